@@ -1,16 +1,177 @@
+import json
+import time
 from urllib.parse import unquote
 
-from flask import abort, Flask, request
+from flask import abort, Flask, g, make_response, request, Response
 from flask_cors import CORS
 from flask_restful import Api, Resource
 
-from .search import ESearch
+from .cache import get_cache
+from .client import _env_flag, pool_stats
+from .encoding import dumps
+from .http_cache import (
+    cache_control,
+    compress_response,
+    current_generation,
+    encoded_etag,
+    etag_matches,
+    request_etag,
+)
+from .metrics import (
+    current_timings,
+    export,
+    finish_request,
+    record_serialization,
+    start_request,
+)
+from .profiling import (
+    add_profile,
+    build_report,
+    dump_slow_request,
+    start_profile,
+    wants_profile,
+)
+from .search import ESearch, InvalidCursor
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+MAX_BATCH_OPERATIONS = 50  # the most operations accepted in a single batch
+MAX_BATCH_COUNT = 1000  # the most results returned by each operation of a batch
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# The endpoints whose responses only depend on the request and the indexed data
+TAGGED_ENDPOINTS = [
+    "singlefieldsearch",
+    "generalsearch",
+    "fulllist",
+    "suggestion",
+    "completion",
+    "combinedsuggestions",
+    "entryinstances",
+]
 
 app = Flask(__name__)
-CORS(app)
+# Let browsers read the cursor for the next page of results
+CORS(app, expose_headers=[NEXT_CURSOR_HEADER])
 api = Api(app)
 
 
+@app.before_request
+def _start_timing():
+    start_request()
+    g.profile = start_profile(wants_profile(request.args))
+
+
+@app.after_request
+def _record_metrics(response):
+    # Group requests by route rather than URL, so that words don't become labels
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    if route != "/metrics":
+        size = None if response.is_streamed else response.content_length
+        timings = finish_request(route, request.method, response.status_code, size)
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.stop()
+        if timings is not None:
+            dump_slow_request(request.full_path, timings, profile)
+    return response
+
+
+@app.before_request
+def _check_etag():
+    # Tag the responses to searches, and answer at once if the client has them.
+    # Pages read through a cursor come from a point in time, which may not be
+    # the current data and may have expired, so they must always be fetched.
+    g.etag = None
+    if (
+        request.method != "GET"
+        or request.endpoint not in TAGGED_ENDPOINTS
+        or "cursor" in request.args
+        or not _env_flag("ORACC_ETAGS", True)
+    ):
+        return None
+    search = _new_search()
+    if search.profile:
+        return None  # profiles are only useful if the request is actually run
+    generation = current_generation(search.client, search.index)
+    if generation is None:
+        return None
+    g.etag = request_etag(
+        generation,
+        request.endpoint,
+        request.view_args,
+        request.args,
+        request.form,
+        _wants_stream(request.args, request.accept_mimetypes),
+    )
+    if etag_matches(request.if_none_match, g.etag):
+        response = Response(status=304)
+        response.set_etag(g.etag)
+        response.headers["Cache-Control"] = cache_control(request.endpoint)
+        response.vary.update(["Accept", "Accept-Encoding"])
+        return response
+    return None
+
+
+@app.after_request
+def _compress(response):
+    # This runs before the metrics are recorded, so they show the size sent
+    coding = compress_response(response, request.accept_encodings)
+    etag = g.get("etag")
+    if etag is not None and response.status_code in [200, 204] and "cursor" not in request.args:
+        response.set_etag(encoded_etag(etag, coding))
+        response.headers["Cache-Control"] = cache_control(request.endpoint)
+        response.vary.update(["Accept", "Accept-Encoding"])
+    return response
+
+
+@app.teardown_request
+def _stop_profile(exception):
+    # Make sure the profiler is released even if the request failed
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.stop()
+
+
+def _new_search():
+    """Create an ESearch, which profiles its searches if that was requested."""
+    profile = g.get("profile")
+    return ESearch(profile=profile is not None and profile.es)
+
+
+@api.representation("application/json")
+def _output_json(data, code, headers=None):
+    """Encode a response as JSON, recording how long that takes.
+
+    The encoder is chosen by the encoding module. If the client asked for a
+    profile, it is added to the response.
+    """
+    results = data
+    profile = g.get("profile")
+    timings = current_timings()
+    if profile is not None and profile.es and timings is not None:
+        data = add_profile(data, build_report(timings, timings.elapsed(), profile))
+    start = time.perf_counter()
+    response = make_response(dumps(data), code)
+    response.mimetype = "application/json"
+    response.headers.extend(headers or {})
+    record_serialization(time.perf_counter() - start, results)
+    return response
+
+
+def _check_after(after):
+    """Check that the "after" option is the list of sort values of a result.
+
+    ES rejects anything else, so the request is aborted with an error message
+    if it is not.
+    """
+    if not isinstance(after, list) or len(after) != ESearch.SORT_KEYS:
+        abort(
+            400,
+            "The after parameter must be the sort value of a result "
+            "(a JSON list of {} values)!".format(ESearch.SORT_KEYS),
+        )
+    return after
+
+
 def _parse_request_args(args):
     """Retrieve the options of interest from a dictionary of arguments.
 
@@ -29,6 +190,22 @@ def _parse_request_args(args):
             # contain "weird" characters), we explicitly un-escape the arguments
             # here.
             out_args[option] = unquote(args[option])
+    # The sort values of a hit are given as a JSON list, which must be decoded
+    # to be passed back to ES
+    if "after" in out_args:
+        try:
+            after = json.loads(out_args["after"])
+        except ValueError:
+            after = None
+        out_args["after"] = _check_after(after)
+    # Fields to include in or exclude from the results can be given as
+    # comma-separated lists
+    list_options = ["fields", "exclude"]
+    for option in list_options:
+        if option in args:
+            out_args[option] = [
+                field.strip() for field in unquote(args[option]).split(",") if field.strip()
+            ]
     # See if the user has specified how many results to retrieve
     # (we do this separately as we have to convert it to an integer)
     try:
@@ -38,6 +215,79 @@ def _parse_request_args(args):
     return out_args
 
 
+def _parse_field_query(form):
+    """Get the field to search and the word to look for in it from form data."""
+    if not form:
+        abort(400, "No query specified!")
+    elif len(form) > 1:
+        abort(400, "Too many fields specified!")
+    return list(form.items())[0]
+
+
+def _parse_instances_args(args):
+    """Get the position to start from and the number of instances to return."""
+    try:
+        after = max(int(args.get("after", 0)), 0)
+        count = max(int(args.get("count", 100)), 0)
+    except ValueError:
+        abort(400, "The after and count parameters must be integers!")
+    return after, min(count, ESearch.MAX_INSTANCES_COUNT)
+
+
+def _wants_stream(args, accept_mimetypes):
+    """Check whether the results of a request should be streamed as NDJSON.
+
+    Streaming can be requested either by passing stream=1 as a parameter, or
+    by preferring NDJSON to JSON in the Accept header.
+    """
+    if args.get("stream", "").lower() in ["1", "true", "yes"]:
+        return True
+    best = accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def _stream_results(results):
+    """Create a response which sends results one per line as they are found.
+
+    Since the results are encoded and sent one by one, the whole list never
+    needs to be held in memory, and the client starts receiving data as soon as
+    the first batch of results is available from ES.
+    """
+    results = iter(results)
+    # Find the first result now, to be able to respond as for normal requests
+    # when there are no results at all
+    try:
+        first = next(results)
+    except StopIteration:
+        return {}, 204  # "empty content" response if no results found
+
+    def generate():
+        yield dumps(first)
+        for result in results:
+            yield dumps(result)
+
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+
+def _cursor_page(search, word, args, cursor):
+    """Get a page of results through a cursor, for the Flask resources.
+
+    The results are returned in the body as usual, and the cursor for the next
+    page (if there is one) in the X-Next-Cursor header. An empty cursor starts
+    from the first page.
+    """
+    # The cursor replaces the after parameter
+    options = {option: value for option, value in args.items() if option != "after"}
+    try:
+        results, next_cursor = search.page(word, cursor or None, **options)
+    except InvalidCursor as e:
+        abort(400, str(e))
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    if not results:
+        return {}, 204, headers  # "empty content" response if no results found
+    return results, 200, headers
+
+
 def _all_suggest_compiler(completions, suggestions):
     """This combines the suggestions and completions into
     a dictionary which can be displayed."""
@@ -47,16 +297,16 @@ def _all_suggest_compiler(completions, suggestions):
 
 class SingleFieldSearch(Resource):
     def get(self):
-        args = request.form
         # Parse request
-        if not args:
-            abort(400, "No query specified!")
-        elif len(args) > 1:
-            abort(400, "Too many fields specified!")
-        fieldname, word = list(args.items())[0]
+        fieldname, word = _parse_field_query(request.form)
+        # Only the field selection can be customised for this kind of search
+        options = _parse_request_args(request.args)
+        projection = {
+            option: options[option] for option in ["fields", "exclude"] if option in options
+        }
         # Pass to ElasticSearch
-        search = ESearch()
-        results = search.run(word, fieldname)
+        search = _new_search()
+        results = search.run(word, fieldname, **projection)
         # Return search results to caller
         if not results:
             return {}, 204  # "empty content" response if no results found
@@ -67,9 +317,12 @@ class GeneralSearch(Resource):
     def get(self, word):
         """Search "all" fields in the database for the given word."""
         args = _parse_request_args(request.args)
-        print("ARGS", args)
         # Pass to ElasticSearch
-        search = ESearch()
+        search = _new_search()
+        if "cursor" in request.args:
+            return _cursor_page(search, word, args, request.args["cursor"])
+        if _wants_stream(request.args, request.accept_mimetypes):
+            return _stream_results(search.run(word, stream=True, **args))
         results = search.run(word, **args)
         # Return search results to caller
         if not results:
@@ -85,7 +338,7 @@ class Suggestion(Resource):
             size = args["count"]
         else:
             size = 100
-        search = ESearch()
+        search = _new_search()
         results = search.suggest(word, size)
         return results
 
@@ -98,7 +351,7 @@ class Completion(Resource):
             size = args["count"]
         else:
             size = 200
-        search = ESearch()
+        search = _new_search()
         results = search.complete(word, size)
         return results
 
@@ -115,38 +368,135 @@ class CombinedSuggestions(Resource):
         else:
             c_size = 200
             s_size = 100
-        search = ESearch()
+        search = _new_search()
 
-        completions = search.complete(word, c_size)
-        suggestions = search.suggest(word, s_size)
+        # Both are retrieved with a single request to ES
+        completions, suggestions = search.suggest_all(word, c_size, s_size)
         results = _all_suggest_compiler(completions, suggestions)
         return results
 
 
+def _parse_batch_operation(operation):
+    """Check that an operation of a batch request is valid and normalise it.
+
+    Aborts the request with an error message if the operation is invalid.
+    """
+    if not isinstance(operation, dict):
+        abort(400, "Each operation must be a JSON object!")
+    if operation.get("type") not in ESearch.BATCH_DEFAULT_SIZES:
+        abort(400, "Unknown operation type: {}".format(operation.get("type")))
+    if not isinstance(operation.get("word"), str):
+        abort(400, "Each operation must specify a word!")
+    parsed = {"type": operation["type"], "word": operation["word"]}
+    for option in ESearch.BATCH_SEARCH_OPTIONS + ["after"]:
+        if option in operation:
+            parsed[option] = operation[option]
+    if "after" in parsed:
+        _check_after(parsed["after"])
+    for option in ["sort_by", "direction"]:
+        if option in parsed and not isinstance(parsed[option], str):
+            abort(400, "The {} of an operation must be a string!".format(option))
+    for option in ["fields", "exclude"]:
+        if option not in parsed:
+            continue
+        # Like with request parameters, also accept comma-separated lists of fields
+        if isinstance(parsed[option], str):
+            parsed[option] = [
+                field.strip() for field in parsed[option].split(",") if field.strip()
+            ]
+        elif not (
+            isinstance(parsed[option], list)
+            and all(isinstance(field, str) for field in parsed[option])
+        ):
+            abort(400, "The {} of an operation must be a list of field names!".format(option))
+    if "count" in operation:
+        try:
+            count = int(operation["count"])
+        except (TypeError, ValueError):
+            abort(400, "The count of an operation must be an integer!")
+        if count < 0:
+            abort(400, "The count of an operation cannot be negative!")
+        parsed["count"] = min(count, MAX_BATCH_COUNT)
+    return parsed
+
+
+class Batch(Resource):
+    def post(self):
+        """Run several searches, completions and suggestions at once.
+
+        The body of the request should be a JSON list of operations, each an
+        object with a "type" ("search", "completion" or "suggest"), a "word",
+        and optionally a "count" and the other parameters accepted by the
+        corresponding endpoint. The response is the list of their results, in
+        the same order.
+        """
+        operations = request.get_json(silent=True)
+        if not isinstance(operations, list):
+            abort(400, "The request body must be a JSON list of operations!")
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            abort(400, "Too many operations (maximum {})".format(MAX_BATCH_OPERATIONS))
+        operations = [_parse_batch_operation(operation) for operation in operations]
+        search = _new_search()
+        return search.batch(operations)
+
+
 class FullList(Resource):
     def get(self):
         """Return all entries in the database.
 
         Optionally search within a specific range of entries, by passing a
-        starting index (start) and the desired number of results (count).
+        starting index (start) and the desired number of results (count), or
+        page through them with a cursor.
         """
         args = _parse_request_args(request.args)
-        print("ARGS", args)
         # Pass to ElasticSearch
-        search = ESearch()
+        search = _new_search()
+        if "cursor" in request.args:
+            return _cursor_page(search, None, args, request.args["cursor"])
+        if _wants_stream(request.args, request.accept_mimetypes):
+            return _stream_results(search.list_all(stream=True, **args))
         results = search.list_all(**args)
         # Return search results to caller
         return results
 
 
+class EntryInstances(Resource):
+    def get(self, entry_id):
+        """Get the instances of an entry, optionally a page at a time.
+
+        The position to start from (after) and the number of instances to
+        return (count) can be given as parameters. At most
+        ESearch.MAX_INSTANCES_COUNT instances are returned at once.
+        """
+        after, count = _parse_instances_args(request.args)
+        search = _new_search()
+        results = search.instances(entry_id, after, count)
+        if results is None:
+            abort(404, "No entry with id {}".format(entry_id))
+        return results
+
+
 class TestRoute(Resource):
     def get(self):
-        search = ESearch()
+        search = _new_search()
         print("testing")
         search.test_connection()
         return "Hello world!!!!!"
 
 
+@app.route("/metrics")
+def metrics():
+    """Export the request metrics for Prometheus."""
+    data, content_type = export()
+    return Response(data, content_type=content_type)
+
+
+class Stats(Resource):
+    def get(self):
+        """Report usage statistics to help with tuning the server."""
+        return {"pool": pool_stats(), "cache": get_cache().stats()}
+
+
 # Make the search API available at the "/search" and "/suggest" endpoints
 api.add_resource(SingleFieldSearch, "/search")
 api.add_resource(GeneralSearch, "/search/<string:word>")
@@ -154,4 +504,7 @@ api.add_resource(FullList, "/search_all")
 api.add_resource(Suggestion, "/suggest/<string:word>")
 api.add_resource(Completion, "/completion/<string:word>")
 api.add_resource(CombinedSuggestions, "/suggest_all/<string:word>")
+api.add_resource(Batch, "/batch")
+api.add_resource(EntryInstances, "/entry/<string:entry_id>/instances")
 api.add_resource(TestRoute, "/test")
+api.add_resource(Stats, "/stats")
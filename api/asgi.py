@@ -0,0 +1,265 @@
+"""An ASGI version of the search API, built on the asynchronous ES client.
+
+This serves the same search, suggestion and instance endpoints as the Flask
+app, with the same parameters and responses, but every request is handled as a
+coroutine: a single worker can have many requests waiting on Elasticsearch at
+once, and independent searches (such as the completions and suggestions needed
+by /suggest_all) are sent concurrently.
+
+Only the endpoints themselves are implemented here: batches, the result cache,
+ETags and compression, profiling and the /metrics and /stats endpoints are only
+available in the Flask app.
+
+It can be run with any ASGI server, for instance:
+
+    gunicorn -k uvicorn.workers.UvicornWorker --workers=5 api.asgi:app
+"""
+import re
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header
+
+from . import (
+    _all_suggest_compiler,
+    _parse_field_query,
+    _parse_instances_args,
+    _parse_request_args,
+    _wants_stream,
+    NDJSON_MIMETYPE,
+    NEXT_CURSOR_HEADER,
+)
+from .async_search import AsyncESearch
+from .client import get_async_client
+from .encoding import dumps
+from .search import InvalidCursor
+
+
+def _headers(content_type=None, extra_headers=None):
+    # Allow requests from any origin, like the Flask app does
+    headers = [
+        (b"access-control-allow-origin", b"*"),
+        (b"access-control-expose-headers", NEXT_CURSOR_HEADER.encode("latin-1")),
+    ]
+    if content_type is not None:
+        headers.insert(0, (b"content-type", content_type.encode("latin-1")))
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+    return headers
+
+
+async def _send_json(send, data, status=200, extra_headers=None):
+    """Send a complete JSON response."""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": _headers("application/json", extra_headers),
+        }
+    )
+    await send({"type": "http.response.body", "body": dumps(data)})
+
+
+async def _send_empty(send, status=204, extra_headers=None):
+    """Send a response without a body (e.g. when no results are found)."""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": _headers(extra_headers=extra_headers),
+        }
+    )
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _send_results(send, results, stream):
+    """Send a list of results, or stream them as NDJSON as they are found."""
+    if not stream:
+        if not results:
+            await _send_empty(send)  # "empty content" if no results found
+        else:
+            await _send_json(send, results)
+        return
+    # As in the Flask app, look for the first result before starting the
+    # response, so that we can still reply with 204 if there are no results
+    results = results.__aiter__()
+    try:
+        first = await results.__anext__()
+    except StopAsyncIteration:
+        await _send_empty(send)
+        return
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": _headers(NDJSON_MIMETYPE),
+        }
+    )
+    await send({"type": "http.response.body", "body": dumps(first), "more_body": True})
+    async for result in results:
+        await send({"type": "http.response.body", "body": dumps(result), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _send_page(send, word, options, cursor):
+    """Send a page of results, with the cursor for the next page in a header."""
+    options = {option: value for option, value in options.items() if option != "after"}
+    try:
+        results, next_cursor = await AsyncESearch().page(word, cursor or None, **options)
+    except InvalidCursor as e:
+        await _send_json(send, {"message": str(e)}, 400)
+        return
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    if not results:
+        await _send_empty(send, 204, headers)
+    else:
+        await _send_json(send, results, 200, headers)
+
+
+async def single_field_search(send, args, form, accept):
+    """Search a specific field (given in the form data) for a word."""
+    fieldname, word = _parse_field_query(form)
+    # Only the field selection can be customised for this kind of search
+    options = _parse_request_args(args)
+    projection = {
+        option: options[option] for option in ["fields", "exclude"] if option in options
+    }
+    results = await AsyncESearch().run(word, fieldname, **projection)
+    await _send_results(send, results, False)
+
+
+async def general_search(send, args, form, accept, word):
+    """Search "all" fields in the database for the given word."""
+    options = _parse_request_args(args)
+    if "cursor" in args:
+        await _send_page(send, word, options, args["cursor"])
+        return
+    stream = _wants_stream(args, accept)
+    results = await AsyncESearch().run(word, stream=stream, **options)
+    await _send_results(send, results, stream)
+
+
+async def full_list(send, args, form, accept):
+    """Return all entries in the database."""
+    options = _parse_request_args(args)
+    if "cursor" in args:
+        await _send_page(send, None, options, args["cursor"])
+        return
+    stream = _wants_stream(args, accept)
+    results = await AsyncESearch().list_all(stream=stream, **options)
+    await _send_results(send, results, stream)
+
+
+async def suggestion(send, args, form, accept, word):
+    """Get suggestions for terms similar to a (possibly partial) word."""
+    size = _parse_request_args(args).get("count", 100)
+    await _send_json(send, await AsyncESearch().suggest(word, size))
+
+
+async def completion(send, args, form, accept, word):
+    """Get completions for partial words."""
+    size = _parse_request_args(args).get("count", 200)
+    await _send_json(send, await AsyncESearch().complete(word, size))
+
+
+async def combined_suggestions(send, args, form, accept, word):
+    """Get both completions and suggestions, searching for them concurrently."""
+    options = _parse_request_args(args)
+    c_size = options.get("count", 200)
+    s_size = options.get("count", 100)
+    completions, suggestions = await AsyncESearch().suggest_all(word, c_size, s_size)
+    await _send_json(send, _all_suggest_compiler(completions, suggestions))
+
+
+async def entry_instances(send, args, form, accept, entry_id):
+    """Get the instances of an entry, optionally a page at a time."""
+    after, count = _parse_instances_args(args)
+    results = await AsyncESearch().instances(entry_id, after, count)
+    if results is None:
+        await _send_json(send, {"message": "No entry with id {}".format(entry_id)}, 404)
+    else:
+        await _send_json(send, results)
+
+
+async def test_route(send, args, form, accept):
+    await _send_json(send, "Hello world!!!!!")
+
+
+ROUTES = [
+    (re.compile(r"/search"), single_field_search),
+    (re.compile(r"/search/(?P<word>[^/]+)"), general_search),
+    (re.compile(r"/search_all"), full_list),
+    (re.compile(r"/suggest/(?P<word>[^/]+)"), suggestion),
+    (re.compile(r"/completion/(?P<word>[^/]+)"), completion),
+    (re.compile(r"/suggest_all/(?P<word>[^/]+)"), combined_suggestions),
+    (re.compile(r"/entry/(?P<entry_id>[^/]+)/instances"), entry_instances),
+    (re.compile(r"/test"), test_route),
+]
+
+
+async def _read_form(receive, headers):
+    """Read the body of a request, if it holds form data."""
+    content_type = headers.get(b"content-type", b"").split(b";")[0].strip()
+    if content_type != b"application/x-www-form-urlencoded":
+        return {}
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    return dict(parse_qsl(body.decode("utf8"), keep_blank_values=True))
+
+
+def _without_body(send):
+    """Wrap the send function of a HEAD request, leaving out the bodies."""
+    async def send_headers(message):
+        if message["type"] == "http.response.body":
+            message = dict(message, body=b"")
+        await send(message)
+
+    return send_headers
+
+
+async def _lifespan(receive, send):
+    """Handle the server starting up and shutting down."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Close the connections to ES cleanly
+            await get_async_client().close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if scope["method"] == "HEAD":
+        send = _without_body(send)
+    for pattern, handler in ROUTES:
+        match = pattern.fullmatch(scope["path"])
+        if match:
+            break
+    else:
+        await _send_json(send, {"message": "Not found"}, 404)
+        return
+    if scope["method"] not in ["GET", "HEAD"]:
+        await _send_json(send, {"message": "Method not allowed"}, 405)
+        return
+    args = dict(parse_qsl(scope["query_string"].decode("utf8"), keep_blank_values=True))
+    headers = dict(scope["headers"])
+    form = await _read_form(receive, headers)
+    accept = parse_accept_header(headers.get(b"accept", b"").decode("latin-1"), MIMEAccept)
+    try:
+        await handler(send, args, form, accept, **match.groupdict())
+    except HTTPException as e:
+        # Invalid parameters are reported as in the Flask app
+        await _send_json(send, {"message": e.description}, e.code)
@@ -0,0 +1,140 @@
+"""An asynchronous version of the searches, for use with the ASGI API.
+
+The queries are built exactly as in ESearch, but they are sent through the
+asynchronous Elasticsearch client, so that many of them can be waiting for a
+response at the same time without each needing its own thread.
+"""
+import asyncio
+
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import async_scan
+
+from .client import get_async_client
+from .search import ESearch, InvalidCursor
+
+
+class AsyncESearch(ESearch):
+    def __init__(self, index_name="oracc", client=None):
+        super().__init__(
+            index_name, client if client is not None else get_async_client()
+        )
+
+    async def _send(self, search, index=None):
+        """Send a search to ES and return the raw response."""
+        return await self.client.search(index=index or self.index, body=search.to_dict())
+
+    async def _sources(self, search, index=None):
+        """Get the documents found by a search, as dictionaries."""
+        response = await self._send(search, index)
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    async def _customise_and_run_async(self, search, count, after):
+        """
+        Execute an ES search appropriately, depending on the specified
+        customisation, and return an asynchronous iterator over the raw hits.
+
+        This follows the same rules as ESearch._customise_and_run.
+        """
+        if after is None and count is None:
+            # When scanning, we must explicitly ask to preserve sorting order!
+            async for hit in async_scan(
+                self.client, query=search.to_dict(), index=self.index, preserve_order=True
+            ):
+                yield hit
+            return
+        if after is not None:
+            search = search.extra(search_after=after)
+            if count is not None:
+                search = search.extra(size=count)
+        else:
+            search = search[0:count]
+        response = await self._send(search)
+        for hit in response["hits"]["hits"]:
+            yield hit
+
+    async def _iter_results_async(self, hits):
+        """Get the required information from each raw hit, one at a time."""
+        async for hit in hits:
+            yield self._format_hit(hit["_source"], hit["sort"])
+
+    async def run(self, word, fieldname=None, stream=False, **args):
+        """Find matches for the given word (optionally in a specified field).
+
+        If stream is True, an asynchronous generator of the results is
+        returned instead of a list.
+        """
+        count = args.pop("count", None)
+        after = args.pop("after", None)
+        if fieldname is None:
+            search = self._general_search(word, **args)
+        else:
+            search = self._field_search(word, fieldname, **args)
+        results = self._iter_results_async(
+            self._customise_and_run_async(search, count, after)
+        )
+        return results if stream else [result async for result in results]
+
+    async def list_all(self, count=None, after=None, stream=False, **args):
+        """Get a list of all entries (or a generator of them, if stream is True)."""
+        search = self._all_search(**args)
+        results = self._iter_results_async(
+            self._customise_and_run_async(search, count, after)
+        )
+        return results if stream else [result async for result in results]
+
+    async def page(self, word=None, cursor=None, count=None, **args):
+        """Get a page of results and the next cursor (see ESearch.page)."""
+        if word is None:
+            search = self._all_search(**args)
+        else:
+            search = self._general_search(word, **args)
+        count = count or self.CURSOR_PAGE_SIZE
+        fingerprint, pit_id, after = self._start_page(search, cursor)
+        if pit_id is None:
+            pit_id = (
+                await self.client.open_point_in_time(
+                    index=self.index, keep_alive=self.CURSOR_KEEP_ALIVE
+                )
+            )["id"]
+        search = self._page_search(search, pit_id, after, count)
+        try:
+            response = await self.client.search(body=search.to_dict())
+        except NotFoundError as e:
+            raise InvalidCursor("The cursor has expired") from e
+        results, next_cursor, pit_id = self._finish_page(response, fingerprint, pit_id, count)
+        if next_cursor is None:
+            await self.client.close_point_in_time(body={"id": pit_id})
+        return results, next_cursor
+
+    async def suggest(self, word, size):
+        """Get search suggestions matching a given word (see ESearch.suggest)."""
+        response = await self._send(self._suggest_search(word, size))
+        return self._sorted_suggestions(response["suggest"])
+
+    async def complete(self, word, size):
+        """Get completions for a given word (see ESearch.complete)."""
+        response = await self._send(self._complete_search(word, size))
+        return self._sorted_completions(response["suggest"])
+
+    async def suggest_all(self, word, completion_size, suggestion_size):
+        """Get both completions and suggestions for a word.
+
+        The two searches are independent, so they are sent concurrently.
+        """
+        return await asyncio.gather(
+            self.complete(word, completion_size), self.suggest(word, suggestion_size)
+        )
+
+    async def instances(self, entry_id, after=0, count=100):
+        """Get a page of the instances of an entry (see ESearch.instances)."""
+        chunks = await self._sources(
+            self._instances_search(entry_id, after, count), self.instances_index
+        )
+        if not chunks:
+            existing = await self._sources(
+                self._instances_total_search(entry_id), self.instances_index
+            )
+            if not existing:
+                return None
+            return {"id": entry_id, "total": existing[0]["total"], "instances": [], "next": None}
+        return self._instances_page(entry_id, chunks, after, count)
@@ -0,0 +1,242 @@
+"""An in-process cache for the results of searches.
+
+The indexed data only changes when glossaries are ingested, but many requests
+(especially from autocompletion) are repeated over and over. Results are
+therefore cached in memory, keyed by the (normalised) query and its options.
+
+To notice when new data has been ingested, the cache regularly checks the
+"generation" of the index, which the ingest process records in the index's
+mapping metadata. When it changes, all cached results for that index are
+dropped.
+
+The cache can be configured through the following environment variables:
+
+- ORACC_CACHE_MAX_BYTES: roughly how much memory the cache can use, in bytes
+  (default 64 MiB). Setting this to 0 disables caching.
+- ORACC_CACHE_TTL: how long results are kept, in seconds (default 300)
+- ORACC_CACHE_CHECK_INTERVAL: how often to check whether the index generation
+  has changed, in seconds (default 5)
+"""
+from collections import OrderedDict
+import functools
+import inspect
+import json
+import threading
+import time
+import unicodedata
+
+from elasticsearch.exceptions import NotFoundError
+
+from .client import _env_int
+from .encoding import dumps
+
+SIZE_SAMPLE = 20  # how many items of a long list to encode to estimate its size
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalise_word(word):
+    """Normalise a query word, so that equivalent queries share a cache entry.
+
+    The searches are not sensitive to case or to extra whitespace, and the same
+    characters can be represented by different Unicode sequences. Only the
+    lowercase forms are used, as in the analyzers: casefolding would also merge
+    words which are searched differently (e.g. "Straße" and "STRASSE").
+    """
+    return " ".join(unicodedata.normalize("NFC", word).lower().split())
+
+
+def estimate_size(value):
+    """Estimate the size of a result from the length of its JSON encoding.
+
+    Long lists of results are estimated from a sample of their items, so that
+    large results don't have to be encoded in full (on top of encoding them
+    for the response) only to find that they are too large to cache.
+    """
+    if isinstance(value, list) and len(value) > SIZE_SAMPLE:
+        sample = value[::len(value) // SIZE_SAMPLE][:SIZE_SAMPLE]
+        return (len(dumps(sample)) - 1) * len(value) // len(sample)
+    return len(dumps(value)) - 1  # not counting the final newline
+
+
+def index_generation(client, index):
+    """Find the generation of the data in an index (or behind an alias).
+
+    This combines the name of each concrete index with the generation recorded
+    in its metadata, so it changes whenever the data is re-ingested or an alias
+    is moved to a new index. Returns None if the index does not exist.
+    """
+    try:
+        mappings = client.indices.get_mapping(index=index)
+    except NotFoundError:
+        return None
+    return ",".join(
+        "{}:{}".format(name, mapping["mappings"].get("_meta", {}).get("generation", ""))
+        for name, mapping in sorted(mappings.items())
+    )
+
+
+class ResultCache:
+    """A thread-safe LRU cache with a time limit and a bound on its total size.
+
+    The size of each result is estimated from the length of its JSON encoding
+    (see estimate_size).
+    Results larger than a quarter of the maximum size are never cached, so that
+    a single huge result cannot push out everything else.
+    """
+
+    def __init__(self, max_bytes, ttl, check_interval):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._entries = OrderedDict()  # key -> (expiry time, size, value)
+        self._generations = {}  # index -> (generation, time of last check)
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """Look up a key, returning a (found, value) pair."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:  # expired
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used ones if needed."""
+        size = estimate_size(value)
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        """Remove an entry (the lock must be held when calling this)."""
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def clear(self, index=None):
+        """Remove all cached results (only for the given index, if specified)."""
+        with self._lock:
+            for key in list(self._entries):
+                if index is None or key[0] == index:
+                    self._remove(key)
+            if index is None:
+                self._generations.clear()
+            else:
+                self._generations.pop(index, None)
+
+    def generation(self, client, index):
+        """Return the current generation of an index, checking it regularly.
+
+        If the generation has changed since the last check, all results cached
+        for the index are dropped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            generation, checked = self._generations.get(index, (None, None))
+        if checked is not None and now - checked < self.check_interval:
+            return generation
+        new_generation = index_generation(client, index)
+        if checked is not None and new_generation != generation:
+            self.clear(index)
+            self.invalidations += 1
+        with self._lock:
+            self._generations[index] = (new_generation, now)
+        return new_generation
+
+    def stats(self):
+        """Report how the cache is being used."""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def get_cache():
+    """Return the cache for this process, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache(
+                    max_bytes=_env_int("ORACC_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+                    ttl=_env_int("ORACC_CACHE_TTL", 300),
+                    check_interval=_env_int("ORACC_CACHE_CHECK_INTERVAL", 5),
+                )
+    return _cache
+
+
+def cached(method):
+    """Cache the results of an ESearch method.
+
+    Results are keyed by the index searched, the name of the method and all its
+    arguments. The query word is normalised when it is searched for in the
+    analysed text fields (ESearch.FIELDNAMES), which ignore case; searches on
+    a single other field (e.g. a keyword field such as the id) use it as it is.
+    Requests for a stream of results
+    or for a profile are never cached, and neither are searches on an index
+    that doesn't exist.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = get_cache()
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        del arguments["self"]
+        # Arguments collected by **args are grouped under a single name
+        for name, parameter in signature.parameters.items():
+            if parameter.kind == parameter.VAR_KEYWORD:
+                arguments.update(arguments.pop(name))
+        # Profiled searches must actually be run to be profiled
+        if not cache.enabled or arguments.get("stream") or getattr(self, "profile", False):
+            return method(self, *args, **kwargs)
+        analysed_fields = [None] + getattr(self, "FIELDNAMES", [])
+        if "word" in arguments and arguments.get("fieldname") in analysed_fields:
+            arguments["word"] = normalise_word(arguments["word"])
+        generation = cache.generation(self.client, self.index)
+        if generation is None:
+            return method(self, *args, **kwargs)
+        key = (
+            self.index,
+            generation,
+            method.__name__,
+            json.dumps(arguments, sort_keys=True),
+        )
+        found, value = cache.get(key)
+        if not found:
+            value = method(self, *args, **kwargs)
+            cache.put(key, value)
+        return value
+
+    return wrapper
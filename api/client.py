@@ -0,0 +1,140 @@
+"""A shared Elasticsearch client for all requests handled by a worker process.
+
+Creating an Elasticsearch client also creates a new pool of HTTP connections,
+so doing it on every request means that no connection is ever reused. Instead,
+each process creates a single client the first time it is needed, and all
+request threads share it (the client and its connection pool are thread-safe).
+
+The client can be tuned through the following environment variables:
+
+- ELASTICSEARCH_HOST: the address of the Elasticsearch instance
+- ORACC_ES_POOL_SIZE: maximum number of connections kept open (default 10)
+- ORACC_ES_TIMEOUT: request timeout in seconds (default 10)
+- ORACC_ES_MAX_RETRIES: how many times to retry a failed request (default 3)
+- ORACC_ES_RETRY_ON_TIMEOUT: whether to also retry timed-out requests (default 1)
+- ORACC_ES_KEEPALIVE: whether to enable TCP keep-alive on connections (default 1)
+"""
+import os
+import socket
+import threading
+
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
+from urllib3.connection import HTTPConnection
+
+from .metrics import TimedTransport
+
+_client = None
+_client_lock = threading.Lock()
+_async_client = None
+
+
+def _env_int(name, default):
+    """Read an integer setting from the environment, or return the default."""
+    try:
+        return int(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    """Read a decimal number setting from the environment, or return the default."""
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _env_flag(name, default):
+    """Read a boolean setting (given as 0 or 1) from the environment."""
+    return bool(_env_int(name, int(default)))
+
+
+class KeepAliveConnection(Urllib3HttpConnection):
+    """A connection whose sockets send TCP keep-alive probes.
+
+    Without this, idle connections in the pool can be silently dropped by
+    firewalls or proxies between us and Elasticsearch, so that the next request
+    on them fails and has to be retried.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool.conn_kw["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+
+
+def client_settings():
+    """Collect the settings used to create the client from the environment."""
+    settings = {
+        "maxsize": _env_int("ORACC_ES_POOL_SIZE", 10),
+        "timeout": _env_int("ORACC_ES_TIMEOUT", 10),
+        "max_retries": _env_int("ORACC_ES_MAX_RETRIES", 3),
+        "retry_on_timeout": _env_flag("ORACC_ES_RETRY_ON_TIMEOUT", True),
+    }
+    if _env_flag("ORACC_ES_KEEPALIVE", True):
+        settings["connection_class"] = KeepAliveConnection
+    return settings
+
+
+def get_client():
+    """Return the client for this process, creating it on first use."""
+    global _client
+    # Check without the lock first, so that the common case stays cheap.
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                host = os.environ.get("ELASTICSEARCH_HOST")
+                # Time the requests to ES, to report them in the metrics
+                _client = Elasticsearch(
+                    host, transport_class=TimedTransport, **client_settings()
+                )
+    return _client
+
+
+def get_async_client():
+    """Return the asynchronous client for this process, creating it on first use.
+
+    This is used by the ASGI version of the API. Since all requests are then
+    handled by a single event loop, no locking is needed.
+    """
+    global _async_client
+    if _async_client is None:
+        # Only import this here, as it requires the optional aiohttp package
+        from elasticsearch import AsyncElasticsearch
+
+        settings = client_settings()
+        # The keep-alive connection class only applies to the synchronous client
+        settings.pop("connection_class", None)
+        host = os.environ.get("ELASTICSEARCH_HOST")
+        _async_client = AsyncElasticsearch(host, **settings)
+    return _async_client
+
+
+def pool_stats():
+    """Report how the connections to each Elasticsearch node are being used.
+
+    For every node, this gives the maximum size of the pool, how many
+    connections have been opened so far, how many are currently idle or in
+    use, and the total number of requests sent through the pool.
+    """
+    if _client is None:
+        return []
+    stats = []
+    for connection in _client.transport.connection_pool.connections:
+        pool = connection.pool
+        # Empty slots in the pool queue are filled with None placeholders, so
+        # only the other items are actual (idle) connections.
+        idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        stats.append(
+            {
+                "host": connection.host,
+                "maxsize": pool.pool.maxsize,
+                "opened": pool.num_connections,
+                "idle": idle,
+                "in_use": max(pool.num_connections - idle, 0),
+                "requests": pool.num_requests,
+            }
+        )
+    return stats
@@ -0,0 +1,59 @@
+"""Encoding the results of requests as JSON.
+
+Responses can hold hundreds of entries, each with long lists of forms, senses
+and so on, and encoding them with the standard json module takes a large part
+of the time spent on each request. They are therefore encoded with orjson when
+it is installed, which is several times faster and produces UTF-8 bytes
+directly, without going through an intermediate string.
+
+The encoder can be chosen with the ORACC_JSON_ENCODER environment variable
+("orjson" or "json"). It defaults to orjson if that is available, and falls back
+to the standard json module otherwise.
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    """Convert the types that JSON encoders don't know about (e.g. AttrDicts)."""
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def _json_dumps(data):
+    return (json.dumps(data, default=_default) + "\n").encode("utf8")
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(
+        data, default=_default, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+    )
+
+
+ENCODERS = {"json": _json_dumps}
+if orjson is not None:
+    ENCODERS["orjson"] = _orjson_dumps
+
+
+def get_encoder(name=None):
+    """
+    Get a function which encodes data as a line of JSON, in UTF-8 bytes.
+
+    :param name: the name of the encoder (by default, the one configured in
+        the environment)
+    :return: the encoding function (the fallback if the encoder is not available)
+    """
+    if name is None:
+        name = os.environ.get("ORACC_JSON_ENCODER", "orjson")
+    return ENCODERS.get(name, _json_dumps)
+
+
+def dumps(data):
+    """Encode data as a line of JSON with the configured encoder."""
+    return get_encoder()(data)
@@ -0,0 +1,139 @@
+"""HTTP caching and compression of the API's responses.
+
+The results of a request only change when new data is ingested, so each
+response to a search is tagged with a strong ETag, made from the generation of
+the index (see the cache module) and the normalised request. Clients and
+proxies which send this back in an If-None-Match header are answered with
+304 Not Modified, without running any search. JSON responses are also
+compressed with gzip (or Brotli, if the brotli package is installed) when the
+client accepts it, in which case the coding is added to the ETag so that each
+encoding of a response has its own tag.
+
+This is configured through the following environment variables:
+
+- ORACC_ETAGS: whether to tag responses and answer conditional requests
+  (default 1)
+- ORACC_CACHE_CONTROL: the Cache-Control header sent with tagged responses
+  (default "no-cache", i.e. they can be stored but must be revalidated)
+- ORACC_CACHE_CONTROL_<ENDPOINT>: the Cache-Control header for a single
+  endpoint, e.g. ORACC_CACHE_CONTROL_FULLLIST for /search_all
+- ORACC_COMPRESS_MIN_BYTES: the size from which responses are compressed
+  (default 1024). Setting this to 0 disables compression.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from .cache import get_cache, normalise_word
+from .client import _env_int
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_CACHE_CONTROL = "no-cache"
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # higher levels are too slow to use on every response
+IGNORED_ARGS = ["profile"]  # parameters which don't change the results
+
+
+def current_generation(client, index):
+    """Get the generation of the data in an index, or None if it is unknown."""
+    try:
+        return get_cache().generation(client, index)
+    except ElasticsearchException:
+        # Let the request itself report the problem
+        return None
+
+
+def request_etag(generation, endpoint, view_args, args, form, variant=None):
+    """
+    Make an ETag for a request, which only changes when its results could.
+
+    :param generation: the generation of the data being searched
+    :param endpoint: the name of the endpoint handling the request
+    :param view_args: the arguments taken from the URL (e.g. the word)
+    :param args: the query parameters of the request, as a MultiDict
+    :param form: the form data of the request, as a MultiDict
+    :param variant: anything else which changes the response (e.g. whether
+        the results are streamed)
+    :return: the tag, without quotes
+    """
+    view_args = {
+        name: normalise_word(value) if name == "word" else value
+        for name, value in (view_args or {}).items()
+    }
+    key = [
+        generation,
+        endpoint,
+        view_args,
+        sorted(item for item in args.items(multi=True) if item[0] not in IGNORED_ARGS),
+        sorted(form.items(multi=True)),
+        variant,
+    ]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest()[:32]
+
+
+def encoded_etag(etag, coding):
+    """The ETag of a response once it has been compressed with a coding."""
+    return "{}-{}".format(etag, coding) if coding else etag
+
+
+def etag_matches(if_none_match, etag):
+    """Check whether a client already has any encoding of a response."""
+    return any(
+        if_none_match.contains_weak(encoded_etag(etag, coding))
+        for coding in [None, "gzip", "br"]
+    )
+
+
+def cache_control(endpoint):
+    """Get the Cache-Control header to send with the responses of an endpoint."""
+    return os.environ.get(
+        "ORACC_CACHE_CONTROL_{}".format(endpoint.upper()),
+        os.environ.get("ORACC_CACHE_CONTROL", DEFAULT_CACHE_CONTROL),
+    )
+
+
+def choose_coding(accept_encodings):
+    """Pick the best compression accepted by the client (or None)."""
+    codings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return accept_encodings.best_match(codings)
+
+
+def compress(data, coding):
+    """Compress the body of a response."""
+    if coding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # Leave out the time, so that the same data is always compressed the same way
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_response(response, accept_encodings):
+    """
+    Compress a JSON response in place, if it is large enough and the client allows it.
+
+    :param response: the Flask response
+    :param accept_encodings: the codings accepted by the client
+    :return: the coding used, or None if the response was left as it was
+    """
+    min_bytes = _env_int("ORACC_COMPRESS_MIN_BYTES", 1024)
+    if (
+        min_bytes <= 0
+        or response.is_streamed
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return None
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    coding = choose_coding(accept_encodings)
+    if coding is None or len(data) < min_bytes:
+        return None
+    response.set_data(compress(data, coding))
+    response.headers["Content-Encoding"] = coding
+    return coding
@@ -0,0 +1,171 @@
+"""Prometheus metrics describing the requests handled by the API.
+
+For each route, this counts the requests (by method and status) and records
+how long they take, how large the responses are and how many results they
+contain. The time taken by each request is also split into phases:
+
+- es: the time Elasticsearch spent on the searches, as reported in the "took"
+  field of its responses
+- network: the rest of the time spent waiting for Elasticsearch, e.g. sending
+  the request and transferring and decoding the response
+- processing: the time spent in Python to build the queries and to process
+  their results (e.g. formatting and sorting them)
+- serialization: the time spent encoding the results as JSON
+
+The metrics are served at /metrics. When the API runs in several processes
+(e.g. as gunicorn workers), the PROMETHEUS_MULTIPROC_DIR environment variable
+must point to an empty folder shared by all processes, in which they record
+their metrics so that they can be added up for each scrape. (The included
+gunicorn.conf.py takes care of emptying it when the server starts.)
+"""
+import contextvars
+import os
+import time
+
+from elasticsearch import Transport
+from prometheus_client import (
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+    Counter,
+    generate_latest,
+    Histogram,
+    multiprocess,
+    REGISTRY,
+)
+
+PHASES = ["es", "network", "processing", "serialization"]
+
+REQUESTS = Counter(
+    "oracc_requests_total",
+    "Requests handled, by route, method and status",
+    ["route", "method", "status"],
+)
+LATENCY = Histogram(
+    "oracc_request_duration_seconds", "Time taken to handle requests", ["route"]
+)
+PHASE_LATENCY = Histogram(
+    "oracc_request_phase_seconds",
+    "Time taken by each phase of handling requests",
+    ["route", "phase"],
+)
+RESPONSE_SIZE = Histogram(
+    "oracc_response_size_bytes",
+    "Size of the response bodies",
+    ["route"],
+    buckets=[4 ** n for n in range(3, 14)],  # 64 bytes to 64 MiB
+)
+RESPONSE_HITS = Histogram(
+    "oracc_response_hits",
+    "Number of results in each response",
+    ["route"],
+    buckets=[0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000],
+)
+
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+class RequestTimings:
+    """Where the time goes while handling a single request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.es = 0.0  # time taken by ES, according to its responses
+        self.es_calls = 0.0  # total time spent waiting for ES
+        self.serialization = 0.0
+        self.hits = None  # the number of results, if the response is a list
+        self.es_profiles = []  # any profiles of the searches returned by ES
+        self.total = None  # the total time taken, once the request is finished
+
+    def elapsed(self):
+        """How long it has been since the request started."""
+        return time.perf_counter() - self.start
+
+    def phases(self, total):
+        """Split the total time taken by the request into its phases."""
+        # ES's own measure may be slightly off, but cannot exceed the wait
+        es = min(self.es, self.es_calls)
+        return {
+            "es": es,
+            "network": self.es_calls - es,
+            "processing": max(total - self.es_calls - self.serialization, 0.0),
+            "serialization": self.serialization,
+        }
+
+
+class TimedTransport(Transport):
+    """A transport which records how long each request to ES takes."""
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        start = time.perf_counter()
+        response = super().perform_request(method, url, headers, params, body)
+        timings = _timings.get()
+        if timings is not None:
+            timings.es_calls += time.perf_counter() - start
+            if isinstance(response, dict):
+                # Multi-searches report the time taken for all searches at once
+                timings.es += response.get("took", 0) / 1000
+                # Profiles are only included if a search asked for them
+                for part in [response] + response.get("responses", []):
+                    if "profile" in part:
+                        timings.es_profiles.append(part["profile"])
+        return response
+
+
+def start_request():
+    """Start timing a new request (in the current thread or task)."""
+    timings = RequestTimings()
+    _timings.set(timings)
+    return timings
+
+
+def current_timings():
+    """Get the RequestTimings of the current request (or None)."""
+    return _timings.get()
+
+
+def record_serialization(seconds, data):
+    """Record how long it took to encode the results of the current request."""
+    timings = _timings.get()
+    if timings is not None:
+        timings.serialization += seconds
+        if isinstance(data, list):
+            timings.hits = len(data)
+
+
+def finish_request(route, method, status, size=None):
+    """
+    Record the metrics for the current request, once its response is ready.
+
+    :param route: the route which handled the request
+    :param method: the HTTP method of the request
+    :param status: the status of the response
+    :param size: the size of the response body, if known (it is not when
+        streaming results)
+    :return: the RequestTimings of the request, or None if it was not timed
+    """
+    timings = _timings.get()
+    if timings is None:
+        return None
+    _timings.set(None)
+    total = timings.total = timings.elapsed()
+    REQUESTS.labels(route, method, status).inc()
+    LATENCY.labels(route).observe(total)
+    for phase, seconds in timings.phases(total).items():
+        PHASE_LATENCY.labels(route, phase).observe(seconds)
+    if size is not None:
+        RESPONSE_SIZE.labels(route).observe(size)
+    if timings.hits is not None:
+        RESPONSE_HITS.labels(route).observe(timings.hits)
+    elif status == 204:
+        RESPONSE_HITS.labels(route).observe(0)
+    return timings
+
+
+def export():
+    """Get the metrics (of all processes) in the Prometheus format, and its type."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
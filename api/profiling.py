@@ -0,0 +1,139 @@
+"""Detailed profiles of single requests, to find out why they are slow.
+
+When enabled, clients can add profile=1 to a request to get a "_profile" block
+along with the results. This contains the time taken by each phase of the
+request (see the metrics module), the functions in which Python spent the most
+time (measured with cProfile), and the profile of each search as reported by
+Elasticsearch's profile API. Such requests are never answered from the cache.
+
+Requests which take too long can also be written to disk as they happen, with
+whatever profile is available for them. To have Python profiles for these,
+a random sample of all requests can be profiled.
+
+Profiling is configured through the following environment variables:
+
+- ORACC_PROFILING: whether clients can ask for profiles (default 0)
+- ORACC_PROFILE_SAMPLE_RATE: the fraction of requests to profile in Python,
+  e.g. 0.01 for 1% of them (default 0)
+- ORACC_SLOW_REQUEST_SECONDS: requests taking at least this long are written
+  to disk (default 0, which disables this)
+- ORACC_PROFILE_DIR: the folder to write slow requests in (default "profiles")
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+
+from .client import _env_flag, _env_float
+
+TOP_FUNCTIONS = 25  # how many functions to include in the Python profiles
+
+# Only one cProfile profiler can be active at a time in recent versions of
+# Python, so only one request per process is profiled at once
+_profiler_lock = threading.Lock()
+
+
+class RequestProfile:
+    """A profile of the Python code run while handling a request."""
+
+    def __init__(self, es=False):
+        """
+        :param es: whether to also ask ES to profile the searches
+        """
+        self.es = es
+        self._profiler = None
+        if _profiler_lock.acquire(blocking=False):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._running = self._profiler is not None
+
+    def stop(self):
+        """Stop profiling (this can safely be called more than once)."""
+        if self._running:
+            self._profiler.disable()
+            self._running = False
+            _profiler_lock.release()
+
+    def top_functions(self):
+        """Get the functions in which most time was spent, or None if not profiled."""
+        if self._profiler is None:
+            return None
+        self.stop()
+        stats = pstats.Stats(self._profiler).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [
+            {
+                "function": "{}:{}({})".format(filename, line, name),
+                "calls": calls,
+                "seconds": own_time,
+                "cumulative_seconds": cumulative_time,
+            }
+            for (filename, line, name), (_, calls, own_time, cumulative_time, _)
+            in rows[:TOP_FUNCTIONS]
+        ]
+
+
+def wants_profile(args):
+    """Check whether a request asks for a profile, and is allowed to."""
+    return (
+        _env_flag("ORACC_PROFILING", False)
+        and args.get("profile", "").lower() in ["1", "true", "yes"]
+    )
+
+
+def start_profile(requested):
+    """
+    Start profiling a request, if it was requested or the request is sampled.
+
+    :param requested: whether the client asked for a profile
+    :return: a RequestProfile, or None if the request is not profiled
+    """
+    if requested:
+        return RequestProfile(es=True)
+    if random.random() < _env_float("ORACC_PROFILE_SAMPLE_RATE", 0):
+        return RequestProfile()
+    return None
+
+
+def build_report(timings, total, profile=None):
+    """Describe where the time went while handling a request."""
+    return {
+        "total_seconds": total,
+        "phases": timings.phases(total),
+        "python": profile.top_functions() if profile is not None else None,
+        "es": timings.es_profiles,
+    }
+
+
+def add_profile(data, report):
+    """Add a profile to the results of a request."""
+    if isinstance(data, dict):
+        return dict(data, _profile=report)
+    return {"results": data, "_profile": report}
+
+
+def dump_slow_request(url, timings, profile=None):
+    """
+    Write a report on a request to disk if it took too long.
+
+    :param url: the URL requested
+    :param timings: the RequestTimings of the finished request
+    :param profile: the RequestProfile of the request, if it was profiled
+    :return: the name of the file written, or None if the request was fast
+    """
+    threshold = _env_float("ORACC_SLOW_REQUEST_SECONDS", 0)
+    if threshold <= 0 or timings.total < threshold:
+        return None
+    directory = os.environ.get("ORACC_PROFILE_DIR", "profiles")
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(
+        directory, "{}-{}.json".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+    )
+    report = dict(url=url, **build_report(timings, timings.total, profile))
+    with open(filename, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    return filename
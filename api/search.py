@@ -1,40 +1,82 @@
 # -*- coding: utf-8 -*-
-import os
+import base64
+import hashlib
+import json
 
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Q, Search
+from elasticsearch.exceptions import NotFoundError, TransportError
+from elasticsearch.helpers import scan
+from elasticsearch_dsl import MultiSearch, Q, Search
+
+from .cache import cached
+from .client import _env_flag, get_client
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be used to get the next page."""
 
 
 class ESearch:
     FIELDNAMES = ["gw", "cf", "forms_n", "norms_n", "senses_mng"]
     TEXT_FIELDS = ["gw"]  # fields with text content on which we can sort
     UNICODE_FIELDS = ["cf"]  # fields which may contain non-ASCII characters
+    POPULARITY_SORT = "-instances_count"  # most frequently attested entries first
+    TIE_BREAKER = "id"  # unique field to keep the order of results stable
+    # How many values the sort (and so the "after" parameter) of a search has:
+    # the popularity, the requested field and the tie-breaker
+    SORT_KEYS = 3
+    # Default number of results for each kind of operation in a batch
+    BATCH_DEFAULT_SIZES = {"search": 100, "completion": 200, "suggest": 100}
+    # Options that can be given to search operations in a batch
+    BATCH_SEARCH_OPTIONS = ["sort_by", "direction", "fields", "exclude"]
+    # How long to keep a consistent view of the data between pages of results
+    CURSOR_KEEP_ALIVE = "2m"
+    CURSOR_PAGE_SIZE = 100  # default number of results in each page
+    # How many instances are stored in each chunk (as in ingest.bulk_upload)
+    INSTANCES_CHUNK_SIZE = 1000
+    MAX_INSTANCES_COUNT = 10000  # the most instances returned at once
 
-    def __init__(self, index_name="oracc"):
-        host = os.environ.get("ELASTICSEARCH_HOST")
-        self.client = Elasticsearch(host)
+    def __init__(self, index_name="oracc", client=None, profile=False, raw=None):
+        # Borrow the client shared by the whole process, unless told otherwise
+        self.client = client if client is not None else get_client()
         self.index = index_name
+        # Whether to ask ES for a profile of how it runs the searches
+        self.profile = profile
+        # Whether to send the searches through the low-level client and read
+        # the responses as they are decoded, rather than through the Response
+        # and Hit objects of elasticsearch_dsl (which only wrap the same data)
+        self.raw = _env_flag("ORACC_RAW_RESPONSES", True) if raw is None else raw
+        # The instances of each entry are kept in a separate index
+        self.instances_index = "{}_instances".format(index_name)
 
     def test_connection(self):
         print("test search connection")
 
-    def _execute(self, word, fieldname):
+    def _field_search(self, word, fieldname, fields=None, exclude=None):
+        """Build the search for entries matching a word in a specific field."""
+        search = (
+            Search(using=self.client, index=self.index)
+            .query("match", **{fieldname: word})
+            .sort(self.POPULARITY_SORT, self.TIE_BREAKER)
+        )
+        return self._project(search, fields, exclude)
+
+    def _execute(self, word, fieldname, fields=None, exclude=None):
         """
         Given a word and a fieldname, return all matching entries in the local
         ElasticSearch DB.
         """
-        search = Search(using=self.client, index=self.index).query(
-            "match", **{fieldname: word}
-        )
-        results = search.scan()
+        search = self._field_search(word, fieldname, fields, exclude)
+        if self.raw:
+            return self._scan(search)
+        # When scanning, we must explicitly ask to preserve sorting order!
+        results = search.params(preserve_order=True).scan()
         return results
 
-    def _execute_general(
-        self, phrase, sort_by="gw", direction="asc", count=None, after=None
+    def _general_search(
+        self, phrase, sort_by="gw", direction="asc", fields=None, exclude=None
     ):
         """
-        Given a phrase of space-separated words, return all matching entries in
-        the local ElasticSearch DB.
+        Build the search for entries matching a phrase of space-separated words.
 
         This works by forming sub-queries for each of the words in the phrase,
         and then taking the set of all results.
@@ -56,87 +98,298 @@ class ESearch:
                 "bool",
                 must=subqueries,
             )
-            .sort(
-                self._sort_field_name(sort_by, direction),
-            )
+            .sort(*self._sort_fields(sort_by, direction))
         )
-        return self._customise_and_run(search, count, after)
+        return self._project(search, fields, exclude)
 
-    def _get_results(self, results):
+    def _execute_general(
+        self,
+        phrase,
+        sort_by="gw",
+        direction="asc",
+        count=None,
+        after=None,
+        fields=None,
+        exclude=None,
+    ):
         """
-        Get the required information from each result and compile it in a list.
+        Given a phrase of space-separated words, return all matching entries in
+        the local ElasticSearch DB.
+        """
+        search = self._general_search(phrase, sort_by, direction, fields, exclude)
+        return self._customise_and_run(search, count, after)
 
-        Currently returns the whole result document along with the sort score.
+    def _all_search(self, sort_by="gw", direction="asc", fields=None, exclude=None):
+        """Build the search for all entries."""
+        search = (
+            Search(using=self.client, index=self.index)
+            .query("match_all")
+            .sort(*self._sort_fields(sort_by, direction))
+        )
+        return self._project(search, fields, exclude)
 
-        This method effectively sorts by _score but is done this way since we need
-        to be within a search query to use .sort() for ES
+    def _iter_results(self, results):
         """
+        Get the required information from each result, one result at a time.
 
-        result_list = [
-            # Add a key called "sort" to each hit, containing its sort "score"
-            dict(
-                **hit.to_dict(),
-                sort=str(hit.meta.sort),
-                instances_count=len(hit.instances),
-            )
-            for hit in results
-        ]
-        # this sorts the results by number of hits (after the search has been done)
-        sorted_result_list = sorted(
-            result_list,
-            key=lambda x: (-x["instances_count"],),
-        )
+        Currently yields the whole result document along with its sort values.
+        The results are already in the right order, since the number of
+        instances of each entry is part of the sort performed by ES.
+        """
+        for hit in results:
+            yield self._format_hit(hit.to_dict(), hit.meta.sort)
+
+    def _iter_raw_results(self, hits):
+        """Get the required information from each raw hit, as _iter_results does."""
+        for hit in hits:
+            yield self._format_hit(hit.get("_source", {}), hit["sort"])
+
+    @staticmethod
+    def _format_hit(source, sort):
+        """Combine the document and sort values of a hit into a single result."""
+        # Add a key called "sort" to each hit, containing its sort values,
+        # which can be passed back as the "after" parameter when paginating
+        return dict(**source, sort=json.dumps(list(sort)))
+
+    def _get_results(self, results):
+        """Get the required information from each result and compile it in a list."""
+        return list(self._iter_results(results))
+
+    def _collect(self, results, stream):
+        """Format the results of a search, as a generator if stream is True or a list."""
+        results = self._iter_raw_results(results) if self.raw else self._iter_results(results)
+        return results if stream else list(results)
+
+    def _send(self, search, index=None):
+        """Send a search to ES through the low-level client and return the raw response."""
+        return self.client.search(index=index or self.index, body=search.to_dict())
+
+    def _scan(self, search):
+        """Go through all the raw hits of a search, keeping their order."""
+        return scan(self.client, query=search.to_dict(), index=self.index, preserve_order=True)
 
-        # This is probably better as a comprehension at the moment,
-        # but in the future we might want some more elaborate processing
-        # result_list = []
-        # for hit in results:
-        #    result_list.append({'headword': hit.headword if hasattr(hit, "headword") else None,
-        #                        'gw': hit.gw if hasattr(hit, "gw") else None,
-        #                        'cf': hit.cf if hasattr(hit, "cf") else None})
-        #    result_list.append(hit.to_dict())
-        return sorted_result_list
-
-    def run(self, word, fieldname=None, **args):
-        """Find matches for the given word (optionally in a specified field)."""
+    def _response(self, search, index=None):
+        """Run a search, getting the raw response or the elasticsearch_dsl one."""
+        return self._send(search, index) if self.raw else search.execute()
+
+    def _response_results(self, response):
+        """Get the formatted results from a search response."""
+        if self.raw:
+            return list(self._iter_raw_results(response["hits"]["hits"]))
+        return self._get_results(response.hits)
+
+    def _response_suggestions(self, response):
+        """Get the suggest section of a search response, as a dictionary."""
+        return response["suggest"] if self.raw else response.suggest.to_dict()
+
+    def _response_sources(self, response):
+        """Get the documents found by a search, as dictionaries."""
+        if self.raw:
+            return [hit["_source"] for hit in response["hits"]["hits"]]
+        return [hit.to_dict() for hit in response.hits]
+
+    @cached
+    def run(self, word, fieldname=None, stream=False, **args):
+        """Find matches for the given word (optionally in a specified field).
+
+        If stream is True, the results are returned as a generator, which only
+        fetches them from ES as they are consumed. Otherwise, they are returned
+        as a list.
+        """
         if fieldname is None:
-            return self._get_results(self._execute_general(word, **args))
+            results = self._execute_general(word, **args)
         else:
-            return self._get_results(self._execute(word, fieldname))
+            results = self._execute(word, fieldname, **args)
+        return self._collect(results, stream)
 
-    def list_all(self, sort_by="gw", direction="asc", count=None, after=None):
-        """Get a list of all entries."""
-        search = (
-            Search(using=self.client, index=self.index)
-            .query("match_all")
-            .sort(
-                self._sort_field_name(sort_by, direction),
-            )
-        )
+    @cached
+    def list_all(
+        self,
+        sort_by="gw",
+        direction="asc",
+        count=None,
+        after=None,
+        fields=None,
+        exclude=None,
+        stream=False,
+    ):
+        """Get a list of all entries (or a generator of them, if stream is True)."""
+        search = self._all_search(sort_by, direction, fields, exclude)
         results = self._customise_and_run(search, count, after)
-        return self._get_results(results)
+        return self._collect(results, stream)
+
+    @staticmethod
+    def _search_fingerprint(search):
+        """Identify a search (its query and sort order) to check cursors against."""
+        body = search.to_dict()
+        # The fields returned and profiling don't affect paging
+        body.pop("_source", None)
+        body.pop("profile", None)
+        encoded = json.dumps(body, sort_keys=True).encode("utf8")
+        return hashlib.sha256(encoded).hexdigest()[:16]
+
+    @staticmethod
+    def _encode_cursor(pit_id, after, fingerprint):
+        """Pack the state needed to continue a search into an opaque token."""
+        state = json.dumps({"pit": pit_id, "after": after, "search": fingerprint})
+        return base64.urlsafe_b64encode(state.encode("utf8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """Unpack the state stored in a cursor (see _encode_cursor)."""
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            state = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+            return state["pit"], state["after"], state["search"]
+        except (ValueError, TypeError, KeyError) as e:
+            raise InvalidCursor("Invalid cursor") from e
+
+    def _start_page(self, search, cursor):
+        """
+        Work out where a page of results starts, from the cursor given.
+
+        Returns an identifier of the search, the id of its point in time (or
+        None, if this is the first page and one must be opened), and the sort
+        values of the last result of the previous page (or None).
+
+        :raises: InvalidCursor if the cursor is malformed or belongs to a
+            different search.
+        """
+        fingerprint = self._search_fingerprint(search)
+        if not cursor:
+            return fingerprint, None, None
+        pit_id, after, cursor_fingerprint = self._decode_cursor(cursor)
+        if cursor_fingerprint != fingerprint:
+            raise InvalidCursor("The cursor belongs to a different search")
+        return fingerprint, pit_id, after
+
+    def _page_search(self, search, pit_id, after, count):
+        """Build the search for a page of results within a point in time."""
+        # The point in time determines which indices are searched
+        search = search.index().extra(
+            pit={"id": pit_id, "keep_alive": self.CURSOR_KEEP_ALIVE}, size=count
+        )
+        if after is not None:
+            search = search.extra(search_after=after)
+        return search
+
+    def _finish_page(self, response, fingerprint, pit_id, count):
+        """
+        Get the results of a page from the raw response, and the next cursor.
+
+        Also returns the id of the point in time, which can change between
+        requests and should be closed if there is no next page.
+        """
+        pit_id = response.get("pit_id", pit_id)
+        hits = response["hits"]["hits"]
+        results = [self._format_hit(hit.get("_source", {}), hit["sort"]) for hit in hits]
+        if len(hits) < count:
+            return results, None, pit_id
+        return results, self._encode_cursor(pit_id, hits[-1]["sort"], fingerprint), pit_id
+
+    def _run_page(self, search, count=None, cursor=None):
+        """
+        Get a page of the results of a search, and a cursor for the next one.
+
+        The first page opens a point in time in ES, which keeps the view of the
+        data fixed (even if it is changed by an ingest) for all later pages of
+        the same search. Each cursor records this, along with the sort values of
+        the last result returned so far. Since the sort always ends with the
+        entry id, these identify exactly where the next page starts, and ES can
+        find it as quickly as the first one. The cursor is None once there are
+        no more results.
+
+        :raises: InvalidCursor if the cursor is malformed, belongs to a different
+            search, or has expired.
+        """
+        count = count or self.CURSOR_PAGE_SIZE
+        fingerprint, pit_id, after = self._start_page(search, cursor)
+        if pit_id is None:
+            pit_id = self.client.open_point_in_time(
+                index=self.index, keep_alive=self.CURSOR_KEEP_ALIVE
+            )["id"]
+        search = self._page_search(search, pit_id, after, count)
+        try:
+            response = self.client.search(body=search.to_dict())
+        except NotFoundError as e:
+            raise InvalidCursor("The cursor has expired") from e
+        results, next_cursor, pit_id = self._finish_page(response, fingerprint, pit_id, count)
+        if next_cursor is None:
+            # This was the last page, so the point in time is no longer needed
+            self.client.close_point_in_time(body={"id": pit_id})
+        return results, next_cursor
+
+    def page(self, word=None, cursor=None, count=None, **args):
+        """Get a page of the entries matching a word (or of all entries, if None).
+
+        Returns the results and a cursor to pass back to get the next page (or
+        None if there are no more results). The other arguments are the same as
+        for run and list_all, except for after, which is not needed.
+
+        :raises: InvalidCursor if the cursor cannot be used.
+        """
+        if word is None:
+            search = self._all_search(**args)
+        else:
+            search = self._general_search(word, **args)
+        return self._run_page(search, count, cursor)
 
     def _customise_and_run(self, search, count, after):
         """
         Execute an ES search appropriately, depending on the specified
         customisation.
+
+        In raw mode, the hits are returned as they were decoded from ES.
         """
         if after is not None:
-            search = search.extra(search_after=[after])
+            # This must be the list of sort values of a hit
+            search = search.extra(search_after=after)
             # TODO Should we require count to be given here? Otherwise, the
             # default behaviour below (10 hits) could be surprising.
             if count is not None:  # if not given, we will only retrieve 10 hits
-                search = search.params(size=count)
+                search = search.extra(size=count)
             # ES doesn't allow the scan/scroll API to be used with search_after
+            if self.raw:
+                return self._send(search)["hits"]["hits"]
             results = search.execute().hits
         elif count is not None:
             # If count is specified, only get that many results
+            if self.raw:
+                return self._send(search[0:count])["hits"]["hits"]
             results = search[0:count]
+        elif self.raw:
+            return self._scan(search)
         else:
             # When scanning, we must explicitly ask to preserve sorting order!
             results = search.params(preserve_order=True).scan()
         return results
 
+    def _project(self, search, fields=None, exclude=None):
+        """Restrict the fields of each document returned by a search.
+
+        If a list of fields is given, only those will be returned, and any
+        fields in the exclusion list are removed. (The instances of the entries
+        are not stored with them, so they are never part of the results; they
+        can be retrieved with the instances method instead.)
+        """
+        search = search.source(includes=fields or None, excludes=exclude or None)
+        # All searches for entries come through here, so they are profiled here
+        return search.extra(profile=True) if self.profile else search
+
+    def _sort_fields(self, field, direction):
+        """Build the full list of sort arguments for a search.
+
+        Entries are sorted by how often they appear in the corpus first, then
+        by the requested field, and finally by their id so that the order of
+        entries which are otherwise equal is well-defined (this is needed for
+        paging through the results with "after").
+        """
+        return [
+            self.POPULARITY_SORT,
+            self._sort_field_name(field, direction),
+            self.TIE_BREAKER,
+        ]
+
     def _sort_field_name(self, field, direction):
         """Build the argument to sort based on a field name and a direction."""
         return "{}{}{}".format(
@@ -155,14 +408,8 @@ class ESearch:
             else (".keyword" if field in self.TEXT_FIELDS else ""),
         )
 
-    def suggest(self, word, size):
-        """Get search suggestions matching a given word.
-
-        This will return terms found in the indexed data which are close to the
-        query word. This is useful for correcting misspellings.
-        Note that this does not return the query word itself, even if it is
-        found in the data.
-        """
+    def _suggest_search(self, word, size):
+        """Build the search for suggestions of terms close to a word."""
         search = Search(using=self.client, index=self.index)
         # Use one term suggester per searchable field, as we can't have multiple
         # fields in each suggester
@@ -179,7 +426,13 @@ class ESearch:
                     "size": size,
                 },
             )
-        suggestion_results = search.execute().suggest.to_dict().values()
+        return search
+
+    def _sorted_suggestions(self, suggest_results):
+        """Extract the suggested terms from the suggest section of a response."""
+        suggestion_results = [
+            suggest_results["sug_{}".format(field_name)] for field_name in self.FIELDNAMES
+        ]
         sorted_suggestions = sorted(
             suggestion_results,
             key=lambda x: (
@@ -201,16 +454,25 @@ class ESearch:
         # Remove duplicate results (use a dictionary vs a set to preserve order)
         return list(dict.fromkeys(all_suggestions))
 
-    def complete(self, word, size):
-        """Get completions for a given word.
+    @cached
+    def suggest(self, word, size):
+        """Get search suggestions matching a given word.
 
-        This will return terms and guidewords found in the indexed data which are completions
-        of the query. This is useful for finding a range of results from limited input.
-        Note that this does not return the query itself, even if it is
+        This will return terms found in the indexed data which are close to the
+        query word. This is useful for correcting misspellings.
+        Note that this does not return the query word itself, even if it is
         found in the data.
         """
-        search = Search(using=self.client, index=self.index)
-        search = search.suggest(
+        search = self._suggest_search(word, size)
+        return self._sorted_suggestions(self._response_suggestions(self._response(search)))
+
+    def _complete_search(self, word, size):
+        """Build the search for completions of a word."""
+        # Only the number of instances is needed from each suggested document
+        search = Search(using=self.client, index=self.index).source(
+            ["instances_count"]
+        )
+        return search.suggest(
             "sug_complete",
             word,
             completion={
@@ -219,17 +481,173 @@ class ESearch:
                 "size": size,
             },
         )
-        completion_results = search.execute().suggest.to_dict()["sug_complete"]
+
+    def _sorted_completions(self, suggest_results):
+        """Extract the completed terms from the suggest section of a response."""
+        completion_results = suggest_results["sug_complete"]
 
         sorted_results = sorted(
             completion_results[0]["options"],
             key=lambda x: (
                 x["_score"],
                 len(x["text"]),
-                -len(x["_source"].get("instances", [])),
+                -x["_source"].get("instances_count", 0),
             ),
         )
 
         all_completions = [option["text"] for option in sorted_results]
 
         return all_completions
+
+    @cached
+    def complete(self, word, size):
+        """Get completions for a given word.
+
+        This will return terms and guidewords found in the indexed data which are completions
+        of the query. This is useful for finding a range of results from limited input.
+        Note that this does not return the query itself, even if it is
+        found in the data.
+        """
+        search = self._complete_search(word, size)
+        return self._sorted_completions(self._response_suggestions(self._response(search)))
+
+    def _batch_search(self, operation):
+        """Prepare a single operation of a batch.
+
+        Returns the search to run, and a function to extract the results of the
+        operation from the corresponding response.
+        """
+        kind, word = operation["type"], operation["word"]
+        size = operation.get("count", self.BATCH_DEFAULT_SIZES.get(kind))
+        if kind == "search":
+            options = {
+                option: operation[option]
+                for option in self.BATCH_SEARCH_OPTIONS
+                if option in operation
+            }
+            search = self._general_search(word, **options)
+            after = operation.get("after")
+            if after is not None:
+                search = search.extra(search_after=after)
+            # Scanning is not possible in a multi-search, so there is always a
+            # limit on the number of results
+            return search[0:size], self._response_results
+        elif kind == "completion":
+            return (
+                self._complete_search(word, size),
+                lambda response: self._sorted_completions(self._response_suggestions(response)),
+            )
+        elif kind == "suggest":
+            return (
+                self._suggest_search(word, size),
+                lambda response: self._sorted_suggestions(self._response_suggestions(response)),
+            )
+        raise ValueError("Unknown operation type: {}".format(kind))
+
+    def batch(self, operations):
+        """Run several operations with a single request to ES.
+
+        Each operation is a dictionary with its "type" (one of "search",
+        "completion" or "suggest"), the "word" to look for, and optionally the
+        maximum number of results ("count") and, for searches, the same options
+        as for run. The results of the operations are returned in order.
+        """
+        multi_search = MultiSearch(using=self.client, index=self.index)
+        processors = []
+        for operation in operations:
+            search, process = self._batch_search(operation)
+            multi_search = multi_search.add(search)
+            processors.append(process)
+        if not processors:
+            return []
+        if self.raw:
+            responses = self._send_multi(multi_search)
+        else:
+            responses = multi_search.execute()
+        return [process(response) for process, response in zip(processors, responses)]
+
+    def _send_multi(self, multi_search):
+        """
+        Send a multi-search through the low-level client, returning the raw
+        response to each search.
+
+        :raises: TransportError if any of the searches failed, like
+            MultiSearch.execute does.
+        """
+        responses = self.client.msearch(index=self.index, body=multi_search.to_dict())
+        for response in responses["responses"]:
+            if response.get("error"):
+                raise TransportError("N/A", response["error"]["type"], response["error"])
+        return responses["responses"]
+
+    @cached
+    def suggest_all(self, word, completion_size, suggestion_size):
+        """Get both completions and suggestions for a word, in one request."""
+        return self.batch(
+            [
+                {"type": "completion", "word": word, "count": completion_size},
+                {"type": "suggest", "word": word, "count": suggestion_size},
+            ]
+        )
+
+    def _instances_search(self, entry_id, after, count):
+        """Build the search for the chunks holding a range of an entry's instances."""
+        first, last = after, after + count  # the positions to return: [first, last)
+        search = (
+            Search(using=self.client, index=self.instances_index)
+            .filter("term", entry_id=entry_id)
+            .filter("range", start={"lt": last})
+            .filter("range", end={"gt": first})
+            .sort("start")
+        )
+        # All chunks but the last are full, so the requested positions can
+        # only be spread over this many chunks (one more than it takes to
+        # hold them, if they don't start at the beginning of a chunk)
+        return search.extra(size=-(-count // self.INSTANCES_CHUNK_SIZE) + 1)
+
+    def _instances_total_search(self, entry_id):
+        """Build the search for the total number of instances of an entry."""
+        search = Search(using=self.client, index=self.instances_index).filter(
+            "term", entry_id=entry_id
+        )
+        return search.source(["total"]).extra(size=1)
+
+    @staticmethod
+    def _instances_page(entry_id, chunks, after, count):
+        """Extract the requested range of instances from the chunks holding it."""
+        first, last = after, after + count
+        instances = []
+        for chunk in chunks:
+            instances.extend(
+                chunk["instances"][max(first - chunk["start"], 0):last - chunk["start"]]
+            )
+        total = chunks[0]["total"]
+        next_position = first + len(instances)
+        return {
+            "id": entry_id,
+            "total": total,
+            "instances": instances,
+            # Where the next page starts (if there is one)
+            "next": next_position if next_position < total else None,
+        }
+
+    def instances(self, entry_id, after=0, count=100):
+        """Get a page of the instances of an entry.
+
+        The instances are stored in chunks, so this finds the chunks overlapping
+        the requested positions and extracts the relevant part of each. Returns
+        None if the entry does not exist.
+        """
+        search = self._instances_search(entry_id, after, count)
+        chunks = self._response_sources(self._response(search, self.instances_index))
+        if not chunks:
+            # Even entries without any instances have a (single, empty) chunk,
+            # so this can only happen if the entry doesn't exist, or if the
+            # requested positions are beyond the end of the list.
+            existing = self._response_sources(
+                self._response(self._instances_total_search(entry_id), self.instances_index)
+            )
+            if not existing:
+                return None
+            return {"id": entry_id, "total": existing[0]["total"], "instances": [], "next": None}
+        return self._instances_page(entry_id, chunks, after, count)
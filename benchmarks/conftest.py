@@ -0,0 +1,96 @@
+import glob
+import json
+
+import pytest
+
+from api.search import ESearch
+from ingest.break_down import process_glossary_data
+from synthesize import synthesize
+
+SAMPLE_GLOSSARIES = sorted(glob.glob("ingest/assets/dev/sample-glossaries/*.json"))
+RESPONSE_SIZE = 1000  # how many hits to put in a simulated search response
+SYNTHETIC_SCALE = 10  # how much larger than the samples the synthetic glossaries are
+
+
+@pytest.fixture(scope="session")
+def glossaries():
+    """The sample glossaries, as dictionaries."""
+    data = {}
+    for filename in SAMPLE_GLOSSARIES:
+        with open(filename, "r") as infile:
+            data[filename] = json.load(infile)
+    return data
+
+
+@pytest.fixture(scope="session")
+def synthetic_glossaries(tmp_path_factory):
+    """Glossaries generated from the samples, but larger."""
+    return synthesize(SAMPLE_GLOSSARIES, SYNTHETIC_SCALE, str(tmp_path_factory.mktemp("synthetic")))
+
+
+@pytest.fixture(scope="session")
+def sample_entries(glossaries):
+    """The processed entries of all sample glossaries."""
+    return [
+        entry for glossary in glossaries.values() for entry in process_glossary_data(glossary)
+    ]
+
+
+@pytest.fixture(scope="session")
+def search():
+    """An ESearch which is never actually connected to ES."""
+    return ESearch(client=object())
+
+
+@pytest.fixture(scope="session")
+def search_response(sample_entries):
+    """A raw ES response to a search, built by repeating the sample entries."""
+    hits = []
+    for n in range(RESPONSE_SIZE):
+        entry = sample_entries[n % len(sample_entries)]
+        source = {key: value for key, value in entry.items() if key != "instances"}
+        hits.append(
+            {
+                "_index": "oracc",
+                "_id": entry["id"],
+                "_score": None,
+                "_source": source,
+                "sort": [entry["instances_count"], entry["gw"], entry["id"]],
+            }
+        )
+    return {"took": 1, "timed_out": False, "hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+
+@pytest.fixture(scope="session")
+def suggest_response(sample_entries):
+    """The suggest section of a raw ES response with term suggestions."""
+    suggest = {}
+    for field in ESearch.FIELDNAMES:
+        options = []
+        for n, entry in enumerate(sample_entries):
+            values = entry[field] if isinstance(entry[field], list) else [entry[field]]
+            for value in values:
+                options.append(
+                    {"text": value, "score": 0.5 + (n % 5) / 10, "freq": n % 7 + 1}
+                )
+        suggest["sug_{}".format(field)] = [
+            {"text": "god", "offset": 0, "length": 3, "options": options[:100]}
+        ]
+    return suggest
+
+
+@pytest.fixture(scope="session")
+def completion_response(sample_entries):
+    """The suggest section of a raw ES response with completions."""
+    options = [
+        {
+            "text": entry[field],
+            "_index": "oracc",
+            "_id": entry["id"],
+            "_score": 1.0,
+            "_source": {"instances_count": entry["instances_count"]},
+        }
+        for entry in sample_entries
+        for field in ["cf", "gw"]
+    ]
+    return {"sug_complete": [{"text": "a", "offset": 0, "length": 1, "options": options}]}
@@ -0,0 +1,273 @@
+"""Generate large synthetic glossaries, to test how the ingest copes with scale.
+
+The glossaries are modelled on the sample glossaries: each synthetic entry is
+a copy of a randomly chosen sample entry in the same language, with its forms,
+norms and senses resampled so that their numbers follow those of all sample
+entries. The number of instances of each entry is drawn from a power law (as
+word frequencies follow Zipf's law), and split between its forms, senses etc.,
+so that the counts and references are consistent throughout the glossary. The
+glossaries are written gradually, so even very large ones can be generated.
+
+To make glossaries 100 times the size of the samples:
+
+    python benchmarks/synthesize.py --scale 100
+"""
+import argparse
+import collections
+import copy
+import glob
+import json
+import os
+import random
+
+SAMPLE_GLOSSARIES = "ingest/assets/dev/sample-glossaries/*.json"
+RESAMPLED_FIELDS = ["forms", "norms", "senses"]  # whose lengths vary between entries
+SUBSCRIPTS = "₀₁₂₃₄₅₆₇₈₉"
+
+
+def subscript(number):
+    """Write a number in subscript digits, as in sign names like "a₂"."""
+    return "".join(SUBSCRIPTS[int(digit)] for digit in str(number))
+
+
+def split(total, parts, rng):
+    """Split a number of instances randomly between parts, giving each at least one."""
+    weights = [rng.random() for _ in range(parts)]
+    scale = (total - parts) / sum(weights)
+    counts = [1 + int(weight * scale) for weight in weights]
+    # Hand out whatever is left after rounding down
+    for _ in range(total - sum(counts)):
+        counts[rng.randrange(parts)] += 1
+    return counts
+
+
+def field_lengths(samples):
+    """Find how many forms, norms and senses the entries of the samples have."""
+    lengths = {field: [] for field in RESAMPLED_FIELDS}
+    for sample in samples:
+        for entry in sample["entries"]:
+            for field in RESAMPLED_FIELDS:
+                if entry.get(field):
+                    lengths[field].append(len(entry[field]))
+    return lengths
+
+
+def nodes(node):
+    """Go through a part of an entry and all the dictionaries nested in it."""
+    yield node
+    for value in node.values():
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    yield from nodes(item)
+
+
+class GlossarySynthesizer:
+    """Make a synthetic glossary out of the entries of a sample glossary."""
+
+    def __init__(self, sample, lengths, rng, exponent=1.0, max_instances=50000):
+        """
+        :param sample: the sample glossary, as a dictionary
+        :param lengths: the numbers of forms, norms and senses to choose from
+        :param rng: a random.Random to draw everything from
+        :param exponent: the exponent of the power law for the instance counts
+            (smaller values give more entries with many instances)
+        :param max_instances: the most instances that an entry can have
+        """
+        self.sample = sample
+        self.lengths = lengths
+        self.rng = rng
+        self.exponent = exponent
+        self.max_instances = max_instances
+        self.lang = sample["lang"]
+        # The texts that the instances of the sample are found in
+        self.corpora = sorted(
+            {ref.split(":")[0] for refs in sample["instances"].values() for ref in refs}
+        )
+        self.copies = collections.Counter()  # how many times each entry was used
+        self.references = []  # the instance reference and count for each "xis"
+        self.summaries = []  # the new and sample ids of each entry
+
+    def _variant(self, item, number):
+        """Make a new copy of a form, norm or sense, different from the others."""
+        item = copy.deepcopy(item)
+        if number:
+            if "mng" in item:
+                item["mng"] = "{} {}".format(item["mng"], number + 1)
+            elif "n" in item:
+                item["n"] += subscript(number + 1)
+        return item
+
+    def _assign(self, node, total, parent_total):
+        """Give a part of an entry (and everything in it) a number of instances."""
+        node["icount"] = str(total)
+        node["ipct"] = str(round(100 * total / parent_total))
+        node["xis"] = "{}.r{:06x}".format(self.lang, len(self.references))
+        self.references.append((node["xis"], total))
+        for value in node.values():
+            if isinstance(value, list) and value and "icount" in value[0]:
+                del value[total:]  # each part must appear at least once
+                for item, count in zip(value, split(total, len(value), self.rng)):
+                    self._assign(item, count, total)
+
+    def entry(self, number):
+        """Make the synthetic entry with the given number."""
+        sample_entry = self.rng.choice(self.sample["entries"])
+        entry = copy.deepcopy(sample_entry)
+        copy_number = self.copies[sample_entry["id"]]
+        self.copies[sample_entry["id"]] += 1
+        if copy_number:
+            entry["gw"] = "{} {}".format(entry["gw"], copy_number + 1)
+            entry["headword"] = "{}[{}]{}".format(entry["cf"], entry["gw"], entry["pos"])
+            entry["dc_title"] = "{}/{}/{}[{}]".format(
+                self.sample["project"], self.lang, entry["cf"], entry["gw"]
+            )
+        for field in RESAMPLED_FIELDS:
+            items = entry.get(field)
+            if items:
+                entry[field] = [
+                    self._variant(items[n % len(items)], n // len(items))
+                    for n in range(self.rng.choice(self.lengths[field]))
+                ]
+        # Give everything new ids, keeping the references between them
+        entry_id = "s{}{:08d}".format(self.lang, number)
+        new_ids = {}
+        for n, node in enumerate(nodes(entry)):
+            for key in ["id", "cbd_id"]:
+                if key in node:
+                    # Copies of the same form keep the first one's references
+                    new_id = "{}.{}".format(entry_id, n) if n else entry_id
+                    new_ids.setdefault(node[key], new_id)
+                    node[key] = new_id
+        for node in nodes(entry):
+            if "ref" in node:
+                node["ref"] = new_ids.get(node["ref"], node["ref"])
+        count = min(int(self.rng.paretovariate(self.exponent)), self.max_instances)
+        self._assign(entry, count, count)
+        self.summaries.append((entry_id, sample_entry["id"]))
+        return entry
+
+    def instances(self, count):
+        """Make up references to the places in the texts where a word appears."""
+        return [
+            "{}:P{:06d}.{}.{}".format(
+                self.rng.choice(self.corpora),
+                self.rng.randrange(1000000),
+                self.rng.randrange(1, 200),
+                self.rng.randrange(1, 20),
+            )
+            for _ in range(count)
+        ]
+
+    def write(self, outfile, entry_count):
+        """Write a glossary with the given number of entries to a file."""
+        sample_summaries = self.sample.get("summaries", {})
+        outfile.write("{")
+        for key, value in self.sample.items():
+            if key not in ["entries", "instances", "summaries"]:
+                outfile.write("{}: {}, ".format(json.dumps(key), json.dumps(value)))
+        outfile.write('"entries": [')
+        for number in range(entry_count):
+            if number:
+                outfile.write(", ")
+            json.dump(self.entry(number), outfile)
+        outfile.write('], "instances": {')
+        for n, (reference, count) in enumerate(self.references):
+            if n:
+                outfile.write(", ")
+            outfile.write("{}: {}".format(json.dumps(reference), json.dumps(self.instances(count))))
+        outfile.write('}, "summaries": {')
+        first = True
+        for entry_id, sample_id in self.summaries:
+            if sample_id in sample_summaries:
+                summary = sample_summaries[sample_id].replace(sample_id, entry_id)
+                outfile.write("{}{}: {}".format("" if first else ", ", json.dumps(entry_id),
+                                                json.dumps(summary)))
+                first = False
+        outfile.write("}}\n")
+
+
+def synthesize(filenames, scale, output_dir, seed=0, exponent=1.0, max_instances=50000):
+    """
+    Write a synthetic glossary for each sample glossary, scaled up.
+
+    :param filenames: the sample glossaries to model the new ones on
+    :param scale: how many times more entries the new glossaries should have
+    :param output_dir: the folder to write the new glossaries in
+    :param seed: the seed for the random choices, so the output can be reproduced
+    :param exponent: the exponent of the power law for the instance counts
+    :param max_instances: the most instances that an entry can have
+    :return: the names of the new glossary files
+    """
+    samples = []
+    for filename in filenames:
+        with open(filename, "r") as infile:
+            samples.append(json.load(infile))
+    lengths = field_lengths(samples)
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    output_names = []
+    for sample in samples:
+        output_name = os.path.join(
+            output_dir, "synthetic-{}-x{}.json".format(sample["lang"], scale)
+        )
+        synthesizer = GlossarySynthesizer(sample, lengths, rng, exponent, max_instances)
+        with open(output_name, "w") as outfile:
+            synthesizer.write(outfile, scale * len(sample["entries"]))
+        output_names.append(output_name)
+    return output_names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog=__file__,
+        description="Generate large glossaries modelled on the sample glossaries"
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=10,
+        help="How many times more entries to generate than the samples have (default 10)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default="synthetic-glossaries",
+        help="Where to write the glossaries (default synthetic-glossaries)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the random choices, to generate the same glossaries again (default 0)",
+    )
+    parser.add_argument(
+        "--exponent",
+        type=float,
+        default=1.0,
+        help="Exponent of the power law for the number of instances of each entry; "
+        "smaller values give more common words (default 1.0)",
+    )
+    parser.add_argument(
+        "--max-instances",
+        type=int,
+        default=50000,
+        help="The most instances that an entry can have (default 50000)",
+    )
+    parser.add_argument(
+        "filenames",
+        type=str,
+        nargs="*",
+        help="Sample glossaries to model the new ones on (default: all sample glossaries)",
+    )
+    args = parser.parse_args()
+
+    for name in synthesize(
+        args.filenames or sorted(glob.glob(SAMPLE_GLOSSARIES)),
+        args.scale,
+        args.output_dir,
+        args.seed,
+        args.exponent,
+        args.max_instances,
+    ):
+        print("Wrote {} ({:.1f} MB)".format(name, os.path.getsize(name) / 1e6))
@@ -0,0 +1,44 @@
+import glob
+
+import pytest
+
+from ingest.break_down import (
+    direct_fields,
+    indirect_fields,
+    interpret_entry,
+    process_entry,
+    process_file,
+    process_glossary_data,
+)
+
+
+def test_process_entry(benchmark, glossaries):
+    """Flatten every entry of the sample glossaries."""
+    entries = [entry for glossary in glossaries.values() for entry in glossary["entries"]]
+    benchmark(lambda: [process_entry(entry) for entry in entries])
+
+
+def test_interpret_entry(benchmark, glossaries):
+    """Flatten every entry without compiling the field specs, for comparison."""
+    entries = [entry for glossary in glossaries.values() for entry in glossary["entries"]]
+    benchmark(
+        lambda: [interpret_entry(entry, direct_fields, indirect_fields) for entry in entries]
+    )
+
+
+def test_process_glossary_data(benchmark, glossaries):
+    """Process the sample glossaries, once they are loaded."""
+    benchmark(lambda: [process_glossary_data(glossary) for glossary in glossaries.values()])
+
+
+@pytest.mark.parametrize(
+    "filename", sorted(glob.glob("ingest/assets/dev/sample-glossaries/*.json"))
+)
+def test_process_file(benchmark, filename):
+    """Read and process a sample glossary file."""
+    benchmark(process_file, filename, write_file=False)
+
+
+def test_process_synthetic_files(benchmark, synthetic_glossaries):
+    """Read and process glossaries much larger than the samples."""
+    benchmark(lambda: [process_file(name, write_file=False) for name in synthetic_glossaries])
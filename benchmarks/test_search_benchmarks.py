@@ -0,0 +1,72 @@
+import tracemalloc
+
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+import pytest
+
+from api.encoding import ENCODERS
+from api.search import ESearch
+
+
+def peak_allocation(function, *args):
+    """Measure the most memory allocated at once while calling a function."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_get_results(benchmark, search, search_response):
+    """Extract the results from the hits of a search response."""
+    hits = Response(Search(), search_response).hits
+    benchmark(search._get_results, hits)
+
+
+@pytest.mark.parametrize("raw", [True, False], ids=["raw", "dsl"])
+def test_process_search_response(benchmark, search_response, raw):
+    """Get the results from a decoded search response, with or without elasticsearch_dsl."""
+    search = ESearch(client=object(), raw=raw)
+
+    def process():
+        if raw:
+            return search._response_results(search_response)
+        return search._response_results(Response(Search(), search_response))
+
+    benchmark.extra_info["peak_bytes"] = peak_allocation(process)
+    benchmark(process)
+
+
+@pytest.mark.parametrize("raw", [True, False], ids=["raw", "dsl"])
+def test_process_completion_response(benchmark, completion_response, raw):
+    """Get the completions from a decoded response, with or without elasticsearch_dsl."""
+    search = ESearch(client=object(), raw=raw)
+    response = {"suggest": completion_response}
+
+    def process():
+        if raw:
+            return search._sorted_completions(search._response_suggestions(response))
+        return search._sorted_completions(
+            search._response_suggestions(Response(Search(), response))
+        )
+
+    benchmark.extra_info["peak_bytes"] = peak_allocation(process)
+    benchmark(process)
+
+
+def test_sorted_suggestions(benchmark, search, suggest_response):
+    """Sort and deduplicate term suggestions from all searchable fields."""
+    benchmark(search._sorted_suggestions, suggest_response)
+
+
+def test_sorted_completions(benchmark, search, completion_response):
+    """Sort completions by score, length and popularity."""
+    benchmark(search._sorted_completions, completion_response)
+
+
+@pytest.mark.parametrize("encoder", sorted(ENCODERS))
+def test_encode_results(benchmark, search, search_response, encoder):
+    """Encode a large list of results as JSON, as in the API's responses."""
+    results = search._get_results(Response(Search(), search_response).hits)
+    benchmark(ENCODERS[encoder], results)
@@ -0,0 +1,24 @@
+"""Settings for running the API with gunicorn.
+
+gunicorn reads this file automatically when it is started from this folder.
+The hooks below keep the metrics in PROMETHEUS_MULTIPROC_DIR (if it is set)
+consistent across the worker processes.
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    """Start from an empty metrics folder, dropping those of any earlier run."""
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    """Stop reporting the live values of a worker which has exited."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
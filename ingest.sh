@@ -11,7 +11,8 @@ cd /home/rits/oracc-rest
 source venv/bin/activate
 
 # Run the ingest script and capture the outcome
-python3 -m ingest.bulk_upload 2>&1 | tee -a "$LOG_FILE"
+# Only glossaries that changed since the last run are re-uploaded
+python3 -m ingest.bulk_upload --incremental 2>&1 | tee -a "$LOG_FILE"
 echo "$(date '+%Y-%m-%d %H:%M:%S') - Ingest process completed" >> "$LOG_FILE"
 
 echo "Ingest complete. See $LOG_FILE for details."
\ No newline at end of file
@@ -0,0 +1,264 @@
+"""Methods for sending bulk requests to ES at a pace the cluster can sustain.
+
+The size of the bulk requests is adjusted as the upload goes on: it grows while
+requests are answered quickly, and shrinks when they are slow or when ES starts
+rejecting documents because it is overloaded (with a 429 status). Rejected
+documents, and whole requests that fail for similar temporary reasons, are
+retried after a randomised, increasing delay. Documents that still cannot be
+indexed can be written to a "dead-letter" file in the format of the bulk API,
+so that they can be uploaded again later, instead of stopping the ingest.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import random
+import threading
+import time
+
+import elasticsearch
+import elasticsearch.helpers
+from elasticsearch.helpers.actions import expand_action
+from elasticsearch.serializer import JSONSerializer
+
+LOGGER = logging.getLogger("adaptive")
+
+# Statuses for which a document (or a whole request) is worth retrying
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class DeadLetterFile:
+    """A file in which to write the bulk actions that could not be applied."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.failed = []  # the (index, id) of each failed document
+        self._file = None
+
+    def write(self, item, lines):
+        """Record a failed action, given its item in the response and its lines."""
+        # Only create the file if something actually fails
+        if self._file is None:
+            self._file = open(self.filename, "a")
+        header, data = lines
+        print(header, file=self._file)
+        if data is not None:
+            print(data, file=self._file)
+        self._file.flush()
+        details = next(iter(item.values()))
+        self.failed.append((details.get("_index"), details.get("_id")))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class AdaptiveBulk:
+    """Send bulk actions to ES, adapting the size of requests to how ES copes."""
+
+    def __init__(self, es, chunk_size=500, max_bytes=100 * 1024 * 1024,
+                 min_chunk_size=10, max_chunk_size=5000, target_seconds=1.0,
+                 max_retries=8, initial_backoff=0.5, max_backoff=60,
+                 dead_letter=None, expand_action_callback=expand_action):
+        """
+        :param es: an Elasticsearch instance to connect to
+        :param chunk_size: how many documents to send in the first request
+        :param max_bytes: the maximum size of each request
+        :param min_chunk_size: the fewest documents to send in each request
+        :param max_chunk_size: the most documents to send in each request
+        :param target_seconds: how long each request should ideally take
+        :param max_retries: how many times to retry rejected documents
+        :param initial_backoff: how long to wait (roughly) before the first retry
+        :param max_backoff: the longest to wait before a retry
+        :param dead_letter: a DeadLetterFile for the documents that fail
+        :param expand_action_callback: a function turning an action into its
+            header and data, as in elasticsearch.helpers
+        """
+        self.es = es
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_seconds = target_seconds
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+        self.expand_action_callback = expand_action_callback
+        self.serializer = JSONSerializer()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _chunks(self, actions):
+        """Group actions into requests of the current chunk size (and max_bytes)."""
+        chunk = []
+        size = 0
+        for action in actions:
+            header, data = self.expand_action_callback(action)
+            lines = (
+                self.serializer.dumps(header),
+                None if data is None else self.serializer.dumps(data),
+            )
+            line_size = sum(len(line.encode("utf-8")) + 1 for line in lines if line is not None)
+            if chunk and (len(chunk) >= self.chunk_size or size + line_size > self.max_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(lines)
+            size += line_size
+        if chunk:
+            yield chunk
+
+    def _adapt(self, seconds, rejected):
+        """Change the chunk size according to how the last request went."""
+        with self._lock:
+            if rejected:
+                new_size = self.chunk_size // 2
+            elif seconds > 1.5 * self.target_seconds:
+                new_size = int(self.chunk_size * self.target_seconds / seconds)
+            elif seconds < 0.5 * self.target_seconds:
+                new_size = int(self.chunk_size * 1.25) + 1
+            else:
+                return
+            new_size = min(max(new_size, self.min_chunk_size), self.max_chunk_size)
+            if new_size != self.chunk_size:
+                LOGGER.debug("Chunk size %s -> %s", self.chunk_size, new_size)
+                self.chunk_size = new_size
+
+    def _backoff(self, attempt):
+        """Wait before a retry, for a random part of an exponentially growing time."""
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+        time.sleep(random.uniform(delay / 2, delay))
+
+    def _count(self, key, number=1):
+        with self._lock:
+            self.counts[key] += number
+
+    def _send(self, chunk):
+        """
+        Send a chunk of actions, retrying any temporary failures.
+
+        :return: a list of (ok, item, lines) for each action in the chunk
+        """
+        results = []
+        attempt = 0
+        while True:
+            body = "".join(
+                line + "\n" for lines in chunk for line in lines if line is not None
+            )
+            start = time.monotonic()
+            self._count("requests")
+            try:
+                response = self.es.bulk(body=body)
+            except elasticsearch.TransportError as e:
+                # A 429 for the whole request, or a timeout, means ES is too busy
+                status = e.status_code if isinstance(e.status_code, int) else None
+                self._adapt(time.monotonic() - start, rejected=True)
+                if (
+                    status in RETRY_STATUSES
+                    or isinstance(e, elasticsearch.ConnectionTimeout)
+                ) and attempt < self.max_retries:
+                    self._count("retried", len(chunk))
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                if status is None:
+                    raise  # ES cannot be reached, so there is no point going on
+                error = {"status": status, "error": str(e)}
+                items = []
+                for header, _ in chunk:
+                    operation, metadata = next(iter(json.loads(header).items()))
+                    items.append({operation: dict(metadata, **error)})
+            else:
+                items = response["items"]
+            retry = []
+            for lines, item in zip(chunk, items):
+                details = next(iter(item.values()))
+                status = details.get("status", 500)
+                if status in RETRY_STATUSES and attempt < self.max_retries:
+                    retry.append(lines)
+                else:
+                    results.append((200 <= status < 300, item, lines))
+            self._adapt(time.monotonic() - start, rejected=bool(retry))
+            if not retry:
+                return results
+            self._count("retried", len(retry))
+            self._backoff(attempt)
+            attempt += 1
+            chunk = retry
+
+    def _finish(self, results, ignore):
+        for ok, item, lines in results:
+            if not ok and ignore is not None and ignore(item):
+                ok = True
+            if not ok:
+                self._count("failed")
+                if self.dead_letter is not None:
+                    self.dead_letter.write(item, lines)
+            yield ok, item
+
+    def run(self, actions, threads=1, ignore=None):
+        """
+        Send actions to ES, yielding (ok, item) for each once it has been applied.
+
+        :param actions: the bulk actions to apply
+        :param threads: how many requests to send at once
+        :param ignore: a function taking the item for a failed action, and
+            returning whether the failure can be ignored
+        """
+        chunks = self._chunks(actions)
+        if threads <= 1:
+            for chunk in chunks:
+                yield from self._finish(self._send(chunk), ignore)
+            return
+        # Keep a few requests waiting for each thread, but not too many, so that
+        # the actions are not all read into memory if ES cannot keep up
+        with ThreadPoolExecutor(threads) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(self._send, chunk))
+                if len(pending) >= 2 * threads:
+                    yield from self._finish(pending.popleft().result(), ignore)
+            while pending:
+                yield from self._finish(pending.popleft().result(), ignore)
+
+
+def bulk_apply(es, actions, dead_letter=None, threads=1, ignore=None, **options):
+    """
+    Apply bulk actions adaptively, returning how many were applied and which failed.
+
+    :param es: an Elasticsearch instance to connect to
+    :param actions: the bulk actions to apply
+    :param dead_letter: a DeadLetterFile for the actions that fail
+    :param threads: how many requests to send at once
+    :param ignore: a function deciding whether a failed action can be ignored
+    :param options: any other options for AdaptiveBulk
+    :return: the number of applied actions, and the items of those that failed
+    :raises: elasticsearch.helpers.BulkIndexError if any action fails and
+        there is no dead-letter file to record it in.
+    """
+    bulk = AdaptiveBulk(es, dead_letter=dead_letter, **options)
+    applied = 0
+    errors = []
+    for ok, item in bulk.run(actions, threads, ignore):
+        if ok:
+            applied += 1
+        else:
+            errors.append(item)
+    LOGGER.info(
+        "Applied %s actions in %s requests (%s retried, %s failed)",
+        applied,
+        bulk.counts["requests"],
+        bulk.counts["retried"],
+        bulk.counts["failed"],
+    )
+    if errors:
+        if dead_letter is None:
+            raise elasticsearch.helpers.BulkIndexError(
+                "{} document(s) failed to update.".format(len(errors)), errors
+            )
+        LOGGER.warning(
+            "%s document(s) could not be updated, see %s", len(errors), dead_letter.filename
+        )
+    return applied, errors
@@ -0,0 +1,108 @@
+"""Methods for recording an ingest in a compact file, which can be replayed later.
+
+An artifact is a gzip-compressed NDJSON file containing the bulk actions for all
+the documents uploaded by a full ingest, i.e. the entries (with their ids and
+completions) and the chunks of their instances, exactly as they were sent to
+ES. It starts with a line describing the artifact, and ends with the manifest
+of the ingest. Replaying an artifact uploads the same documents into new
+indices without reading and flattening the glossaries again: the documents are
+sent as they are, and only the short lines naming their index are rewritten.
+"""
+import gzip
+import json
+import os
+
+from elasticsearch.helpers.actions import expand_action
+
+from .incremental import Manifest
+from .prepare_index import instances_index_name
+
+FORMAT_VERSION = 1
+
+
+def serialise_action(action, serializer):
+    """Turn an action into the (already serialised) lines of a bulk request."""
+    header, data = expand_action(action)
+    return serializer.dumps(header), serializer.dumps(data)
+
+
+class ArtifactWriter:
+    """Record the bulk actions of an ingest as they are uploaded."""
+
+    def __init__(self, filename, compresslevel=6):
+        """
+        :param filename: the name of the artifact file to write
+        :param compresslevel: the gzip compression level (from 1 to 9)
+        """
+        self.filename = filename
+        self.compresslevel = compresslevel
+        self._file = None
+
+    def start(self, index_name):
+        """Start a new artifact, for documents uploaded to the given index."""
+        # Only replace the previous artifact once the new one is complete
+        self._file = gzip.open(
+            self.filename + ".tmp", "wt", encoding="utf-8", compresslevel=self.compresslevel
+        )
+        print(json.dumps({"artifact": FORMAT_VERSION, "index": index_name}), file=self._file)
+
+    def record(self, lines):
+        """Write the serialised lines of bulk actions, passing them on unchanged."""
+        for header, data in lines:
+            self._file.write(header + "\n" + data + "\n")
+            yield header, data
+
+    def close(self, manifest):
+        """Finish the artifact with the manifest of the ingest."""
+        print(json.dumps({"manifest": manifest.to_dict()}), file=self._file)
+        self._file.close()
+        self._file = None
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def discard(self):
+        """Give up on the artifact, leaving any previous one in place."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.filename + ".tmp")
+
+
+class ArtifactReader:
+    """Read back the bulk actions recorded in an artifact."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entry_ids = set()  # the ids of the entries read so far
+        self.manifest = None  # the manifest, once the whole artifact is read
+
+    def actions(self, index_name):
+        """
+        Read the serialised lines of the bulk actions, for uploading to an index.
+
+        :param index_name: the index to upload the entries to (their instances
+            go to the corresponding instances index)
+        :return: a generator of the header and data lines of each action
+        :raises: ValueError if the file is not a complete artifact.
+        """
+        with gzip.open(self.filename, "rt", encoding="utf-8") as infile:
+            description = json.loads(next(infile, "{}"))
+            if description.get("artifact") != FORMAT_VERSION:
+                raise ValueError("{} is not an ingest artifact".format(self.filename))
+            old_name = description["index"]
+            new_names = {
+                old_name: index_name,
+                instances_index_name(old_name): instances_index_name(index_name),
+            }
+            for line in infile:
+                header = json.loads(line)
+                if "manifest" in header:
+                    manifest = Manifest.from_dict(header["manifest"])
+                    manifest.index_name = index_name
+                    self.manifest = manifest
+                    return
+                metadata = next(iter(header.values()))
+                metadata["_index"] = new_names[metadata["_index"]]
+                if metadata["_index"] == index_name:
+                    self.entry_ids.add(metadata["_id"])
+                yield json.dumps(header), next(infile).rstrip("\n")
+        raise ValueError("{} is incomplete".format(self.filename))
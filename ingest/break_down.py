@@ -1,25 +1,28 @@
 """A module for breaking down a glossary into individual entries."""
 import json
 import os
-import subprocess
 import sys
 import warnings
 
+from .json_stream import JSONStream
 
-# By default, we treat most glossary data as strings, but sometimes we want the
-# REST API to return a different type (for instance, counts should be integers).
-# The below sequences refer to fields in two ways: a field name just by itself
-# indicates that the field should be indexed as a string; alternatively, if the
-# name is accompanied by a type [e.g. ("icount", int)], that means that its
-# values should be converted to the given type.
-base_fields = ["project", "lang"]  # fields to copy into each entry
-direct_fields = ["gw", "headword", "cf", ("icount", int), "id"]
-indirect_fields = {
-    "senses": ["mng"],
-    "forms": ["n"],
-    "norms": ["n"],
-    "periods": ["p"]
-}
+
+# The fields to extract from each entry are described in a JSON file (by default
+# fields.json, next to this module), so that more fields can be added without
+# changing the code. By default, we treat most glossary data as strings, but
+# sometimes we want the REST API to return a different type (for instance,
+# counts should be integers). The field specs in the file refer to fields in
+# two ways: a field name just by itself indicates that the field should be
+# indexed as a string; alternatively, if the name is accompanied by the name of
+# a type [e.g. ["icount", "int"]], that means that its values should be
+# converted to the given type. The file has three sections:
+# - base_fields: fields of the glossary to copy into each entry
+# - direct_fields: fields of the entry to copy as they are
+# - indirect_fields: for each field with a list of nested items (e.g. "senses"),
+#   the fields of the items to collect into a list. These are named after both
+#   fields, e.g. the "mng" of each sense goes in "senses_mng".
+FIELDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fields.json")
+TYPES = {"str": str, "int": int, "float": float}
 
 
 def name_and_type(field_spec):
@@ -34,8 +37,38 @@ def name_and_type(field_spec):
         return field_spec[0], field_spec[1]
 
 
-def process_entry(entry):
-    """Flatten the nested fields of an entry."""
+def load_fields(filename=FIELDS_FILE):
+    """
+    Read the specs of the fields to extract from the entries from a JSON file.
+
+    :param filename: the name of the file describing the fields
+    :return: the base fields, direct fields and indirect fields, with the type
+        of each field (where given) as a Python type rather than a name
+    :raises: ValueError if a field has an unknown type.
+    """
+    with open(filename, "r") as infile:
+        spec = json.load(infile)
+
+    def parse(field_spec):
+        if isinstance(field_spec, str):
+            return field_spec
+        name, type_name = field_spec
+        if type_name not in TYPES:
+            raise ValueError("Unknown type {} for field {}".format(type_name, name))
+        return name, TYPES[type_name]
+
+    return (
+        list(spec.get("base_fields", [])),
+        [parse(field) for field in spec.get("direct_fields", [])],
+        {
+            outer: [parse(inner) for inner in inner_fields]
+            for outer, inner_fields in spec.get("indirect_fields", {}).items()
+        },
+    )
+
+
+def interpret_entry(entry, direct_fields, indirect_fields):
+    """Flatten the nested fields of an entry, following the given field specs."""
     new_entry = {}
     for field in direct_fields:
         field_name, to_type = name_and_type(field)
@@ -49,63 +82,201 @@ def process_entry(entry):
                         for inner_entry
                         in entry.get(top_field, [])  # in case field is missing
             ]
-    # TODO Consider making this a generator (if too slow for bigger files)?
     return new_entry
 
 
-def process_glossary_data(data):
+def compile_flattener(direct_fields, indirect_fields):
     """
-    Process a glossary and link the entries to their instances.
+    Turn field specs into a function which flattens an entry accordingly.
+
+    The function gives the same results as interpret_entry, but since it is
+    generated specifically for the given fields, it does not have to work out
+    their names and types again for every entry, which adds up over millions
+    of entries.
+    """
+    namespace = {}
+    names = {}
+    items = []
+
+    def convert(expression, to_type):
+        # Make the type available to the generated code under a safe name
+        if to_type not in names:
+            names[to_type] = "_type{}".format(len(names))
+            namespace[names[to_type]] = to_type
+        if to_type is str:
+            # Glossary values are almost always strings already, and checking
+            # for that is much quicker than calling str on them
+            return "(value if (value := {}).__class__ is {} else {}(value))".format(
+                expression, names[str], names[str]
+            )
+        return "{}({})".format(names[to_type], expression)
+
+    for field in direct_fields:
+        field_name, to_type = name_and_type(field)
+        items.append(
+            "{!r}: {}".format(field_name, convert("entry[{!r}]".format(field_name), to_type))
+        )
+    for top_field, inner_fields in indirect_fields.items():
+        for inner_field in inner_fields:
+            inner_field_name, to_type = name_and_type(inner_field)
+            items.append(
+                "{!r}: [{} for item in entry.get({!r}, ())]".format(
+                    "{}_{}".format(top_field, inner_field_name),
+                    convert("item[{!r}]".format(inner_field_name), to_type),
+                    top_field,
+                )
+            )
+    source = "def process_entry(entry):\n    return {{\n{}    }}\n".format(
+        "".join("        {},\n".format(item) for item in items)
+    )
+    exec(compile(source, "<flattener>", "exec"), namespace)
+    process_entry = namespace["process_entry"]
+    process_entry.__doc__ = "Flatten the nested fields of an entry."
+    return process_entry
+
+
+def use_fields(filename=FIELDS_FILE):
+    """Extract the fields described in the given file from all entries from now on."""
+    global fields_file, base_fields, direct_fields, indirect_fields, process_entry
+    fields_file = filename
+    base_fields, direct_fields, indirect_fields = load_fields(filename)
+    process_entry = compile_flattener(direct_fields, indirect_fields)
+
+
+fields_file = base_fields = direct_fields = indirect_fields = process_entry = None
+use_fields()
+
+
+def link_entry(new_entry, entry_instances, base_data):
+    """Complete a flattened entry with its instances and the glossary-wide data."""
+    new_entry["instances"] = entry_instances
+    # Store the number of instances, so that ES can sort entries by how
+    # often they appear without having to look at the instances themselves
+    new_entry["instances_count"] = len(entry_instances)
+    # Add the attributes shared by all entries in the glossary
+    new_entry.update(base_data)
+    return new_entry
+
+
+def warn_missing_instance(entry):
+    warnings.warn(
+        "Could not find the instance {} for entry {}!".format(
+            entry["xis"], entry["headword"])
+    )
+
+
+def iter_glossary_data(data):
+    """
+    Process a glossary and link the entries to their instances, one at a time.
 
     Glossaries contain entries in a nested format. This step extracts the
-    relevant information at various nesting levels, and produces a list of
-    entries with "flattened" fields. It also incorporates the information from
-    the instances part of the glossary into the relevant entries.
+    relevant information at various nesting levels, and produces entries with
+    "flattened" fields. It also incorporates the information from the instances
+    part of the glossary into the relevant entries.
     Any entries referring to non-existent instances will be ignored. A warning
     will be raised in those cases.
 
     :param data: a dictionary representing a glossary, including the instances.
-    :return: a list of entries, flattened and linked to instances when possible.
+    :return: a generator of entries, flattened and linked to instances when possible.
 
     """
     instances = data["instances"]
     base_data = {key: data[key] for key in base_fields}
-    new_entries = []
     for entry in data["entries"]:
-        # Create a flat entry from the nested norms, forms, senses etc.
-        new_entry = process_entry(entry)
         # Find the instance that is referred to by the entry. For now, just link
         # the top-level reference rather than that of individual senses, norms
         # etc. Every entry should have a corresponding instance in the glossary,
         # so if something is missing this will throw a KeyError, which will let
         # us know that there is something wrong with the glossary.
         try:
-            new_entry["instances"] = instances[entry["xis"]]
+            entry_instances = instances[entry["xis"]]
         except KeyError:
-            warnings.warn(
-                "Could not find the instance {} for entry {}!".format(
-                    entry["xis"], entry["headword"])
-            )
+            warn_missing_instance(entry)
             continue
-        # Add the attributes shared by all entries in the glossary
-        new_entry.update(base_data)
-        new_entries.append(new_entry)
-    return new_entries
+        # Create a flat entry from the nested norms, forms, senses etc.
+        yield link_entry(process_entry(entry), entry_instances, base_data)
 
 
-def preprocess_glossary(glossary_filename):
-    """Remove unused fields from a glossary and return it as a dictionary."""
-    filter_file = os.path.join("ingest", "remove_unused.jq")
-    try:
-        s = subprocess.run(
-                ["jq", "-f", filter_file, glossary_filename],
-                stdout=subprocess.PIPE
-        )
-    except FileNotFoundError as e:
-        # If the jq is executable is not found, a FileNotFoundError is raised
-        raise RuntimeError('Could not run jq command.') from e
-    # We need to decode the output to a string if not working in binary mode
-    return json.loads(s.stdout.decode("utf8"))
+def process_glossary_data(data):
+    """
+    Process a glossary and link the entries to their instances.
+
+    :param data: a dictionary representing a glossary, including the instances.
+    :return: a list of entries, flattened and linked to instances when possible.
+    """
+    return list(iter_glossary_data(data))
+
+
+def stream_glossary(infile, block_size=1 << 16):
+    """
+    Read a glossary incrementally, producing its flattened entries one at a time.
+
+    This gives the same entries as process_glossary_data, but without ever
+    loading the whole glossary into memory. Each entry is flattened as soon as
+    it is read, keeping only the fields we use. Since in Oracc glossaries the
+    instances come after the entries, the flattened entries are held until
+    their instances are found, and are produced in the order of the instances
+    (which is normally the same as that of the entries). The memory used
+    therefore still grows with the number of entries, but only by the size of
+    their flattened versions. Any other parts of the glossary, like the
+    summaries, are skipped over without being decoded.
+
+    :param infile: a text file containing the glossary
+    :param block_size: how many characters to read from the file at a time
+    :return: a generator of the flattened entries, linked to their instances
+    """
+    stream = JSONStream(infile, block_size)
+    base_data = {}
+    waiting = {}  # instance reference -> entries waiting for those instances
+    instances = {}  # only used if the instances come before the entries
+    entries_read = False
+    for key in stream.object_keys():
+        if key in base_fields:
+            base_data[key] = stream.decode()
+        elif key == "entries":
+            for _ in stream.array_items():
+                entry = stream.decode()
+                new_entry = process_entry(entry)
+                if entry["xis"] in instances:
+                    yield link_entry(new_entry, instances[entry["xis"]], base_data)
+                else:
+                    # Only keep what is needed to report a missing instance
+                    reference = {"xis": entry["xis"], "headword": entry["headword"]}
+                    waiting.setdefault(entry["xis"], []).append((reference, new_entry))
+            entries_read = True
+        elif key == "instances":
+            for reference in stream.object_keys():
+                if reference in waiting:
+                    entry_instances = stream.decode()
+                    for _, new_entry in waiting.pop(reference):
+                        yield link_entry(new_entry, entry_instances, base_data)
+                elif entries_read:
+                    stream.skip()  # nobody refers to these instances
+                else:
+                    instances[reference] = stream.decode()
+        else:
+            stream.skip()
+    # Any entries still waiting refer to instances that don't exist
+    for waiting_entries in waiting.values():
+        for entry, _ in waiting_entries:
+            warn_missing_instance(entry)
+
+
+def read_entries(input_name):
+    """
+    Read the entries of a glossary file lazily, one at a time.
+
+    The glossaries contain a lot of information that we do not use, and can be
+    too large to load in memory. Therefore, we read them incrementally and only
+    keep the information we need from each entry, so that the entries can be
+    uploaded while the rest of the file is still being read.
+
+    :param input_name: the name of the glossary JSON file
+    :return: a generator of the individual entries, as dictionaries
+    """
+    with open(input_name, 'r') as input_file:
+        yield from stream_glossary(input_file)
+    print("Finished processing {}".format(input_name))
 
 
 def process_file(input_name, write_file=True):
@@ -118,24 +289,7 @@ def process_file(input_name, write_file=True):
     :param write_file: whether to write the entries in a new file, to be used later
     :return: a list of the new individual entries, as dictionaries
     """
-    # The glossaries contain a lot of information that we do not use.
-    # Sometimes this can make them too large to load in memory. Therefore,
-    # we first preprocess each file to remove the fields we do not need.
-    try:
-        data = preprocess_glossary(input_name)
-    except RuntimeError:
-        # If the preprocessing fails (most likely reason is that the jq tool
-        # is not present), try to read the file normally as a last resort.
-        warnings.warn(
-            "Could not preprocess file {}. Is jq installed?\n"
-            "Will attempt to ingest without preprocessing."
-            "This may fail for large glossaries.".format(input_name),
-            RuntimeWarning
-        )
-        with open(input_name, 'r') as input_file:
-            data = json.load(input_file)
-
-    new_entries = process_glossary_data(data)
+    new_entries = list(read_entries(input_name))
     if write_file:
         output_name = input_name.rsplit('.', 1)[0] + "-entries.json"
         with open(output_name, 'w') as outfile:
@@ -143,7 +297,6 @@ def process_file(input_name, write_file=True):
                 header = '{ "index" : { "_id" : "' + new_entry["id"] + '" } }'
                 print(header, file=outfile)
                 print(json.dumps(new_entry), file=outfile)
-    print("Finished processing {}".format(input_name))
     return new_entries
 
 
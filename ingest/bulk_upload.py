@@ -1,6 +1,7 @@
 import argparse
 import glob
 import logging
+import os
 import sys
 import time
 import urllib3
@@ -9,24 +10,365 @@ import elasticsearch
 from elasticsearch import Elasticsearch
 import elasticsearch.client
 import elasticsearch.helpers
+from elasticsearch.serializer import JSONSerializer
 
-from .break_down import process_file
-from .prepare_index import create_index
+from .adaptive import bulk_apply, DeadLetterFile
+from .artifact import ArtifactReader, ArtifactWriter, serialise_action
+from .break_down import read_entries, use_fields
+from .incremental import (
+    apply_actions,
+    changed_entry_actions,
+    failed_entry_ids,
+    Manifest,
+    removed_file_actions,
+)
+from .parallel import parallel_upload, report_throughput
+from .prepare_index import (
+    create_index,
+    create_instances_index,
+    finish_bulk_load,
+    instances_index_name,
+    new_generation,
+    set_generation,
+)
+from .versioning import (
+    alias_targets,
+    GenerationError,
+    remove_old_generations,
+    swap_aliases,
+    verify_count,
+    versioned_index_name,
+)
 
 INDEX_NAME = "oracc"
+INSTANCES_CHUNK_SIZE = 1000  # how many instances to store in each document
+BULK_CHUNK_SIZE = 500  # how many documents to send to ES in each bulk request
+BULK_MAX_BYTES = 100 * 1024 * 1024  # the maximum size of each bulk request
 
 LOGGER = logging.getLogger("bulk_upload")
 
 
-def upload_entries(es, entries):
+def instance_chunks(entry_id, instances, index_name):
+    """
+    Split the instances of an entry into documents for the instances index.
+
+    Every entry gets at least one document, even if it has no instances, so
+    that the instances of any existing entry can always be looked up.
+    """
+    total = len(instances)
+    for start in range(0, max(total, 1), INSTANCES_CHUNK_SIZE):
+        end = min(start + INSTANCES_CHUNK_SIZE, total)
+        yield {
+            "_index": index_name,
+            "_id": "{}.{}".format(entry_id, start // INSTANCES_CHUNK_SIZE),
+            "entry_id": entry_id,
+            "start": start,
+            "end": end,
+            "total": total,
+            "instances": instances[start:end],
+        }
+
+
+def entry_actions(entries, index_name):
+    """
+    Prepare the bulk actions to index a sequence of entries.
+
+    The instances of each entry are moved into their own index, so that the
+    main index only records how many there are.
+    """
     for entry in entries:
-        entry["_index"] = INDEX_NAME
-        entry["completions"] = [entry["cf"], entry["gw"]]
-    elasticsearch.helpers.bulk(es, entries, index=INDEX_NAME)
+        # Copy the entry rather than changing it, so that the caller's data
+        # still has the instances
+        document = {key: value for key, value in entry.items() if key != "instances"}
+        instances = entry.get("instances", [])
+        document["_index"] = index_name
+        document["_id"] = entry["id"]
+        document["completions"] = [entry["cf"], entry["gw"]]
+        # Entries which have not come from process_glossary_data (e.g. if read
+        # from an older file) may not have their instances counted yet
+        document.setdefault("instances_count", len(instances))
+        yield document
+        yield from instance_chunks(entry["id"], instances, instances_index_name(index_name))
+
+
+def upload_entries(es, entries, index_name=None, chunk_size=None, max_bytes=None,
+                   dead_letter=None, artifact=None):
+    """
+    Upload a sequence of entries (and their instances) to ES.
+
+    The entries are consumed lazily and sent in chunks as they are produced, so
+    only one chunk of documents needs to be held in memory at a time. The size
+    of the chunks is adjusted to how quickly ES can index them, and documents
+    rejected by ES when it is overloaded are sent again.
+
+    :param es: an Elasticsearch instance to connect to
+    :param entries: the entries to upload, e.g. as produced by read_entries
+    :param index_name: the index to upload to (by default, INDEX_NAME)
+    :param chunk_size: how many documents to send in the first request
+    :param max_bytes: the maximum size of each request
+    :param dead_letter: a DeadLetterFile for any documents that cannot be indexed
+    :param artifact: an ArtifactWriter in which to record the uploaded documents
+    :return: the set of ids of the uploaded entries
+    :raises: elasticsearch.helpers.BulkIndexError if any document cannot be
+        indexed and there is no dead-letter file.
+    """
+    index_name = index_name or INDEX_NAME
+    ids = set()
+
+    def record_ids(entries):
+        for entry in entries:
+            ids.add(entry["id"])
+            yield entry
+
+    actions = entry_actions(record_ids(entries), index_name)
+    options = {}
+    if artifact is not None:
+        # Serialise the actions here, so they can be recorded as they are sent
+        serializer = JSONSerializer()
+        actions = artifact.record(serialise_action(action, serializer) for action in actions)
+        options["expand_action_callback"] = lambda lines: lines
+    _, errors = bulk_apply(
+        es,
+        actions,
+        dead_letter,
+        chunk_size=chunk_size or BULK_CHUNK_SIZE,
+        max_bytes=max_bytes or BULK_MAX_BYTES,
+        **options,
+    )
+    # Entries whose documents failed have not been uploaded (but the chunks of
+    # their instances have ids that are never the same as those of entries)
+    for item in errors:
+        ids.discard(next(iter(item.values())).get("_id"))
+    return ids
+
+
+def upload_file(es, input_file, index_name=None):
+    return upload_entries(es, read_entries(input_file), index_name)
+
+
+def start_generation(es):
+    """
+    Create a new generation of the indices, set up for uploading data quickly.
+
+    :param es: an Elasticsearch instance to connect to
+    :return: the name of the new index for the entries
+    """
+    # Upload the data into a new generation of indices, leaving the current one
+    # untouched (and searchable) until the upload is complete
+    generation = new_generation()
+    index_name = versioned_index_name(INDEX_NAME, generation)
+    LOGGER.debug("Will create index %s", index_name)
+    # Create the indices with the required settings. Since they are not searched
+    # until the upload is complete, they can be set up for indexing quickly.
+    create_index(es, index_name, generation, bulk_load=True)
+    try:
+        create_instances_index(es, instances_index_name(index_name), bulk_load=True)
+    except BaseException:
+        discard_generation(es, index_name)
+        raise
+    return index_name
+
+
+def discard_generation(es, index_name, artifact=None):
+    """
+    Delete the indices of a new generation of the data, unless it is already in use.
+
+    This is called when an upload fails for any reason, so that no half-built
+    indices are left behind (still set up for bulk loading).
+
+    :param es: an Elasticsearch instance to connect to
+    :param index_name: the name of the new index for the entries
+    :param artifact: an ArtifactWriter recording the upload, to be discarded too
+    """
+    if artifact is not None:
+        artifact.discard()
+    try:
+        if index_name in alias_targets(es, INDEX_NAME):
+            return  # the upload failed after the new data was published
+        LOGGER.warning("Deleting the unpublished generation %s", index_name)
+        es.indices.delete(
+            index=[index_name, instances_index_name(index_name)], ignore_unavailable=True
+        )
+    except elasticsearch.exceptions.ElasticsearchException:
+        # Don't hide the original problem (which may well be the same)
+        LOGGER.exception("Could not delete the unpublished generation %s", index_name)
+
+
+def publish_generation(es, index_name, entry_count, keep=1, replicas=1, force_merge=False):
+    """
+    Start using a new generation of the indices, once all entries are uploaded.
+
+    :param es: an Elasticsearch instance to connect to
+    :param index_name: the name of the new index for the entries
+    :param entry_count: how many entries were uploaded
+    :param keep: how many previous generations of the data to keep
+    :param replicas: how many replicas of the new indices to keep
+    :param force_merge: whether to merge the new indices into a single segment
+    :raises: GenerationError if the index does not contain the expected number
+        of entries, in which case the previous generation is left in use.
+    """
+    finish_bulk_load(
+        es, [index_name, instances_index_name(index_name)], replicas, force_merge
+    )
+    # Make sure all the entries have made it into the index before using it
+    verify_count(es, index_name, entry_count)
+    swap_aliases(es, INDEX_NAME, index_name)
+    remove_old_generations(es, INDEX_NAME, keep=keep)
+
+
+def full_upload(es, files, keep=1, workers=1, chunk_size=None, max_bytes=None,
+                dead_letter=None, replicas=1, force_merge=False, artifact=None):
+    """
+    Upload all glossaries into a new generation of the indices, and switch to it.
+
+    :param es: an Elasticsearch instance to connect to
+    :param files: the names of the glossary files to upload
+    :param keep: how many previous generations of the data to keep
+    :param workers: how many glossaries to process at once (and how many bulk
+        requests to send at once)
+    :param chunk_size: how many documents to send in each bulk request
+    :param max_bytes: the maximum size of each bulk request
+    :param dead_letter: a DeadLetterFile for any documents that cannot be indexed
+    :param replicas: how many replicas of the new indices to keep
+    :param force_merge: whether to merge the new indices into a single segment
+    :param artifact: an ArtifactWriter in which to record the uploaded documents
+        (which must be closed with the manifest once the upload is done)
+    :return: a manifest recording the uploaded data
+    :raises: GenerationError if not all entries have been uploaded. If the
+        upload fails for this or any other reason, the new indices and the
+        artifact are discarded before the error is passed on.
+    """
+    index_name = start_generation(es)
+    try:
+        if artifact is not None:
+            artifact.start(index_name)
+
+        manifest = Manifest(index_name)
+        if workers > 1:
+            uploaded_ids = parallel_upload(
+                es,
+                files,
+                index_name,
+                manifest,
+                entry_actions,
+                workers,
+                chunk_size or BULK_CHUNK_SIZE,
+                max_bytes or BULK_MAX_BYTES,
+                INSTANCES_CHUNK_SIZE,
+                dead_letter,
+                artifact,
+            )
+        else:
+            uploaded_ids = set()
+            for file in files:
+                print(f"going to upload {file}")
+                start = time.monotonic()
+                # Break down into individual entries and upload to ES using the bulk API
+                entries = manifest.record(file, read_entries(file), INSTANCES_CHUNK_SIZE)
+                file_ids = upload_entries(
+                    es, entries, index_name, chunk_size, max_bytes, dead_letter, artifact
+                )
+                report_throughput(
+                    file, len(file_ids), os.path.getsize(file), time.monotonic() - start
+                )
+                uploaded_ids |= file_ids
+
+        publish_generation(es, index_name, len(uploaded_ids), keep, replicas, force_merge)
+    except BaseException:
+        discard_generation(es, index_name, artifact)
+        raise
+    return manifest
+
+
+def replay_upload(es, filename, keep=1, workers=1, chunk_size=None, max_bytes=None,
+                  dead_letter=None, replicas=1, force_merge=False):
+    """
+    Upload the documents recorded in an artifact into a new generation of the indices.
+
+    This gives the same data as the ingest which wrote the artifact, without
+    having to process the glossaries again.
+
+    :param es: an Elasticsearch instance to connect to
+    :param filename: the name of the artifact
+    :param keep: how many previous generations of the data to keep
+    :param workers: how many bulk requests to send at once
+    :param chunk_size: how many documents to send in each bulk request
+    :param max_bytes: the maximum size of each bulk request
+    :param dead_letter: a DeadLetterFile for any documents that cannot be indexed
+    :param replicas: how many replicas of the new indices to keep
+    :param force_merge: whether to merge the new indices into a single segment
+    :return: the manifest recorded in the artifact, for the new index
+    :raises: ValueError if the file is not a complete artifact, or
+        GenerationError if not all entries have been uploaded. If the upload
+        fails for these or any other reasons, the new indices are discarded
+        before the error is passed on.
+    """
+    index_name = start_generation(es)
+    artifact = ArtifactReader(filename)
+    start = time.monotonic()
+    try:
+        # The actions are already serialised, so there is nothing left to expand
+        _, errors = bulk_apply(
+            es,
+            artifact.actions(index_name),
+            dead_letter,
+            threads=workers,
+            chunk_size=chunk_size or BULK_CHUNK_SIZE,
+            max_bytes=max_bytes or BULK_MAX_BYTES,
+            expand_action_callback=lambda lines: lines,
+        )
+        uploaded_ids = artifact.entry_ids
+        for item in errors:
+            uploaded_ids.discard(next(iter(item.values())).get("_id"))
+        report_throughput(
+            filename, len(uploaded_ids), os.path.getsize(filename), time.monotonic() - start
+        )
+        publish_generation(es, index_name, len(uploaded_ids), keep, replicas, force_merge)
+    except BaseException:
+        discard_generation(es, index_name)
+        raise
+    return artifact.manifest
+
 
+def incremental_upload(es, files, manifest, dead_letter=None):
+    """
+    Update the current indices with the glossaries that changed since the last ingest.
 
-def upload_file(es, input_file):
-    upload_entries(es, process_file(input_file, write_file=False))
+    :param es: an Elasticsearch instance to connect to
+    :param files: the names of the glossary files to upload
+    :param manifest: the manifest of the data currently in the index
+    :param dead_letter: a DeadLetterFile for any documents that cannot be updated
+    :return: the number of documents updated or deleted
+    """
+    index_name = manifest.index_name
+    changed = 0
+    for file in files:
+        if not manifest.file_changed(file):
+            LOGGER.info("Skipping %s, which has not changed", file)
+            continue
+        print(f"going to update {file}")
+        actions = changed_entry_actions(
+            manifest,
+            file,
+            read_entries(file),
+            index_name,
+            INSTANCES_CHUNK_SIZE,
+            entry_actions,
+        )
+        changed += apply_actions(es, actions, dead_letter)
+    # Remove the entries of any glossaries that no longer exist
+    for file in list(manifest.files):
+        if not os.path.exists(file):
+            LOGGER.info("Removing the entries of %s, which no longer exists", file)
+            changed += apply_actions(
+                es, removed_file_actions(manifest, file, index_name), dead_letter
+            )
+    LOGGER.info("Updated or deleted %s documents", changed)
+    if changed:
+        es.indices.refresh(index=[index_name, instances_index_name(index_name)])
+        # Let the API know that the data has changed, so it can drop cached results
+        set_generation(es, index_name)
+    return changed
 
 
 def ICU_installed(es):
@@ -82,6 +424,85 @@ if __name__ == "__main__":
         metavar="SECONDS",
         help="Wait for up to this many seconds for elasticsearch to be ready before uploading",
     )
+    parser.add_argument(
+        "--keep",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Keep this many previous versions of the data, besides the new one (default 1)",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only upload the glossaries and entries that changed since the last ingest",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default="ingest-manifest.json",
+        help="File recording the uploaded data, for incremental ingests "
+        "(default ingest-manifest.json)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Process this many glossaries at once, and send this many bulk "
+        "requests at once (default 1; only for full uploads)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=BULK_CHUNK_SIZE,
+        metavar="DOCUMENTS",
+        help=f"Send this many documents in each bulk request (default {BULK_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=BULK_MAX_BYTES,
+        metavar="BYTES",
+        help=f"Maximum size of each bulk request (default {BULK_MAX_BYTES})",
+    )
+    parser.add_argument(
+        "--dead-letter",
+        type=str,
+        metavar="FILE",
+        help="Write any documents that cannot be uploaded to this file (in the "
+        "format of the bulk API) instead of stopping",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Keep this many replicas of newly created indices (default 1)",
+    )
+    parser.add_argument(
+        "--force-merge",
+        help="Merge newly created indices into a single segment after uploading, "
+        "for faster searches",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fields",
+        type=str,
+        help="JSON file describing the fields to extract from each entry "
+        "(default ingest/fields.json)",
+    )
+    parser.add_argument(
+        "--artifact",
+        type=str,
+        help="Record the uploaded documents in this (gzip-compressed) file, "
+        "to upload them again later with --replay",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        metavar="ARTIFACT",
+        help="Upload the documents recorded in an artifact instead of reading glossaries",
+    )
     parser.add_argument(
         "filenames",
         type=str,
@@ -92,6 +513,9 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
 
+    if args.fields:
+        use_fields(args.fields)
+
     es = Elasticsearch(args.host)
     if args.wait:
         await_healthy(es, args.wait)
@@ -99,8 +523,6 @@ if __name__ == "__main__":
         LOGGER.debug("ICU Analysis plugin is required but could not be found. Exiting.")
         sys.exit()
 
-    clear_database = True
-
     files = args.filenames
     if len(files) == 0:
         files = glob.glob("neo/gloss-???.json")
@@ -109,21 +531,59 @@ if __name__ == "__main__":
         for fn in args.filenames:
             files += glob.glob(fn)
 
-    LOGGER.debug("Will index %s", ",".join(files))
-
-    # Clear ES database if desired
-    client = elasticsearch.client.IndicesClient(es)
-    if clear_database:
-        try:
-            LOGGER.debug("Will delete index %s", INDEX_NAME)
-            client.delete(index=INDEX_NAME)
-        except elasticsearch.exceptions.NotFoundError:
-            LOGGER.debug("Index not found, continuing")
+    # Refer to files in the same way regardless of the working directory, so
+    # that they can be matched against the manifest
+    files = [os.path.abspath(file) for file in files]
 
-    # Create the index with the required settings
-    create_index(es, INDEX_NAME)
+    LOGGER.debug("Will index %s", ",".join(files))
 
-    for file in files:
-        print(f"going to upload {file}")
-        # Break down into individual entries and upload to ES using the bulk API
-        upload_file(es, file)
+    dead_letter = DeadLetterFile(args.dead_letter) if args.dead_letter else None
+    artifact = None
+    manifest = Manifest.load(args.manifest)
+    try:
+        if args.replay:
+            manifest = replay_upload(
+                es,
+                args.replay,
+                args.keep,
+                args.workers,
+                args.chunk_size,
+                args.max_bytes,
+                dead_letter,
+                args.replicas,
+                args.force_merge,
+            )
+        elif args.incremental and alias_targets(es, INDEX_NAME) == [manifest.index_name]:
+            if args.artifact:
+                LOGGER.warning("Artifacts are only written when uploading everything")
+            incremental_upload(es, files, manifest, dead_letter)
+        else:
+            if args.incremental:
+                LOGGER.info("No manifest for the current data, will upload everything")
+            artifact = ArtifactWriter(args.artifact) if args.artifact else None
+            manifest = full_upload(
+                es,
+                files,
+                args.keep,
+                args.workers,
+                args.chunk_size,
+                args.max_bytes,
+                dead_letter,
+                args.replicas,
+                args.force_merge,
+                artifact,
+            )
+    except GenerationError:
+        # The new indices and artifact have already been discarded, and the
+        # previous manifest is left as it was
+        LOGGER.exception("Upload incomplete, keeping the previous data")
+        if dead_letter is not None:
+            dead_letter.close()
+        sys.exit(1)
+    if dead_letter is not None:
+        dead_letter.close()
+        # Make sure that whatever failed is tried again on the next ingest
+        manifest.forget(failed_entry_ids(dead_letter.failed))
+    if artifact is not None:
+        artifact.close(manifest)
+    manifest.save(args.manifest)
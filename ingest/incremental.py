@@ -0,0 +1,201 @@
+"""Methods for updating the indexed data with only the glossaries that changed.
+
+A manifest file records what has been uploaded: a hash of the contents of each
+glossary file, and for each entry (by id) a hash of its processed document, the
+file it came from and the number of documents holding its instances. On the
+next ingest, files whose hash hasn't changed are skipped, and of the rest only
+the entries that are new or different are uploaded. Entries which are no longer
+present are deleted.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+
+from .adaptive import bulk_apply
+from .prepare_index import instances_index_name
+
+LOGGER = logging.getLogger("incremental")
+
+
+def file_hash(filename):
+    """Compute a hash of the contents of a file, reading it a block at a time."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def entry_hash(entry):
+    """Compute a hash of a processed entry (including its instances)."""
+    encoded = json.dumps(entry, sort_keys=True, ensure_ascii=False).encode("utf8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def chunk_count(entry, chunk_size):
+    """Return how many documents are used to store the instances of an entry."""
+    return max(math.ceil(len(entry.get("instances", [])) / chunk_size), 1)
+
+
+class Manifest:
+    """A record of the data uploaded to a specific index."""
+
+    def __init__(self, index_name=None, files=None, entries=None):
+        self.index_name = index_name
+        self.files = files or {}  # file name -> hash of contents
+        self.entries = entries or {}  # entry id -> {"hash", "file", "chunks"}
+
+    @classmethod
+    def load(cls, filename):
+        """Read a manifest from a file, or return an empty one if it doesn't exist."""
+        try:
+            with open(filename, "r") as infile:
+                data = json.load(infile)
+        except FileNotFoundError:
+            return cls()
+        return cls.from_dict(data)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["index"], data["files"], data["entries"])
+
+    def to_dict(self):
+        return {"index": self.index_name, "files": self.files, "entries": self.entries}
+
+    def save(self, filename):
+        """Write the manifest to a file, replacing it only once fully written."""
+        temporary_name = filename + ".tmp"
+        with open(temporary_name, "w") as outfile:
+            json.dump(self.to_dict(), outfile)
+        os.replace(temporary_name, filename)
+
+    def record(self, filename, entries, chunk_size):
+        """Record the entries of a file in the manifest as they are uploaded.
+
+        This is a generator which yields the entries unchanged, so it can be
+        placed in front of a full upload.
+        """
+        for entry in entries:
+            self.entries[entry["id"]] = {
+                "hash": entry_hash(entry),
+                "file": filename,
+                "chunks": chunk_count(entry, chunk_size),
+            }
+            yield entry
+        self.files[filename] = file_hash(filename)
+
+    def file_changed(self, filename):
+        """Check whether a file has changed since it was last uploaded."""
+        return self.files.get(filename) != file_hash(filename)
+
+    def forget(self, entry_ids):
+        """
+        Remove entries that failed to upload, so that they are uploaded again.
+
+        The files they came from are also marked as changed, so that they are
+        not skipped on the next incremental ingest.
+        """
+        for entry_id in entry_ids:
+            details = self.entries.pop(entry_id, None)
+            if details is not None:
+                self.files.pop(details["file"], None)
+
+    def entries_of(self, filename):
+        """Return the ids of the recorded entries that came from a file."""
+        return [
+            entry_id
+            for entry_id, details in self.entries.items()
+            if details["file"] == filename
+        ]
+
+
+def deletion_actions(entry_id, chunks, index_name, first_chunk=0):
+    """Prepare the bulk actions to delete an entry or some of its instances.
+
+    If first_chunk is 0, the entry itself is deleted along with all of its
+    instances; otherwise, only the chunks of instances from that one onwards.
+    """
+    if first_chunk == 0:
+        yield {"_op_type": "delete", "_index": index_name, "_id": entry_id}
+    for chunk in range(first_chunk, chunks):
+        yield {
+            "_op_type": "delete",
+            "_index": instances_index_name(index_name),
+            "_id": "{}.{}".format(entry_id, chunk),
+        }
+
+
+def changed_entry_actions(manifest, filename, entries, index_name, chunk_size, to_actions):
+    """Prepare the bulk actions to bring the entries of a file up to date.
+
+    Entries that haven't changed since the last upload are skipped, changed and
+    new ones are (re-)indexed, and entries of the file that are no longer
+    present are deleted. The manifest is updated accordingly.
+
+    :param to_actions: a function turning a sequence of entries into actions
+    """
+    remaining = set(manifest.entries_of(filename))
+    for entry in entries:
+        entry_id = entry["id"]
+        remaining.discard(entry_id)
+        new_details = {
+            "hash": entry_hash(entry),
+            "file": filename,
+            "chunks": chunk_count(entry, chunk_size),
+        }
+        old_details = manifest.entries.get(entry_id)
+        if old_details is not None and old_details["hash"] == new_details["hash"]:
+            continue
+        yield from to_actions([entry], index_name)
+        # If the entry now has fewer instances, remove the extra chunks
+        if old_details is not None and old_details["chunks"] > new_details["chunks"]:
+            yield from deletion_actions(
+                entry_id, old_details["chunks"], index_name, new_details["chunks"]
+            )
+        manifest.entries[entry_id] = new_details
+    for entry_id in remaining:
+        yield from deletion_actions(entry_id, manifest.entries[entry_id]["chunks"], index_name)
+        del manifest.entries[entry_id]
+    manifest.files[filename] = file_hash(filename)
+
+
+def removed_file_actions(manifest, filename, index_name):
+    """Prepare the bulk actions to delete all entries of a file that is gone."""
+    for entry_id in manifest.entries_of(filename):
+        yield from deletion_actions(entry_id, manifest.entries[entry_id]["chunks"], index_name)
+        del manifest.entries[entry_id]
+    del manifest.files[filename]
+
+
+def failed_entry_ids(failed):
+    """
+    Find which entries are affected by documents that failed to upload.
+
+    :param failed: the (index, id) of each failed document
+    """
+    for index_name, document_id in failed:
+        # The documents of the instances are named after their entry
+        if document_id is not None and index_name and index_name.endswith("_instances"):
+            document_id = document_id.rsplit(".", 1)[0]
+        yield document_id
+
+
+def _missing_deletion(item):
+    operation, details = next(iter(item.items()))
+    return operation == "delete" and details.get("status") == 404
+
+
+def apply_actions(es, actions, dead_letter=None):
+    """
+    Send bulk actions to ES, returning how many were applied.
+
+    Deleting a document that is already missing is not considered an error.
+
+    :param dead_letter: a DeadLetterFile for any actions that fail
+    :raises: elasticsearch.helpers.BulkIndexError if any other action fails
+        and there is no dead-letter file.
+    """
+    applied, _ = bulk_apply(es, actions, dead_letter, ignore=_missing_deletion)
+    return applied
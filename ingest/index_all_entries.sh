@@ -11,7 +11,7 @@ curl -XPOST 'localhost:9200/oracc/entry/_delete_by_query?conflicts=proceed&prett
 '
 
 for file in neo/gloss-???.json; do
-  python break_down.py $file
+  (cd .. && python -m ingest.break_down "ingest/$file")
 done
 
 for file in neo/*entries*; do
@@ -0,0 +1,161 @@
+"""A minimal incremental reader for large JSON documents.
+
+The standard json module can only decode a whole document at once, which means
+holding both its text and the resulting objects in memory. This module instead
+reads a document a block at a time and lets the caller walk through its
+structure: containers can be entered and iterated over one item at a time, and
+each item can be either decoded (with the standard decoder, so only one item is
+ever held in memory) or skipped without being decoded at all.
+"""
+import json
+import re
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Inside a string, the only characters of interest are the closing quote and
+# backslashes (which may escape a quote). Outside strings, we only care about
+# the characters which start a string or open or close a container.
+_STRING_SPECIAL = re.compile(r'["\\]')
+_STRUCTURE_SPECIAL = re.compile(r'["\[\]{}]')
+# What may follow a number that has been cut short at the end of a block
+_NUMBER_TAIL = re.compile(r"[0-9.eE+\-]*\Z")
+
+
+class JSONStream:
+    """Walk through a JSON document read incrementally from a text file."""
+
+    def __init__(self, infile, block_size=1 << 16):
+        self._file = infile
+        self._block_size = block_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _read_more(self, size=None):
+        """Read another block from the file, dropping the part already used.
+
+        Returns False if there is nothing more to read.
+        """
+        if self._eof:
+            return False
+        block = self._file.read(size or self._block_size)
+        if not block:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + block
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._read_more():
+                return
+
+    def peek(self):
+        """Return the next non-whitespace character, without consuming it."""
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of JSON document")
+        return self._buffer[self._pos]
+
+    def expect(self, character):
+        """Consume the next non-whitespace character, which must be the given one."""
+        found = self.peek()
+        if found != character:
+            raise ValueError(
+                "Expected {!r} but found {!r} in JSON document".format(character, found)
+            )
+        self._pos += 1
+
+    def decode(self):
+        """Decode the next value in the document and return it."""
+        self._skip_whitespace()
+        while True:
+            # If a value is incomplete, it has to be decoded again from its
+            # start, so read at least as much again to keep this from becoming
+            # quadratic for very large values.
+            size = max(self._block_size, len(self._buffer) - self._pos)
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # The value may just continue beyond what has been read so far
+                if self._read_more(size):
+                    continue
+                raise
+            # A number at the end of the buffer may also continue further
+            if _NUMBER_TAIL.match(self._buffer, end) and self._read_more(size):
+                continue
+            self._pos = end
+            return value
+
+    def skip(self):
+        """Move past the next value in the document, without decoding it."""
+        character = self.peek()
+        if character not in '[{"':
+            self.decode()  # a number, boolean or null, which is small anyway
+            return
+        depth = 0
+        in_string = False
+        while True:
+            pattern = _STRING_SPECIAL if in_string else _STRUCTURE_SPECIAL
+            match = pattern.search(self._buffer, self._pos)
+            # Make sure that an escape sequence is not split across blocks
+            if match is None or (
+                match.group() == "\\" and match.end() >= len(self._buffer)
+            ):
+                self._pos = match.start() if match else len(self._buffer)
+                if not self._read_more():
+                    raise ValueError("Unexpected end of JSON document")
+                continue
+            special = match.group()
+            self._pos = match.end()
+            if in_string:
+                if special == "\\":
+                    self._pos += 1  # skip the escaped character
+                else:
+                    in_string = False
+                    if depth == 0:
+                        return
+            elif special == '"':
+                in_string = True
+            elif special in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _items(self, opening, closing, keyed):
+        self.expect(opening)
+        if self.peek() == closing:
+            self._pos += 1
+            return
+        while True:
+            if keyed:
+                key = self.decode()
+                self.expect(":")
+                yield key
+            else:
+                yield None
+            if self.peek() == ",":
+                self._pos += 1
+            else:
+                self.expect(closing)
+                return
+
+    def object_keys(self):
+        """Iterate over the keys of the next value, which must be an object.
+
+        After each key is yielded, the caller must consume the corresponding
+        value (with decode, skip, or by iterating over it) before continuing.
+        """
+        return self._items("{", "}", keyed=True)
+
+    def array_items(self):
+        """Iterate over the items of the next value, which must be an array.
+
+        This yields None for each item, which the caller must then consume (with
+        decode, skip, or by iterating over it) before continuing.
+        """
+        return self._items("[", "]", keyed=False)
@@ -0,0 +1,211 @@
+"""Methods for ingesting several glossaries at once, using all available cores.
+
+Glossaries are read and flattened in a pool of worker processes, which also
+prepare the bulk actions for their entries, already serialised as JSON. The
+main process then only has to send these to ES, which it does from a pool of
+threads so that several bulk requests are in progress at any time. The workers
+hand over their entries in small batches through a bounded queue, so memory use
+does not grow with the size of the glossaries even if ES cannot keep up.
+"""
+import logging
+import multiprocessing
+import os
+from queue import Empty
+import time
+
+from elasticsearch.serializer import JSONSerializer
+
+from . import break_down
+from .adaptive import bulk_apply
+from .artifact import serialise_action
+from .break_down import read_entries
+from .incremental import chunk_count, entry_hash, file_hash
+
+LOGGER = logging.getLogger("parallel")
+
+BATCH_SIZE = 100  # how many entries a worker hands over at a time
+POLL_INTERVAL = 5  # how often to check that the workers are alive, in seconds
+
+_queue = None  # where each worker process puts its results
+
+
+def _init_worker(queue, fields_file):
+    global _queue
+    _queue = queue
+    # Extract the same fields as the main process
+    if fields_file != break_down.fields_file:
+        break_down.use_fields(fields_file)
+
+
+def prepare_file(filename, index_name, chunk_size, to_actions):
+    """
+    Read a glossary in a worker process and pass its bulk actions to the main one.
+
+    The results are put in the queue as ("batch", filename, entries) messages,
+    where each entry is a tuple of its id, its details for the manifest, and
+    its serialised bulk lines. A final ("done", filename, statistics) message
+    is sent once the whole file has been read, or ("error", filename, message)
+    if that was not possible.
+
+    :param to_actions: a function turning a sequence of entries into actions
+    """
+    serializer = JSONSerializer()
+    start = time.monotonic()
+    count = 0
+    batch = []
+    try:
+        for entry in read_entries(filename):
+            details = {
+                "hash": entry_hash(entry),
+                "file": filename,
+                "chunks": chunk_count(entry, chunk_size),
+            }
+            lines = [
+                serialise_action(action, serializer)
+                for action in to_actions([entry], index_name)
+            ]
+            batch.append((entry["id"], details, lines))
+            count += 1
+            if len(batch) >= BATCH_SIZE:
+                _queue.put(("batch", filename, batch))
+                batch = []
+        if batch:
+            _queue.put(("batch", filename, batch))
+        statistics = {
+            "entries": count,
+            "bytes": os.path.getsize(filename),
+            "seconds": time.monotonic() - start,
+            "hash": file_hash(filename),
+        }
+        _queue.put(("done", filename, statistics))
+    except Exception as e:
+        _queue.put(("error", filename, "{}: {}".format(type(e).__name__, e)))
+
+
+def check_workers(pool, pids):
+    """
+    Make sure that none of the worker processes of a pool has died.
+
+    A pool silently replaces any worker which is killed (e.g. when running out
+    of memory), and the file it was reading is never finished.
+
+    :param pool: the pool of worker processes
+    :param pids: the process ids of the workers when the pool was started
+    :raises: RuntimeError if any of the workers has stopped.
+    """
+    processes = list(pool._pool)
+    if {process.pid for process in processes} != pids or any(
+        process.exitcode is not None for process in processes
+    ):
+        raise RuntimeError("A worker process stopped unexpectedly")
+
+
+def report_throughput(filename, entries, size, seconds):
+    """Log how quickly the entries of a file were processed."""
+    seconds = max(seconds, 1e-6)
+    LOGGER.info(
+        "%s: %d entries in %.2fs (%.0f entries/s, %.2f MB/s)",
+        filename,
+        entries,
+        seconds,
+        entries / seconds,
+        size / seconds / 1e6,
+    )
+
+
+def parallel_upload(es, files, index_name, manifest, to_actions, workers,
+                    chunk_size, max_bytes, instances_chunk_size, dead_letter=None,
+                    artifact=None):
+    """
+    Upload several glossaries at once, using a pool of processes and threads.
+
+    :param es: an Elasticsearch instance to connect to
+    :param files: the names of the glossary files to upload
+    :param index_name: the index to upload to
+    :param manifest: a manifest in which to record the uploaded entries
+    :param to_actions: a function turning a sequence of entries into actions
+    :param workers: how many processes to read glossaries with, and how many
+        threads to send bulk requests with
+    :param chunk_size: how many documents to send in the first bulk request
+    :param max_bytes: the maximum size of each bulk request
+    :param instances_chunk_size: how many instances are stored in each document
+    :param dead_letter: a DeadLetterFile for any documents that cannot be indexed
+    :param artifact: an ArtifactWriter in which to record the uploaded documents
+    :return: the set of ids of the uploaded entries
+    :raises: RuntimeError if any of the glossaries could not be read, or if a
+        worker process stopped unexpectedly.
+    :raises: elasticsearch.helpers.BulkIndexError if any document cannot be
+        indexed and there is no dead-letter file.
+    """
+    context = multiprocessing.get_context()
+    # Let the workers get ahead of the uploads, but only by a few batches each
+    queue = context.Queue(maxsize=4 * workers)
+    pool = context.Pool(
+        workers, initializer=_init_worker, initargs=(queue, break_down.fields_file)
+    )
+    pids = {process.pid for process in pool._pool}
+    ids = set()
+
+    def report_error(filename):
+        # Tasks which could not be run at all (e.g. if their arguments could not
+        # be pickled) never send any messages themselves
+        def callback(e):
+            queue.put(("error", filename, "{}: {}".format(type(e).__name__, e)))
+
+        return callback
+
+    def read_results():
+        remaining = len(files)
+        while remaining:
+            try:
+                kind, filename, contents = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                check_workers(pool, pids)
+                continue
+            if kind == "batch":
+                for entry_id, details, lines in contents:
+                    ids.add(entry_id)
+                    manifest.entries[entry_id] = details
+                    yield from lines
+            elif kind == "done":
+                remaining -= 1
+                manifest.files[filename] = contents["hash"]
+                report_throughput(
+                    filename, contents["entries"], contents["bytes"], contents["seconds"]
+                )
+            else:
+                raise RuntimeError("Could not process {}: {}".format(filename, contents))
+
+    start = time.monotonic()
+    try:
+        for filename in files:
+            pool.apply_async(
+                prepare_file,
+                (filename, index_name, instances_chunk_size, to_actions),
+                error_callback=report_error(filename),
+            )
+        actions = read_results()
+        if artifact is not None:
+            actions = artifact.record(actions)
+        # The actions are already serialised, so there is nothing left to expand
+        _, errors = bulk_apply(
+            es,
+            actions,
+            dead_letter,
+            threads=workers,
+            chunk_size=chunk_size,
+            max_bytes=max_bytes,
+            expand_action_callback=lambda lines: lines,
+        )
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    for item in errors:
+        ids.discard(next(iter(item.values())).get("_id"))
+    total_bytes = sum(os.path.getsize(filename) for filename in files)
+    report_throughput("all files", len(ids), total_bytes, time.monotonic() - start)
+    return ids
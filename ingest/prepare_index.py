@@ -1,10 +1,29 @@
 """Methods for creating an index for Oracc glossary data."""
+from datetime import datetime, timezone
+
 from elasticsearch_dsl import analyzer, char_filter, Field, Index, Mapping
 
 
 ANALYZER_NAME = "cuneiform_analyzer"
 CHAR_FILTER_NAME = "cuneiform_to_ascii"
 
+# Settings for an index which is being filled, but not yet searched. Nothing is
+# made searchable until the end, there are no replicas to copy documents to,
+# and the translog is only written to disk now and then rather than after
+# every request (any lost data would be noticed when counting the documents).
+BULK_LOAD_SETTINGS = {
+    "refresh_interval": "-1",
+    "number_of_replicas": 0,
+    "translog": {"durability": "async", "flush_threshold_size": "1gb"},
+}
+# The settings to restore once a bulk load is finished (None meaning the
+# default value), apart from the number of replicas
+SERVING_SETTINGS = {
+    "refresh_interval": None,
+    "translog.durability": None,
+    "translog.flush_threshold_size": None,
+}
+
 
 class ICUKeywordField(Field):
     """A class to represent fields of type icu_collation_keyword.
@@ -78,13 +97,52 @@ def prepare_cuneiform_analyzer():
     return cuneiform_analyzer
 
 
-def prepare_index_mapping():
+def new_generation():
+    """Create a marker for a new version of the indexed data.
+
+    The API caches search results until the generation of the index changes.
+    """
+    return datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+
+
+def set_generation(es, index_name, generation=None):
+    """Record in the metadata of an index that its data has changed.
+
+    :param es: an Elasticsearch instance to connect to
+    :param index_name: the name of the index whose data has changed
+    :param generation: the marker to record (a new one is created by default)
+    """
+    update_meta(es, index_name, generation=generation or new_generation())
+
+
+def update_meta(es, index_name, **values):
+    """Change some of the values recorded in the metadata of an index.
+
+    ES replaces the whole metadata of an index whenever it is updated, so the
+    other values are read first and recorded again.
+
+    :param es: an Elasticsearch instance to connect to
+    :param index_name: the name of the index (or of an alias for it)
+    :param values: the values to record
+    """
+    for name, mapping in es.indices.get_mapping(index=index_name).items():
+        meta = dict(mapping["mappings"].get("_meta", {}), **values)
+        es.indices.put_mapping(index=name, body={"_meta": meta})
+
+
+def prepare_index_mapping(generation=None):
     """Create the field mappings in the index for the specified type.
 
     These must be specified before ingesting the data, so that the fields are
     properly populated.
+
+    :param generation: the generation of the data (a new one is created by default)
     """
     mappings = Mapping()
+    # Record when the index was created, so that cached results from older
+    # versions of the data can be discarded, and that it is not searched yet
+    # (see versioning.swap_aliases).
+    mappings.meta("_meta", {"generation": generation or new_generation(), "published": False})
     # Create an additional field used for sorting. The new field is called
     # cf.sort and will use a locale-aware collation.
     # The base cf field will use the custom cuneiform analyzer.
@@ -100,10 +158,52 @@ def prepare_index_mapping():
         mappings.field(field, "text", analyzer=ANALYZER_NAME)
     # Add completions field to index
     mappings.field("completions", "completion")
+    # The number of instances is used to sort entries by popularity, and the
+    # id to break ties between them, so neither of them needs to be analyzed.
+    mappings.field("instances_count", "integer")
+    mappings.field("id", "keyword")
+    return mappings
+
+
+def instances_index_name(index_name):
+    """Return the name of the index holding the instances for an entry index."""
+    return "{}_instances".format(index_name)
+
+
+def prepare_instances_mapping():
+    """Create the field mappings for the index of instances.
+
+    The instances of each entry are stored in chunks, each containing the
+    instances at positions [start, end) of the full list. Only the entry id and
+    the positions are ever searched on; the instances themselves are just
+    returned, so they are not indexed at all.
+    """
+    mappings = Mapping()
+    mappings.field("entry_id", "keyword")
+    mappings.field("start", "integer")
+    mappings.field("end", "integer")
+    mappings.field("total", "integer", index=False)
+    mappings.field("instances", "keyword", index=False, doc_values=False)
     return mappings
 
 
-def create_index(es, index_name):
+def create_instances_index(es, index_name, bulk_load=False):
+    """
+    Create an index to hold the instances of the entries in a glossary index.
+
+    :param es: an Elasticsearch instance to connect to
+    :param index_name: the name of the index to create
+    :param bulk_load: whether to use settings for filling the index quickly
+        (see finish_bulk_load)
+    """
+    index = Index(index_name)
+    index.mapping(prepare_instances_mapping())
+    if bulk_load:
+        index.settings(**BULK_LOAD_SETTINGS)
+    index.create(using=es)
+
+
+def create_index(es, index_name, generation=None, bulk_load=False):
     """
     Create an index to handle glossary data.
 
@@ -112,8 +212,33 @@ def create_index(es, index_name):
 
     :param es: an Elasticsearch instance to connect to
     :param index_name: the name of the index to create
+    :param generation: the generation of the data (a new one is created by default)
+    :param bulk_load: whether to use settings for filling the index quickly
+        (see finish_bulk_load)
     """
     index = Index(index_name)
     index.analyzer(prepare_cuneiform_analyzer())
-    index.mapping(prepare_index_mapping())
+    index.mapping(prepare_index_mapping(generation))
+    if bulk_load:
+        index.settings(**BULK_LOAD_SETTINGS)
     index.create(using=es)
+
+
+def finish_bulk_load(es, index_names, replicas=1, force_merge=False):
+    """
+    Make indices created for a bulk load ready to be searched.
+
+    This restores the usual settings, and makes all documents searchable.
+
+    :param es: an Elasticsearch instance to connect to
+    :param index_names: the names of the indices that have been loaded
+    :param replicas: how many replicas of the indices to keep
+    :param force_merge: whether to merge each index into a single segment,
+        which makes searches faster, since no more documents will be added
+    """
+    settings = dict(SERVING_SETTINGS, number_of_replicas=replicas)
+    es.indices.put_settings(index=index_names, body={"index": settings})
+    es.indices.refresh(index=index_names)
+    if force_merge:
+        # This can take a while for large indices, so don't let it time out
+        es.indices.forcemerge(index=index_names, max_num_segments=1, request_timeout=3600)
@@ -0,0 +1,135 @@
+"""Methods for keeping several versions of the glossary data in Elasticsearch.
+
+Each ingest creates a new "generation" of the data, in indices whose names
+include the time of the ingest (e.g. oracc-20240101120000000000). The API
+never queries these indices directly, but through aliases (e.g. oracc) which
+are only moved to a new generation once it has been fully uploaded. This way,
+searches keep being answered from the previous data during an ingest. Each
+index records in its metadata whether an alias has ever pointed to it, so that
+the indices of failed ingests are never kept instead of usable old data.
+"""
+import logging
+import re
+
+import elasticsearch
+
+from .prepare_index import instances_index_name, update_meta
+
+LOGGER = logging.getLogger("versioning")
+
+
+def versioned_index_name(alias, generation):
+    """Return the name of the index holding a generation of the data."""
+    return "{}-{}".format(alias, generation)
+
+
+def list_generations(es, alias):
+    """Find the indices of all generations for an alias, oldest first.
+
+    Only the main indices are returned, not those of the instances.
+    """
+    pattern = re.compile(r"{}-\d+".format(re.escape(alias)))
+    names = es.indices.get(index="{}-*".format(alias), expand_wildcards="open")
+    return sorted(name for name in names if pattern.fullmatch(name))
+
+
+def published_generations(es, index_names):
+    """Find which of the given indices have been searched through an alias.
+
+    Indices created before this was recorded are assumed to have been.
+    """
+    if not index_names:
+        return set()
+    mappings = es.indices.get_mapping(index=index_names)
+    return {
+        name
+        for name, mapping in mappings.items()
+        if mapping["mappings"].get("_meta", {}).get("published", True)
+    }
+
+
+def alias_targets(es, alias):
+    """Return the names of the indices an alias currently points to."""
+    try:
+        return list(es.indices.get_alias(name=alias))
+    except elasticsearch.exceptions.NotFoundError:
+        return []
+
+
+class GenerationError(RuntimeError):
+    """A new generation of the data is incomplete, and must not be used."""
+
+    def __init__(self, message, index_name):
+        super().__init__(message)
+        self.index_name = index_name
+
+
+def verify_count(es, index_name, expected):
+    """
+    Check that an index contains the expected number of documents.
+
+    :raises: GenerationError if the number of documents is different.
+    """
+    es.indices.refresh(index=index_name)
+    count = es.count(index=index_name)["count"]
+    if count != expected:
+        raise GenerationError(
+            "Index {} has {} documents instead of {}".format(index_name, count, expected),
+            index_name,
+        )
+    LOGGER.info("Index %s has all %s documents", index_name, count)
+
+
+def swap_aliases(es, alias, new_index):
+    """
+    Point an alias, and the alias of the corresponding instances, to a new index.
+
+    All changes are made in a single request, so that searches see either the
+    old data or the new, but never a mix (or nothing at all). If an index exists
+    with the name of the alias (as created by older versions of the ingest), it
+    is deleted as part of the same request.
+    """
+    actions = []
+    for alias_name, index_name in [
+        (alias, new_index),
+        (instances_index_name(alias), instances_index_name(new_index)),
+    ]:
+        if es.indices.exists(index=alias_name) and not es.indices.exists_alias(
+            name=alias_name
+        ):
+            actions.append({"remove_index": {"index": alias_name}})
+        for old_index in alias_targets(es, alias_name):
+            actions.append({"remove": {"index": old_index, "alias": alias_name}})
+        actions.append({"add": {"index": index_name, "alias": alias_name}})
+    update_meta(es, new_index, published=True)
+    es.indices.update_aliases(body={"actions": actions})
+    LOGGER.info("Alias %s now points to %s", alias, new_index)
+
+
+def remove_old_generations(es, alias, keep=1):
+    """
+    Delete the indices of old generations of the data.
+
+    The generation the alias points to is always kept, as well as the given
+    number of the most recent other generations (so that they can be restored
+    if there is something wrong with the new data). Only generations which have
+    been published count towards these: any others older than the current one
+    are left over from failed ingests, and are deleted. Newer ones may still
+    be being uploaded, so they are left alone.
+    """
+    current = set(alias_targets(es, alias))
+    others = [name for name in list_generations(es, alias) if name not in current]
+    published = published_generations(es, others)
+    old = [name for name in others if name in published]
+    to_delete = old[:-keep] if keep > 0 else old
+    if current:
+        to_delete = sorted(
+            to_delete
+            + [name for name in others if name not in published and name < max(current)]
+        )
+    for index_name in to_delete:
+        LOGGER.info("Deleting old generation %s", index_name)
+        es.indices.delete(
+            index=[index_name, instances_index_name(index_name)], ignore_unavailable=True
+        )
+    return to_delete
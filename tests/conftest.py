@@ -6,8 +6,9 @@ from elasticsearch import Elasticsearch, exceptions
 from elasticsearch.client import IndicesClient
 import pytest
 
+from api.cache import get_cache
 import ingest.bulk_upload
-from ingest.prepare_index import create_index
+from ingest.prepare_index import create_index, create_instances_index, instances_index_name
 
 
 @pytest.fixture(scope="session")
@@ -25,11 +26,17 @@ def es(monkeypatch, test_index_name):
     monkeypatch.setattr(ingest.bulk_upload, "INDEX_NAME", test_index_name)
     assert ingest.bulk_upload.INDEX_NAME == test_index_name  # just making sure
     client = Elasticsearch()
+    # Make sure no results are cached from the data of a previous test
+    get_cache().clear()
     yield client
     try:
         IndicesClient(client).delete(ingest.bulk_upload.INDEX_NAME)
     except exceptions.NotFoundError:
         warnings.warn("The ES index was never created (was anything indexed?)")
+    try:
+        IndicesClient(client).delete(instances_index_name(ingest.bulk_upload.INDEX_NAME))
+    except exceptions.NotFoundError:
+        pass
 
 
 @pytest.fixture(scope="module")
@@ -43,7 +50,9 @@ def entries():
 def uploaded_entries(es, entries, test_index_name):
     """A fixture to ensure that the test glossary entries have been uploaded."""
     create_index(es, test_index_name)
+    create_instances_index(es, instances_index_name(test_index_name))
     ingest.bulk_upload.upload_entries(es, entries)
+    es.indices.refresh(index=instances_index_name(test_index_name))
     # Wait until the upload has finished, but give up after about 10 seconds.
     number_attempts = 20  # how many times to check before giving up
     delay = 0.5  # how long to sleep between attempts
@@ -0,0 +1,91 @@
+import json
+
+import elasticsearch
+import elasticsearch.helpers
+import pytest
+
+from ingest.adaptive import AdaptiveBulk, bulk_apply, DeadLetterFile
+from ingest.incremental import failed_entry_ids, Manifest
+
+
+class OverloadedClient:
+    """
+    Mimics an overloaded ES, rejecting the whole first request and then every
+    other document once. The document with id "bad" can never be indexed.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.seen = set()
+
+    def bulk(self, body, **kwargs):
+        lines = body.splitlines()
+        headers = [json.loads(line) for line in lines[::2]]
+        self.requests.append(len(headers))
+        if len(self.requests) == 1:
+            raise elasticsearch.TransportError(429, "es_rejected_execution_exception")
+        items = []
+        for n, header in enumerate(headers):
+            document_id = header["index"]["_id"]
+            if document_id == "bad":
+                status = 400
+            elif n % 2 and document_id not in self.seen:
+                status = 429
+            else:
+                status = 201
+            self.seen.add(document_id)
+            items.append({"index": {"_index": "idx", "_id": document_id, "status": status}})
+        return {"errors": True, "items": items}
+
+
+def actions(count):
+    for n in range(count):
+        yield {"_index": "idx", "_id": str(n), "value": n}
+
+
+def test_retry_rejected():
+    """Test that rejected documents are retried, with smaller requests."""
+    client = OverloadedClient()
+    bulk = AdaptiveBulk(client, chunk_size=8, min_chunk_size=1, initial_backoff=0)
+    results = list(bulk.run(actions(20)))
+    assert len(results) == 20
+    assert all(ok for ok, _ in results)
+    # The first request is sent again after being rejected...
+    assert client.requests[:2] == [8, 8]
+    # ...and the requests become smaller as documents keep being rejected
+    assert bulk.chunk_size < 8
+    assert bulk.counts["retried"] > 8
+
+
+def test_dead_letter(tmp_path):
+    """Test that documents which cannot be indexed go to the dead-letter file."""
+    client = OverloadedClient()
+    all_actions = list(actions(5)) + [{"_index": "idx", "_id": "bad", "value": -1}]
+    with pytest.raises(elasticsearch.helpers.BulkIndexError):
+        bulk_apply(OverloadedClient(), all_actions, initial_backoff=0)
+    dead_letter = DeadLetterFile(str(tmp_path / "failed.ndjson"))
+    applied, errors = bulk_apply(client, all_actions, dead_letter, initial_backoff=0)
+    dead_letter.close()
+    assert applied == 5
+    assert len(errors) == 1
+    # The file should be ready to send to the bulk API again
+    with open(dead_letter.filename) as infile:
+        lines = [json.loads(line) for line in infile]
+    assert lines == [{"index": {"_index": "idx", "_id": "bad"}}, {"value": -1}]
+    assert dead_letter.failed == [("idx", "bad")]
+
+
+def test_forget_failed_entries():
+    """Test that failed entries are removed from the manifest, to be retried."""
+    manifest = Manifest(
+        "idx",
+        {"a.json": "1", "b.json": "2"},
+        {
+            "a.1": {"hash": "x", "file": "a.json", "chunks": 1},
+            "a.2": {"hash": "y", "file": "a.json", "chunks": 1},
+            "b.1": {"hash": "z", "file": "b.json", "chunks": 1},
+        },
+    )
+    manifest.forget(failed_entry_ids([("idx", "a.1"), ("idx_instances", "b.1.0")]))
+    assert list(manifest.entries) == ["a.2"]
+    assert manifest.files == {}
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from api.asgi import app
+from api.async_search import AsyncESearch
+
+
+def call(path, query_string=b"", headers=(), method="GET", body=b""):
+    """Send a request to the ASGI app and return the messages it sends."""
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": list(headers),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def test_suggest_all_concurrent(monkeypatch):
+    """Check that completions and suggestions are searched for concurrently."""
+    delay = 0.2
+
+    async def fake_complete(self, word, size):
+        await asyncio.sleep(delay)
+        return ["goddess"]
+
+    async def fake_suggest(self, word, size):
+        await asyncio.sleep(delay)
+        return ["god"]
+
+    monkeypatch.setattr(AsyncESearch, "complete", fake_complete)
+    monkeypatch.setattr(AsyncESearch, "suggest", fake_suggest)
+    start = time.monotonic()
+    start_message, body_message = call("/suggest_all/go")
+    # If the two calls ran one after the other, this would take twice as long
+    assert time.monotonic() - start < 2 * delay
+    assert start_message["status"] == 200
+    assert json.loads(body_message["body"]) == {
+        "completions": ["goddess"],
+        "suggestions": ["god"],
+    }
+
+
+def test_stream_results(monkeypatch):
+    """Check that results can be streamed as NDJSON, one entry per line."""
+    entries = [{"gw": "god"}, {"gw": "goddess"}]
+
+    async def fake_list_all(self, stream=False, **args):
+        assert stream
+
+        async def generate():
+            for entry in entries:
+                yield entry
+
+        return generate()
+
+    monkeypatch.setattr(AsyncESearch, "list_all", fake_list_all)
+    messages = call("/search_all", headers=[(b"accept", b"application/x-ndjson")])
+    assert (b"content-type", b"application/x-ndjson") in messages[0]["headers"]
+    lines = b"".join(message.get("body", b"") for message in messages[1:]).splitlines()
+    assert [json.loads(line) for line in lines] == entries
+
+
+def test_unknown_route():
+    """Check that unknown paths are reported as not found."""
+    assert call("/nothing/here")[0]["status"] == 404
+
+
+def test_cursor_header(monkeypatch):
+    """Check that the cursor for the next page is sent in a header."""
+    async def fake_page(self, word=None, cursor=None, count=None, **args):
+        assert word == "god" and cursor is None
+        return [{"gw": "god"}], "next"
+
+    monkeypatch.setattr(AsyncESearch, "page", fake_page)
+    start_message, body_message = call("/search/god", b"cursor=")
+    assert (b"x-next-cursor", b"next") in start_message["headers"]
+    assert json.loads(body_message["body"]) == [{"gw": "god"}]
+
+
+def test_invalid_after():
+    """Check that invalid parameters are rejected as in the Flask app."""
+    messages = call("/search/god", b"after=3")
+    assert messages[0]["status"] == 400
+    assert "after" in json.loads(messages[1]["body"])["message"]
+
+
+def test_single_field_search(monkeypatch):
+    """Check that a field can be searched by giving it in the form data."""
+    async def fake_run(self, word, fieldname=None, stream=False, **args):
+        assert (word, fieldname, args) == ("god", "gw", {"fields": ["gw"]})
+        return [{"gw": "god"}]
+
+    monkeypatch.setattr(AsyncESearch, "run", fake_run)
+    form_headers = [(b"content-type", b"application/x-www-form-urlencoded")]
+    start_message, body_message = call("/search", b"fields=gw", form_headers, body=b"gw=god")
+    assert start_message["status"] == 200
+    assert json.loads(body_message["body"]) == [{"gw": "god"}]
+    assert call("/search")[0]["status"] == 400
+
+
+def test_entry_instances(monkeypatch):
+    """Check that the instances of an entry are paged as in the Flask app."""
+    async def fake_instances(self, entry_id, after=0, count=100):
+        if entry_id != "o0001":
+            return None
+        return {"id": entry_id, "after": after, "count": count}
+
+    monkeypatch.setattr(AsyncESearch, "instances", fake_instances)
+    messages = call("/entry/o0001/instances", b"after=5&count=1000000")
+    assert json.loads(messages[1]["body"]) == {
+        "id": "o0001",
+        "after": 5,
+        "count": AsyncESearch.MAX_INSTANCES_COUNT,
+    }
+    assert call("/entry/o0002/instances")[0]["status"] == 404
+    assert call("/entry/o0001/instances", b"count=many")[0]["status"] == 400
+
+
+def test_head_request(monkeypatch):
+    """Check that responses to HEAD requests have no body."""
+    async def fake_suggest(self, word, size):
+        return ["god"]
+
+    monkeypatch.setattr(AsyncESearch, "suggest", fake_suggest)
+    start_message, body_message = call("/suggest/go", method="HEAD")
+    assert start_message["status"] == 200
+    assert body_message["body"] == b""
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_no_results(monkeypatch, stream):
+    """Check that an empty set of results is answered with an empty 204 response."""
+    async def fake_list_all(self, stream=False, **args):
+        if not stream:
+            return []
+
+        async def generate():
+            for entry in []:
+                yield entry
+
+        return generate()
+
+    monkeypatch.setattr(AsyncESearch, "list_all", fake_list_all)
+    start_message, body_message = call("/search_all", b"stream=1" if stream else b"")
+    assert start_message["status"] == 204
+    assert not any(name == b"content-type" for name, _ in start_message["headers"])
+    assert body_message["body"] == b""
@@ -1,12 +1,16 @@
+import io
 import json
 
 import pytest
 
 from ingest.break_down import (
+    compile_flattener,
+    interpret_entry,
+    load_fields,
     name_and_type,
-    preprocess_glossary,
     process_file,
     process_glossary_data,
+    stream_glossary,
     base_fields,
 )
 
@@ -39,19 +43,6 @@ def missing_instances_glossary():
     return original_data, 1
 
 
-@pytest.fixture(scope="module",
-                params=[
-                  ('tests/gloss-elx.json', 'tests/gloss-elx-preprocessed.json'),
-                ])
-def preprocessing_pair(request):
-    """Return the filename of a glossary and the result of preprocessing it."""
-    input_file = request.param[0]
-    expected_output_file = request.param[1]
-    with open(expected_output_file, 'r') as f:
-        expected_data = json.load(f)
-    return input_file, expected_data
-
-
 def test_process_file(direct_fields, indirect_fields):
     """Test that we can break down a small glossary correctly."""
     input_name = "tests/gloss-elx.json"  # modified from the original
@@ -82,6 +73,8 @@ def test_process_file(direct_fields, indirect_fields):
         # Check that the top-level instances are correctly linked
         correct_instances = original_data["instances"][old_entry["xis"]]
         assert sorted(new_entry["instances"]) == sorted(correct_instances)
+        # And that they have been counted
+        assert new_entry["instances_count"] == len(correct_instances)
 
 
 def test_missing_instances(missing_instances_glossary):
@@ -92,35 +85,37 @@ def test_missing_instances(missing_instances_glossary):
     assert len(processed_data) == len(original_data["entries"]) - missing_number
 
 
-def test_preprocess(preprocessing_pair):
-    """Test that the preprocessing step gives the expected results."""
-    # TODO Should we check the properties of the output data (e.g. keys, length)
-    # rather than compare it to a fixed output?
-    input_file, expected_data = preprocessing_pair
-    output_data = preprocess_glossary(input_file)
-    assert output_data == expected_data
+@pytest.mark.parametrize("block_size", [1, 7, 1 << 16])
+def test_stream_glossary(block_size):
+    """
+    Test that reading a glossary incrementally gives the same entries as
+    processing the whole glossary at once, wherever the blocks are split.
+    """
+    input_name = "tests/gloss-elx.json"
+    with open(input_name, 'r') as infile:
+        expected_entries = process_glossary_data(json.load(infile))
+    with open(input_name, 'r') as infile:
+        new_entries = list(stream_glossary(infile, block_size))
+    assert new_entries == expected_entries
 
 
-def test_preprocess_no_jq(monkeypatch):
-    """Test that the preprocessing step raises an error if jq is not found."""
-    monkeypatch.setenv("PATH", "")
-    with pytest.raises(RuntimeError):
-        preprocess_glossary("tests/gloss-elx.json")
+def test_stream_missing_instances(missing_instances_glossary):
+    """Test that streaming also skips entries with missing instances."""
+    original_data, missing_number = missing_instances_glossary
+    with open("tests/gloss-missing-instance.json", 'r') as infile:
+        with pytest.warns(UserWarning):
+            new_entries = list(stream_glossary(infile))
+    assert len(new_entries) == len(original_data["entries"]) - missing_number
 
 
-def test_process_file_no_jq(monkeypatch):
-    """
-    Test that a file can be processed if jq is not found, but that a warning
-    is raised.
-    """
-    input_file = "tests/gloss-elx.json"
-    monkeypatch.setenv("PATH", "")
-    with pytest.warns(RuntimeWarning) as warning:
-        process_file(input_file, write_file=False)
-    # Check that the filename is present in the warning message
-    assert len(warning) == 1
-    assert input_file in warning[0].message.args[0]
-    # TODO Could check the validity of the result here
+def test_stream_instances_first():
+    """Test that the instances can also come before the entries."""
+    with open("tests/gloss-elx.json", 'r') as infile:
+        data = json.load(infile)
+    expected_entries = process_glossary_data(data)
+    reordered = {"instances": data.pop("instances"), **data}
+    new_entries = list(stream_glossary(io.StringIO(json.dumps(reordered)), 5))
+    assert new_entries == expected_entries
 
 
 def test_name_and_type():
@@ -131,3 +126,29 @@ def test_name_and_type():
     assert name_and_type(("field_name", float)) == ("field_name", float)
     # And check that this still works when the specified type is already str
     assert name_and_type(("field_name", str)) == ("field_name", str)
+
+
+def test_compiled_flattener(tmp_path):
+    """Test that the compiled flattener gives the same entries as the field specs."""
+    fields_file = tmp_path / "fields.json"
+    fields_file.write_text(json.dumps({
+        "base_fields": ["project"],
+        "direct_fields": ["cf", "pos", ["icount", "float"]],
+        "indirect_fields": {"bases": ["n"], "senses": [["icount", "int"], "mng"]},
+    }))
+    base_fields, direct_fields, indirect_fields = load_fields(str(fields_file))
+    assert base_fields == ["project"]
+    assert direct_fields == ["cf", "pos", ("icount", float)]
+    process_entry = compile_flattener(direct_fields, indirect_fields)
+    with open("tests/gloss-elx.json", 'r') as infile:
+        entries = json.load(infile)["entries"]
+    for entry in entries:
+        new_entry = process_entry(entry)
+        assert new_entry == interpret_entry(entry, direct_fields, indirect_fields)
+        assert list(new_entry) == ["cf", "pos", "icount", "bases_n", "senses_icount", "senses_mng"]
+    # Values which are not strings are still converted
+    assert process_entry(dict(entries[0], cf=1))["cf"] == "1"
+    # Unknown types are rejected
+    fields_file.write_text(json.dumps({"direct_fields": [["cf", "list"]]}))
+    with pytest.raises(ValueError):
+        load_fields(str(fields_file))
@@ -1,13 +1,35 @@
+import gzip
+import json
+import os
 import time
+from types import SimpleNamespace
 
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import Index, Search
 
+import pytest
+
 import ingest.bulk_upload
+import ingest.parallel
+from ingest.artifact import ArtifactReader, ArtifactWriter
+from ingest.break_down import process_file
+from ingest.incremental import Manifest
+from ingest.parallel import parallel_upload
 from ingest.prepare_index import (
     ANALYZER_NAME,
     create_index,
+    finish_bulk_load,
     prepare_cuneiform_analyzer,
 )
+from ingest.versioning import (
+    GenerationError,
+    list_generations,
+    remove_old_generations,
+    swap_aliases,
+    verify_count,
+    versioned_index_name,
+)
 
 
 def test_analyzer(es, test_index_name):
@@ -63,3 +85,258 @@ def test_analyzer_search_results(es, entries, test_index_name):
     results = search.execute()
     assert len(results) == 1  # would be 0 if no results found
     assert results[0].cf == "apši"
+
+
+def test_instance_chunks(monkeypatch):
+    """Test that the instances of an entry are split into contiguous chunks."""
+    monkeypatch.setattr(ingest.bulk_upload, "INSTANCES_CHUNK_SIZE", 2)
+    instances = ["a", "b", "c", "d", "e"]
+    chunks = list(ingest.bulk_upload.instance_chunks("x.1", instances, "idx"))
+    assert [chunk["_id"] for chunk in chunks] == ["x.1.0", "x.1.1", "x.1.2"]
+    assert [(chunk["start"], chunk["end"]) for chunk in chunks] == [(0, 2), (2, 4), (4, 5)]
+    assert sum((chunk["instances"] for chunk in chunks), []) == instances
+    assert all(chunk["total"] == len(instances) for chunk in chunks)
+    # Entries without instances still get one (empty) chunk
+    empty_chunks = list(ingest.bulk_upload.instance_chunks("x.2", [], "idx"))
+    assert len(empty_chunks) == 1
+    assert empty_chunks[0]["instances"] == []
+
+
+def test_entry_actions(entries):
+    """Test that the instances are moved out of the main entry documents."""
+    actions = list(ingest.bulk_upload.entry_actions(entries, "idx"))
+    documents = [action for action in actions if action["_index"] == "idx"]
+    chunks = [action for action in actions if action["_index"] == "idx_instances"]
+    assert len(documents) == len(entries)
+    for document, entry in zip(documents, entries):
+        assert "instances" not in document
+        assert document["_id"] == entry["id"]
+        assert document["instances_count"] == len(entry["instances"])
+    assert len(chunks) == len(entries)  # all test entries have few instances
+    # The original entries should be left untouched
+    assert all("instances" in entry for entry in entries)
+
+
+class FakeBulkClient:
+    """Records the bulk requests sent, and how many entries had been read then."""
+
+    def __init__(self):
+        self.requests = []
+        self.bodies = []
+        self.entries_read = 0
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+
+    def bulk(self, body, **kwargs):
+        lines = body.splitlines()
+        self.bodies.append(body)
+        self.requests.append((len(lines) // 2, self.entries_read))
+        return {
+            "errors": False,
+            "items": [{"index": {"status": 201}} for _ in range(len(lines) // 2)],
+        }
+
+
+def test_upload_entries_lazily(entries):
+    """Test that entries are uploaded in chunks while they are still being read."""
+    client = FakeBulkClient()
+
+    def read_entries():
+        for entry in entries:
+            client.entries_read += 1
+            yield entry
+
+    ids = ingest.bulk_upload.upload_entries(client, read_entries(), "idx", chunk_size=4)
+    assert ids == {entry["id"] for entry in entries}
+    # Each entry gives two documents (one of them for its instances)
+    assert sum(size for size, _ in client.requests) == 2 * len(entries)
+    # The first request should be sent before all the entries have been read
+    assert client.requests[0][0] == 4
+    assert client.requests[0][1] < len(entries)
+
+
+def test_parallel_upload():
+    """Test that several glossaries can be processed and uploaded at once."""
+    client = FakeBulkClient()
+    files = ["tests/gloss-elx.json", "tests/gloss-missing-instance.json"]
+    manifest = Manifest("idx")
+    ids = parallel_upload(
+        client, files, "idx", manifest, ingest.bulk_upload.entry_actions, 2, 3, 1 << 20, 1000
+    )
+    expected_entries = [
+        entry for file in files for entry in process_file(file, write_file=False)
+    ]
+    expected_ids = {entry["id"] for entry in expected_entries}
+    assert ids == expected_ids
+    assert sum(size for size, _ in client.requests) == 2 * len(expected_entries)
+    assert client.requests[0][0] == 3
+    # The uploaded data should also be recorded in the manifest
+    assert set(manifest.entries) == expected_ids
+    assert set(manifest.files) == set(files)
+    assert not manifest.file_changed(files[0])
+
+
+def stop_worker(entries, index_name):
+    """Stands in for a worker process being killed while reading a glossary."""
+    os._exit(1)
+
+
+@pytest.mark.parametrize(
+    "to_actions", [stop_worker, lambda entries, index_name: []], ids=["killed", "unpicklable"]
+)
+def test_parallel_upload_failure(monkeypatch, to_actions):
+    """Test that a glossary which is never finished stops the upload instead of hanging it."""
+    monkeypatch.setattr(ingest.parallel, "POLL_INTERVAL", 0.1)
+    with pytest.raises(RuntimeError):
+        parallel_upload(
+            FakeBulkClient(),
+            ["tests/gloss-elx.json"],
+            "idx",
+            Manifest("idx"),
+            to_actions,
+            2,
+            3,
+            1 << 20,
+            1000,
+        )
+
+
+def test_artifact_replay(entries, tmp_path):
+    """Test that the uploaded documents can be recorded, and read back for a new index."""
+    client = FakeBulkClient()
+    filename = str(tmp_path / "ingest.ndjson.gz")
+    artifact = ArtifactWriter(filename)
+    artifact.start("idx-1")
+    ids = ingest.bulk_upload.upload_entries(client, entries, "idx-1", artifact=artifact)
+    artifact.close(Manifest("idx-1", {"a.json": "1"}))
+    sent = [json.loads(line) for body in client.bodies for line in body.splitlines()]
+    reader = ArtifactReader(filename)
+    replayed = [json.loads(line) for lines in reader.actions("idx-2") for line in lines]
+    # The same documents should be uploaded, only to the new indices
+    assert replayed == json.loads(json.dumps(sent).replace('"idx-1', '"idx-2'))
+    assert {header["index"]["_index"] for header in replayed[::2]} == {
+        "idx-2",
+        "idx-2_instances",
+    }
+    assert reader.entry_ids == ids
+    assert reader.manifest.index_name == "idx-2"
+    assert reader.manifest.files == {"a.json": "1"}
+    # Incomplete artifacts should be rejected
+    with gzip.open(filename, "rt") as infile:
+        lines = infile.readlines()
+    with gzip.open(filename, "wt") as outfile:
+        outfile.writelines(lines[:-1])
+    with pytest.raises(ValueError):
+        list(ArtifactReader(filename).actions("idx-2"))
+
+
+def test_incomplete_generation(monkeypatch, tmp_path):
+    """Test that an incomplete upload is reported, without publishing its indices."""
+    class IndicesClient:
+        def refresh(self, index):
+            pass
+
+        def update_aliases(self, body):
+            raise AssertionError("The aliases should not be changed")
+
+    client = SimpleNamespace(indices=IndicesClient(), count=lambda index: {"count": 2})
+    monkeypatch.setattr(ingest.bulk_upload, "finish_bulk_load", lambda *args: None)
+    with pytest.raises(GenerationError) as info:
+        ingest.bulk_upload.publish_generation(client, "idx-1", 3)
+    assert info.value.index_name == "idx-1"
+    # The artifact of the failed upload should not replace the previous one
+    filename = tmp_path / "ingest.ndjson.gz"
+    filename.write_bytes(b"previous")
+    artifact = ArtifactWriter(str(filename))
+    artifact.start("idx-1")
+    artifact.discard()
+    assert filename.read_bytes() == b"previous"
+    assert list(tmp_path.iterdir()) == [filename]
+
+
+class FakeGenerationsClient:
+    """Stands in for an ES client holding several generations of the data."""
+
+    def __init__(self, generations, current=None, published=()):
+        self.generations = generations
+        self.current = current
+        self.published = published
+        self.deleted = []
+        self.indices = self
+
+    def get(self, index, **kwargs):
+        return {name: {} for name in self.generations}
+
+    def get_alias(self, name):
+        if self.current is None:
+            raise NotFoundError(404, "alias_missing", {})
+        return {self.current: {}}
+
+    def get_mapping(self, index):
+        return {
+            name: {"mappings": {"_meta": {"published": name in self.published}}}
+            for name in index
+        }
+
+    def delete(self, index, **kwargs):
+        self.deleted.extend(index)
+
+
+def test_remove_failed_generations():
+    """Test that only published generations are kept as previous versions of the data."""
+    generations = ["oracc-1", "oracc-2", "oracc-3", "oracc-4", "oracc-5"]
+    client = FakeGenerationsClient(generations, "oracc-4", published=["oracc-1", "oracc-2"])
+    # oracc-3 was never published, and oracc-5 may still be being uploaded
+    assert remove_old_generations(client, "oracc", keep=1) == ["oracc-1", "oracc-3"]
+
+
+def test_discard_failed_upload(monkeypatch, tmp_path):
+    """Test that the new indices and the artifact are deleted if an upload fails."""
+    client = FakeGenerationsClient([])
+    monkeypatch.setattr(ingest.bulk_upload, "start_generation", lambda es: "oracc-1")
+
+    def fail(*args):
+        raise ConnectionError("Lost the connection")
+
+    monkeypatch.setattr(ingest.bulk_upload, "upload_entries", fail)
+    artifact = ArtifactWriter(str(tmp_path / "ingest.ndjson.gz"))
+    with pytest.raises(ConnectionError):
+        ingest.bulk_upload.full_upload(client, ["tests/gloss-elx.json"], artifact=artifact)
+    assert client.deleted == ["oracc-1", "oracc-1_instances"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_swap_aliases(es, entries, test_index_name):
+    """Test that new generations of the data replace old ones atomically."""
+    generations = [versioned_index_name(test_index_name, str(n)) for n in range(3)]
+    try:
+        for index_name in generations:
+            create_index(es, index_name)
+            uploaded_ids = ingest.bulk_upload.upload_entries(es, entries, index_name)
+            verify_count(es, index_name, len(uploaded_ids))
+            swap_aliases(es, test_index_name, index_name)
+            # Searching the alias should always give the complete data
+            assert es.count(index=test_index_name)["count"] == len(entries)
+            assert list(es.indices.get_alias(name=test_index_name)) == [index_name]
+        assert list_generations(es, test_index_name) == generations
+        # Only the current and the most recent other generation should be kept
+        assert remove_old_generations(es, test_index_name, keep=1) == generations[:1]
+        assert list_generations(es, test_index_name) == generations[1:]
+    finally:
+        es.indices.delete(index="{}-*".format(test_index_name))
+
+
+def test_bulk_load_settings(es, entries, test_index_name):
+    """Test that indices can be filled quickly, then prepared for searching."""
+    create_index(es, test_index_name, bulk_load=True)
+    settings = es.indices.get_settings(index=test_index_name)[test_index_name]["settings"]
+    assert settings["index"]["refresh_interval"] == "-1"
+    assert settings["index"]["number_of_replicas"] == "0"
+    ingest.bulk_upload.upload_entries(es, entries)
+    finish_bulk_load(es, [test_index_name], replicas=0, force_merge=True)
+    settings = es.indices.get_settings(index=test_index_name)[test_index_name]["settings"]
+    assert "refresh_interval" not in settings["index"]
+    assert "translog" not in settings["index"]
+    # All documents should be searchable straight away, from a single segment
+    assert es.count(index=test_index_name)["count"] == len(entries)
+    segments = es.indices.segments(index=test_index_name)["indices"][test_index_name]
+    assert all(len(shard[0]["segments"]) == 1 for shard in segments["shards"].values())
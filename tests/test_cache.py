@@ -0,0 +1,120 @@
+import json
+import time
+
+from api.cache import cached, estimate_size, normalise_word, ResultCache
+import api.cache
+
+
+class FakeIndicesClient:
+    def __init__(self):
+        self.generation = "1"
+
+    def get_mapping(self, index):
+        return {index: {"mappings": {"_meta": {"generation": self.generation}}}}
+
+
+class FakeClient:
+    def __init__(self):
+        self.indices = FakeIndicesClient()
+
+
+class CountingSearch:
+    """Mimics ESearch, recording how many times the search is actually run."""
+
+    FIELDNAMES = ["gw"]
+
+    def __init__(self):
+        self.client = FakeClient()
+        self.index = "test"
+        self.calls = 0
+
+    @cached
+    def run(self, word, fieldname=None, stream=False, **args):
+        self.calls += 1
+        return [word, fieldname, args]
+
+
+def test_normalise_word():
+    """Check that equivalent query words are normalised to the same form."""
+    assert normalise_word("  God  usan ") == "god usan"
+    # A decomposed "š" should match the precomposed character
+    assert normalise_word("s\u030cu") == normalise_word("\u0161u")
+    assert normalise_word("Straße") != normalise_word("STRASSE")
+
+
+def test_lru_eviction():
+    """Check that the least recently used results are evicted first."""
+    cache = ResultCache(max_bytes=40, ttl=60, check_interval=60)
+    cache.put("a", "x" * 8)  # each value takes 10 bytes as JSON
+    cache.put("b", "x" * 8)
+    cache.put("c", "x" * 8)
+    cache.get("a")  # "a" is now more recent than "b"
+    cache.put("d", "x" * 8)
+    cache.put("e", "x" * 8)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, "x" * 8)
+    assert cache.size <= cache.max_bytes
+    assert cache.stats()["evictions"] == 1
+    # Values that are too large are not stored at all
+    cache.put("f", "x" * 20)
+    assert cache.get("f") == (False, None)
+
+
+def test_expiry():
+    """Check that results are not returned after their time is up."""
+    cache = ResultCache(max_bytes=1000, ttl=0.05, check_interval=60)
+    cache.put("a", 1)
+    assert cache.get("a") == (True, 1)
+    time.sleep(0.1)
+    assert cache.get("a") == (False, None)
+    assert cache.size == 0
+
+
+def test_cached_method(monkeypatch):
+    """Check that results are reused until the index generation changes."""
+    cache = ResultCache(max_bytes=1000, ttl=60, check_interval=0)
+    monkeypatch.setattr(api.cache, "_cache", cache)
+    search = CountingSearch()
+    results = search.run("God", sort_by="gw")
+    # Equivalent queries should share their results
+    assert search.run("god ", sort_by="gw") == results
+    assert search.calls == 1
+    # Different options need a new search
+    search.run("god", sort_by="cf")
+    assert search.calls == 2
+    # ...and so do streamed results
+    search.run("god", stream=True)
+    assert search.calls == 3
+    # Once the data changes, the old results should be dropped
+    search.client.indices.generation = "2"
+    search.run("god", sort_by="gw")
+    assert search.calls == 4
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["invalidations"] == 1
+
+
+def test_keyword_fields_not_normalised(monkeypatch):
+    """Check that searches on fields which are not analysed keep their case."""
+    monkeypatch.setattr(api.cache, "_cache", ResultCache(1000, ttl=60, check_interval=60))
+    search = CountingSearch()
+    # The analysed fields ignore case...
+    assert search.run("God", "gw") == search.run("god", "gw")
+    assert search.calls == 1
+    # ...but keyword fields such as the id don't
+    assert search.run("X.1", "id") != search.run("x.1", "id")
+    assert search.calls == 3
+
+
+def test_estimate_size(monkeypatch):
+    """Check that large results are not encoded in full to measure them."""
+    results = [{"gw": "god", "n": n, "senses": ["x" * (n % 37)]} for n in range(1000)]
+    actual = len(json.dumps(results, separators=(",", ":")))
+    encoded = []
+    monkeypatch.setattr(api.cache, "dumps", lambda value: encoded.append(value) or b"x" * 10)
+    estimate_size(results)
+    assert all(len(value) <= api.cache.SIZE_SAMPLE for value in encoded)
+    monkeypatch.undo()
+    # The estimate should still be close to the real size
+    assert 0.8 * actual < estimate_size(results) < 1.2 * actual
+    assert estimate_size(["x" * 8]) == len(json.dumps(["x" * 8], separators=(",", ":")))
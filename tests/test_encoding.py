@@ -0,0 +1,39 @@
+import json
+
+from elasticsearch_dsl.utils import AttrDict
+import pytest
+
+from api import app, ESearch
+from api.encoding import ENCODERS, get_encoder
+
+RESULTS = [
+    {"cf": "ilum", "gw": "god", "forms": [{"n": "DINGIR", "icount": "12"}], "sort": "[12]"},
+    {"cf": "šarrum", "gw": "king", "senses": AttrDict({"mng": "king₂"})},
+]
+
+
+@pytest.mark.parametrize("name", sorted(ENCODERS))
+def test_encoders(name):
+    """Check that every encoder gives the same data, as a line of UTF-8."""
+    encoded = ENCODERS[name](RESULTS)
+    assert encoded.endswith(b"\n") and encoded.count(b"\n") == 1
+    expected = json.loads(json.dumps(RESULTS, default=AttrDict.to_dict))
+    assert json.loads(encoded.decode("utf8")) == expected
+
+
+def test_choose_encoder(monkeypatch):
+    """Check that the encoder can be configured, falling back to json."""
+    monkeypatch.setenv("ORACC_JSON_ENCODER", "json")
+    assert get_encoder() is ENCODERS["json"]
+    monkeypatch.setenv("ORACC_JSON_ENCODER", "unknown")
+    assert get_encoder() is ENCODERS["json"]
+
+
+def test_json_response(monkeypatch):
+    """Check that responses are encoded with the configured encoder."""
+    monkeypatch.setattr(ESearch, "run", lambda self, word, stream=False, **args: RESULTS[:1])
+    for name in ENCODERS:
+        monkeypatch.setenv("ORACC_JSON_ENCODER", name)
+        response = app.test_client().get("/search/god")
+        assert response.mimetype == "application/json"
+        assert response.json == RESULTS[:1]
@@ -0,0 +1,104 @@
+import gzip
+import json
+
+from api import app, ESearch
+from api.cache import ResultCache
+
+
+def fake_generation(monkeypatch, generation):
+    monkeypatch.setattr(ResultCache, "generation", lambda self, client, index: generation)
+
+
+def counting_run(calls, size=1):
+    def fake_run(self, word, stream=False, **args):
+        calls.append(word)
+        return [{"gw": word, "n": n} for n in range(size)]
+
+    return fake_run
+
+
+def test_conditional_get(monkeypatch):
+    """Check that clients which have the latest results are not sent them again."""
+    calls = []
+    monkeypatch.setattr(ESearch, "run", counting_run(calls))
+    fake_generation(monkeypatch, "oracc_1:1")
+    client = app.test_client()
+    response = client.get("/search/god?count=5&sort_by=gw")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+    # Equivalent requests have the same tag, and are not run again
+    response = client.get("/search/GOD?sort_by=gw&count=5", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert calls == ["god"]
+    # Other requests are run as usual
+    response = client.get("/search/god?count=6&sort_by=gw", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    # And so are all requests once new data has been ingested
+    fake_generation(monkeypatch, "oracc_2:2")
+    response = client.get("/search/god?count=5&sort_by=gw", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(calls) == 3
+
+
+def test_no_etag_without_generation(monkeypatch):
+    """Check that responses are not tagged if the data cannot be identified."""
+    monkeypatch.setattr(ESearch, "run", counting_run([]))
+    fake_generation(monkeypatch, None)
+    response = app.test_client().get("/search/god")
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+
+
+def test_compression(monkeypatch):
+    """Check that large responses are compressed for clients which accept it."""
+    monkeypatch.setattr(ESearch, "run", counting_run([], size=100))
+    fake_generation(monkeypatch, "oracc_1:1")
+    client = app.test_client()
+    plain = client.get("/search/god")
+    assert "Content-Encoding" not in plain.headers
+    compressed = client.get("/search/god", headers={"Accept-Encoding": "gzip, deflate"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    assert json.loads(gzip.decompress(compressed.data)) == plain.json
+    # Each encoding has its own tag, but both identify the same results
+    assert compressed.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+    response = client.get("/search/god", headers={"If-None-Match": compressed.headers["ETag"]})
+    assert response.status_code == 304
+    # Small responses are not worth compressing
+    monkeypatch.setenv("ORACC_COMPRESS_MIN_BYTES", str(len(plain.data) + 1))
+    response = client.get("/search/god", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_cache_control(monkeypatch):
+    """Check that the Cache-Control header can be set for each endpoint."""
+    monkeypatch.setattr(ESearch, "run", counting_run([]))
+    monkeypatch.setattr(ESearch, "list_all", lambda self, stream=False, **args: [])
+    fake_generation(monkeypatch, "oracc_1:1")
+    monkeypatch.setenv("ORACC_CACHE_CONTROL", "public, max-age=60")
+    monkeypatch.setenv("ORACC_CACHE_CONTROL_FULLLIST", "public, max-age=3600")
+    client = app.test_client()
+    assert client.get("/search/god").headers["Cache-Control"] == "public, max-age=60"
+    assert client.get("/search_all").headers["Cache-Control"] == "public, max-age=3600"
+
+
+def test_no_etag_for_cursors(monkeypatch):
+    """Check that pages read through a cursor are never tagged or answered with 304."""
+    calls = []
+
+    def fake_page(self, word=None, cursor=None, count=None, **args):
+        calls.append(cursor)
+        return [{"gw": "god"}], "next"
+
+    monkeypatch.setattr(ESearch, "page", fake_page)
+    fake_generation(monkeypatch, "oracc_1:1")
+    client = app.test_client()
+    for url in ["/search/god?cursor=", "/search_all?cursor=abc"]:
+        response = client.get(url, headers={"If-None-Match": "*"})
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+        assert response.headers["X-Next-Cursor"] == "next"
+    assert len(calls) == 2
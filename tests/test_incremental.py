@@ -0,0 +1,59 @@
+import copy
+
+from ingest.bulk_upload import entry_actions
+from ingest.incremental import (
+    changed_entry_actions,
+    Manifest,
+    removed_file_actions,
+)
+
+
+def test_manifest_round_trip(tmp_path, entries):
+    """Test that a manifest can be saved and loaded again."""
+    glossary = tmp_path / "gloss.json"
+    glossary.write_text("{}")
+    manifest = Manifest("idx")
+    list(manifest.record(str(glossary), entries, 1000))
+    manifest_file = str(tmp_path / "manifest.json")
+    manifest.save(manifest_file)
+    loaded = Manifest.load(manifest_file)
+    assert loaded.index_name == "idx"
+    assert loaded.files == manifest.files
+    assert loaded.entries == manifest.entries
+    assert not loaded.file_changed(str(glossary))
+    glossary.write_text("{ }")
+    assert loaded.file_changed(str(glossary))
+    # A missing manifest is just empty
+    assert Manifest.load(str(tmp_path / "missing.json")).entries == {}
+
+
+def test_changed_entry_actions(tmp_path, entries):
+    """Test that only changed entries are uploaded, and missing ones deleted."""
+    glossary = str(tmp_path / "gloss.json")
+    with open(glossary, "w") as outfile:
+        outfile.write("{}")
+    manifest = Manifest("idx")
+    list(manifest.record(glossary, entries, 1000))
+    new_entries = copy.deepcopy(entries)
+    removed = new_entries.pop()  # one entry disappears...
+    new_entries[0]["gw"] = "changed"  # ...and another one changes
+    actions = list(
+        changed_entry_actions(manifest, glossary, new_entries, "idx", 1000, entry_actions)
+    )
+    indexed = [
+        action["_id"]
+        for action in actions
+        if action.get("_op_type") != "delete" and action["_index"] == "idx"
+    ]
+    deleted = [action["_id"] for action in actions if action.get("_op_type") == "delete"]
+    assert indexed == [new_entries[0]["id"]]
+    assert deleted == [removed["id"], "{}.0".format(removed["id"])]
+    assert removed["id"] not in manifest.entries
+    # Running again with the same entries should do nothing
+    assert not list(
+        changed_entry_actions(manifest, glossary, new_entries, "idx", 1000, entry_actions)
+    )
+    # And all entries of a file should be deleted when it is gone
+    actions = list(removed_file_actions(manifest, glossary, "idx"))
+    assert len(actions) == 2 * len(new_entries)
+    assert not manifest.entries
@@ -0,0 +1,51 @@
+import io
+import json
+
+import pytest
+
+from ingest.json_stream import JSONStream
+
+DOCUMENT = {
+    "skipped": {"a": ["x", "y\\\"]{", {"b": None}], "c": "š\"\\"},
+    "numbers": [1, 23456, -7.5e3, True, False, None],
+    "nested": {"one": [1, [2, [3]]], "two": {}},
+    "empty": [],
+}
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 1 << 16])
+def test_walk_document(block_size):
+    """Test decoding and skipping values, wherever the blocks are split."""
+    stream = JSONStream(io.StringIO(json.dumps(DOCUMENT)), block_size)
+    found = {}
+    for key in stream.object_keys():
+        if key == "skipped":
+            stream.skip()
+        elif key == "numbers":
+            found[key] = [stream.decode() for _ in stream.array_items()]
+        elif key == "empty":
+            found[key] = list(stream.array_items())
+        else:
+            found[key] = stream.decode()
+    assert found == {key: value for key, value in DOCUMENT.items() if key != "skipped"}
+
+
+def test_skip_scalars():
+    """Test that skipping works for values which are not containers."""
+    stream = JSONStream(io.StringIO('[12, "a\\\\", null, {"k": "v"}]'), 2)
+    for _ in stream.array_items():
+        stream.skip()
+    with pytest.raises(ValueError):
+        stream.peek()
+
+
+def test_invalid_document():
+    """Test that errors are raised for malformed or incomplete documents."""
+    stream = JSONStream(io.StringIO('["a" "b"]'))
+    with pytest.raises(ValueError):
+        for _ in stream.array_items():
+            stream.decode()
+    stream = JSONStream(io.StringIO('{"a": [1, 2'), 3)
+    with pytest.raises(ValueError):
+        for _ in stream.object_keys():
+            stream.skip()
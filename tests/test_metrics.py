@@ -0,0 +1,38 @@
+import time
+
+import elasticsearch
+
+from api import app
+from api.metrics import start_request, TimedTransport
+
+
+def test_metrics_endpoint():
+    """Check that requests are counted and timed for each route."""
+    client = app.test_client()
+    assert client.get("/stats").status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    metrics = response.get_data(as_text=True)
+    assert 'oracc_requests_total{method="GET",route="/stats",status="200"}' in metrics
+    for phase in ["es", "network", "processing", "serialization"]:
+        assert 'seconds_count{{phase="{}",route="/stats"}}'.format(phase) in metrics
+    assert 'oracc_response_size_bytes_count{route="/stats"}' in metrics
+    # The metrics endpoint itself is not included
+    assert 'route="/metrics"' not in metrics
+
+
+def test_es_phases(monkeypatch):
+    """Check that the time spent waiting for ES is split using its "took" field."""
+    def fake_request(self, method, url, headers=None, params=None, body=None):
+        time.sleep(0.05)
+        return {"took": 20, "hits": {"hits": []}}
+
+    monkeypatch.setattr(elasticsearch.Transport, "perform_request", fake_request)
+    transport = TimedTransport([{"host": "localhost"}])
+    timings = start_request()
+    transport.perform_request("POST", "/oracc/_search", body={})
+    transport.perform_request("POST", "/oracc/_search", body={})
+    phases = timings.phases(total=0.5)
+    assert phases["es"] == 0.04
+    assert phases["network"] >= 0.05
+    assert abs(sum(phases.values()) - 0.5) < 1e-9
@@ -0,0 +1,64 @@
+import json
+import os
+
+import elasticsearch
+
+from api import app, ESearch
+from api.metrics import start_request, TimedTransport
+
+
+def fake_run(self, word, stream=False, **args):
+    # Profiled searches should not be answered from the cache
+    return [{"gw": "god", "profiled": self.profile}]
+
+
+def test_profile_disabled(monkeypatch):
+    """Check that profiles are only given if the server allows it."""
+    monkeypatch.delenv("ORACC_PROFILING", raising=False)
+    monkeypatch.setattr(ESearch, "run", fake_run)
+    response = app.test_client().get("/search/god?profile=1")
+    assert response.json == [{"gw": "god", "profiled": False}]
+
+
+def test_profile_block(monkeypatch):
+    """Check that the profile of a request is added to its results."""
+    monkeypatch.setenv("ORACC_PROFILING", "1")
+    monkeypatch.setattr(ESearch, "run", fake_run)
+    client = app.test_client()
+    response = client.get("/search/god?profile=1")
+    assert response.json["results"] == [{"gw": "god", "profiled": True}]
+    profile = response.json["_profile"]
+    assert set(profile["phases"]) == {"es", "network", "processing", "serialization"}
+    assert profile["python"]
+    assert set(profile["python"][0]) == {"function", "calls", "seconds", "cumulative_seconds"}
+    assert profile["es"] == []
+    # Requests which don't ask for a profile are unchanged
+    assert client.get("/search/god").json == [{"gw": "god", "profiled": False}]
+
+
+def test_es_profile(monkeypatch):
+    """Check that searches ask ES for a profile, and that it is collected."""
+    search = ESearch(client=object(), profile=True)
+    assert search._general_search("god").to_dict()["profile"] is True
+    assert "profile" not in ESearch(client=object())._general_search("god").to_dict()
+
+    def fake_request(self, method, url, headers=None, params=None, body=None):
+        return {"took": 1, "responses": [{"took": 1, "profile": {"shards": []}}]}
+
+    monkeypatch.setattr(elasticsearch.Transport, "perform_request", fake_request)
+    timings = start_request()
+    TimedTransport([{"host": "localhost"}]).perform_request("POST", "/_msearch")
+    assert timings.es_profiles == [{"shards": []}]
+
+
+def test_slow_request_dump(monkeypatch, tmp_path):
+    """Check that requests slower than the threshold are written to disk."""
+    monkeypatch.setenv("ORACC_SLOW_REQUEST_SECONDS", "0.000001")
+    monkeypatch.setenv("ORACC_PROFILE_DIR", str(tmp_path))
+    app.test_client().get("/stats")
+    (filename,) = os.listdir(tmp_path)
+    with open(tmp_path / filename) as infile:
+        report = json.load(infile)
+    assert report["url"] == "/stats?"
+    assert report["total_seconds"] > 0
+    assert report["python"] is None  # this request was not profiled
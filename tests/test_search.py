@@ -1,4 +1,16 @@
-from api import ESearch
+import copy
+import json
+
+from elasticsearch.exceptions import NotFoundError, TransportError
+from elasticsearch_dsl import Search
+import pytest
+
+from api import _parse_batch_operation, _parse_request_args, app, ESearch, MAX_BATCH_COUNT
+import api.cache
+from api.cache import ResultCache
+from api.client import pool_stats
+from api.search import InvalidCursor
+import ingest.bulk_upload
 
 
 def test_sort_field_name():
@@ -16,6 +28,74 @@ def test_sort_field_name():
         assert search._sort_field_name(field, direction) == expected
 
 
+def test_sort_fields():
+    """Check that results are sorted by popularity first, with a tie-breaker."""
+    search = ESearch()
+    assert search._sort_fields("gw", "desc") == [
+        "-instances_count",
+        "-gw.keyword",
+        "id",
+    ]
+
+
+def test_project():
+    """Check that the fields returned by a search are chosen correctly."""
+    search = ESearch()
+    base = Search()
+    # By default, whole documents are returned
+    assert "_source" not in search._project(base).to_dict()
+    source = search._project(base, fields=["gw", "cf"]).to_dict()["_source"]
+    assert source == {"includes": ["gw", "cf"]}
+    source = search._project(base, exclude=["forms_n"]).to_dict()["_source"]
+    assert source == {"excludes": ["forms_n"]}
+
+
+def test_parse_field_lists():
+    """Check that lists of fields are read from the request arguments."""
+    args = _parse_request_args({"fields": "gw,cf", "exclude": "forms_n, "})
+    assert args == {"fields": ["gw", "cf"], "exclude": ["forms_n"]}
+
+
+def test_parse_after():
+    """Check that "after" must be the sort values of a result."""
+    args = _parse_request_args({"after": '[3, "god", "x.1"]'})
+    assert args == {"after": [3, "god", "x.1"]}
+    assert len(ESearch()._sort_fields("gw", "asc")) == ESearch.SORT_KEYS
+    client = app.test_client()
+    for after in ["3", "god", "[3]", '{"gw": "god"}']:
+        assert client.get("/search/god", query_string={"after": after}).status_code == 400
+    operation = {"type": "search", "word": "god", "after": [3]}
+    assert client.post("/batch", json=[operation]).status_code == 400
+
+
+def test_default_projection(uploaded_entries, test_index_name):
+    """Check that entries come with their number of instances, but never the instances."""
+    search = ESearch(index_name=test_index_name)
+    for entry in search.run("god", sort_by="gw"):
+        assert "instances" not in entry
+        assert "instances_count" in entry
+    for entry in search.run("god", sort_by="gw", fields=["gw", "instances"]):
+        assert set(entry) == {"gw", "sort"}
+
+
+def test_paging_with_after(uploaded_entries, test_index_name):
+    """Check that paging through the results gives every entry exactly once."""
+    search = ESearch(index_name=test_index_name)
+    full_list = search.list_all(sort_by="gw")
+    # The most frequent entries should come first
+    counts = [entry["instances_count"] for entry in full_list]
+    assert counts == sorted(counts, reverse=True)
+    pages = []
+    after = None
+    while True:
+        page = search.list_all(sort_by="gw", count=1, after=after)
+        if not page:
+            break
+        pages.extend(page)
+        after = json.loads(page[-1]["sort"])
+    assert [entry["id"] for entry in pages] == [entry["id"] for entry in full_list]
+
+
 def test_list_all(uploaded_entries, test_index_name):
     """Check that the list_all endpoint returns all the entries."""
     search = ESearch(index_name=test_index_name)
@@ -111,3 +191,303 @@ def test_completion_cf(uploaded_entries, test_index_name):
     # Completions only has one source so the length should
     # be the given size parameter
     assert len(results) <= 5
+
+
+def test_shared_client():
+    """Check that all searches borrow the same Elasticsearch client."""
+    assert ESearch().client is ESearch().client
+    # The pool statistics should describe the connection to each node.
+    stats = pool_stats()
+    assert stats
+    for node_stats in stats:
+        assert node_stats["idle"] + node_stats["in_use"] <= node_stats["opened"]
+
+
+def test_instances(uploaded_entries, test_index_name):
+    """Check that the instances of an entry can be retrieved in pages."""
+    search = ESearch(index_name=test_index_name)
+    entry = uploaded_entries[0]
+    results = search.instances(entry["id"], after=0, count=1)
+    assert results["total"] == len(entry["instances"])
+    assert results["instances"] == entry["instances"][:1]
+    # Asking for positions beyond the end gives no instances, but the total
+    results = search.instances(entry["id"], after=len(entry["instances"]), count=5)
+    assert results["instances"] == []
+    assert results["next"] is None
+    # Unknown entries are reported as missing
+    assert search.instances("no.such.entry") is None
+
+
+def test_stream_results(monkeypatch):
+    """Check that results can be streamed as NDJSON, one entry per line."""
+    entries = [{"gw": "god"}, {"gw": "goddess"}]
+
+    def fake_run(self, word, stream=False, **args):
+        assert stream
+        return (entry for entry in entries)
+
+    monkeypatch.setattr(ESearch, "run", fake_run)
+    client = app.test_client()
+    for kwargs in [
+        {"query_string": {"stream": "1"}},
+        {"headers": {"Accept": "application/x-ndjson"}},
+    ]:
+        response = client.get("/search/god", **kwargs)
+        assert response.mimetype == "application/x-ndjson"
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line) for line in lines] == entries
+    # No results should give the same response as when not streaming
+    monkeypatch.setattr(ESearch, "run", lambda *args, **kwargs: iter([]))
+    assert client.get("/search/god?stream=1").status_code == 204
+
+
+class FakeMultiSearchClient:
+    """Stands in for an ES client, answering multi-searches with fixed responses."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.bodies = []
+
+    def msearch(self, index=None, body=None, **kwargs):
+        self.bodies.append(body)
+        return {"responses": self.responses}
+
+
+@pytest.mark.parametrize("raw", [True, False])
+def test_batch(raw):
+    """Check that batched operations are sent together and answered in order."""
+    hit = {"_source": {"gw": "god", "instances_count": 2}, "sort": [2, "god", "x.1"]}
+    client = FakeMultiSearchClient(
+        [
+            {"hits": {"hits": [hit]}},
+            {
+                "suggest": {
+                    "sug_complete": [
+                        {
+                            "text": "go",
+                            "options": [
+                                {"text": "goddess", "_score": 1, "_source": {}},
+                                {"text": "god", "_score": 1, "_source": {}},
+                            ],
+                        }
+                    ]
+                }
+            },
+        ]
+    )
+    search = ESearch(client=client, raw=raw)
+    results = search.batch(
+        [
+            {"type": "search", "word": "god", "count": 5, "fields": ["gw"]},
+            {"type": "completion", "word": "go"},
+        ]
+    )
+    assert results == [
+        [{"gw": "god", "instances_count": 2, "sort": '[2, "god", "x.1"]'}],
+        ["god", "goddess"],
+    ]
+    # Check that both operations were sent in a single request, each
+    # preceded by its header
+    body = client.bodies[0]
+    assert len(body) == 4
+    assert body[1]["size"] == 5
+    assert body[1]["_source"]["includes"] == ["gw"]
+    assert "sug_complete" in body[3]["suggest"]
+
+
+@pytest.mark.parametrize("raw", [True, False])
+def test_batch_error(raw):
+    """Check that a failed operation fails the whole batch."""
+    error = {"type": "search_phase_execution_exception", "reason": "all shards failed"}
+    client = FakeMultiSearchClient([{"hits": {"hits": []}}, {"error": error}])
+    search = ESearch(client=client, raw=raw)
+    with pytest.raises(TransportError):
+        search.batch([{"type": "search", "word": "god"}, {"type": "search", "word": "go"}])
+
+
+class FakeSearchClient:
+    """Stands in for an ES client, answering every search with a fixed response."""
+
+    def __init__(self, response):
+        self.response = response
+        self.bodies = []
+
+    def search(self, index=None, body=None, **kwargs):
+        self.bodies.append(body)
+        return copy.deepcopy(self.response)
+
+
+@pytest.mark.parametrize("raw", [True, False])
+def test_raw_responses(monkeypatch, raw):
+    """Check that raw responses give the same results as elasticsearch_dsl's objects."""
+    monkeypatch.setattr(api.cache, "_cache", ResultCache(max_bytes=0, ttl=0, check_interval=0))
+    hits = [
+        {"_source": {"id": "x.{}".format(n), "gw": "god"}, "sort": [3 - n, "god", "x.{}".format(n)]}
+        for n in range(3)
+    ]
+    options = [
+        {"text": "goddess", "_score": 1.0, "_source": {"instances_count": 1}},
+        {"text": "god", "_score": 1.0, "_source": {"instances_count": 5}},
+    ]
+    client = FakeSearchClient(
+        {
+            "hits": {"hits": hits},
+            "suggest": {"sug_complete": [{"text": "go", "options": options}]},
+        }
+    )
+    search = ESearch(client=client, raw=raw)
+    expected = [
+        {"id": "x.{}".format(n), "gw": "god", "sort": '[{}, "god", "x.{}"]'.format(3 - n, n)}
+        for n in range(3)
+    ]
+    assert search.run("god", count=3) == expected
+    assert client.bodies[-1]["size"] == 3
+    assert search.list_all(after=[3, "god", "x.0"], count=2) == expected
+    assert client.bodies[-1]["search_after"] == [3, "god", "x.0"]
+    assert client.bodies[-1]["size"] == 2
+    assert search.complete("go", 10) == ["god", "goddess"]
+    # The instances are read from the chunks in the same way
+    chunks = [
+        {"entry_id": "x.0", "start": 0, "end": 3, "total": 5, "instances": ["a", "b", "c"]},
+        {"entry_id": "x.0", "start": 3, "end": 5, "total": 5, "instances": ["d", "e"]},
+    ]
+    client.response = {"hits": {"hits": [{"_source": chunk} for chunk in chunks]}}
+    assert search.instances("x.0", after=1, count=3) == {
+        "id": "x.0",
+        "total": 5,
+        "instances": ["b", "c", "d"],
+        "next": 4,
+    }
+
+
+def test_batch_endpoint_validation():
+    """Check that invalid batch requests are rejected."""
+    client = app.test_client()
+    assert client.post("/batch", json={"type": "search"}).status_code == 400
+    assert client.post("/batch", json=[{"type": "lookup", "word": "god"}]).status_code == 400
+    assert client.post("/batch", json=[{"type": "search"}]).status_code == 400
+    for invalid in [
+        {"count": "many"},
+        {"count": -1},
+        {"fields": 3},
+        {"exclude": ["gw", {"cf": 1}]},
+        {"sort_by": ["gw"]},
+    ]:
+        operation = dict({"type": "search", "word": "god"}, **invalid)
+        assert client.post("/batch", json=[operation]).status_code == 400
+
+
+def test_parse_batch_operation():
+    """Check that the options of batch operations are normalised and limited."""
+    parsed = _parse_batch_operation(
+        {"type": "search", "word": "god", "count": 10 ** 9, "fields": "gw, ,cf"}
+    )
+    assert parsed["count"] == MAX_BATCH_COUNT
+    assert parsed["fields"] == ["gw", "cf"]
+
+
+class FakePointInTimeClient:
+    """
+    Stands in for an ES client, paging through fixed hits in a point in time.
+
+    The hits are assumed to be in order already, and to have sort values which
+    can be compared in the same order.
+    """
+
+    def __init__(self, hits):
+        self.hits = hits
+        self.open = set()
+        self.opened = 0
+
+    def open_point_in_time(self, index, keep_alive=None, **kwargs):
+        self.opened += 1
+        pit_id = "pit{}".format(self.opened)
+        self.open.add(pit_id)
+        return {"id": pit_id}
+
+    def close_point_in_time(self, body, **kwargs):
+        self.open.remove(body["id"])
+
+    def search(self, body, index=None, **kwargs):
+        assert index is None  # searches in a point in time can't name indices
+        pit_id = body["pit"]["id"]
+        if pit_id not in self.open:
+            raise NotFoundError(404, "search_context_missing_exception")
+        after = body.get("search_after")
+        hits = [hit for hit in self.hits if after is None or hit["sort"] > after]
+        # ES can give a new id for the same point in time
+        self.open.remove(pit_id)
+        self.open.add(pit_id + "+")
+        return {"pit_id": pit_id + "+", "hits": {"hits": hits[:body["size"]]}}
+
+
+def test_cursor_paging():
+    """Check that paging with cursors returns every result exactly once."""
+    # Several entries share the same number of instances and guideword
+    hits = [
+        {"_source": {"id": "x.{}".format(n), "gw": "god"}, "sort": [n // 4, "god", "x.%02d" % n]}
+        for n in range(10)
+    ]
+    client = FakePointInTimeClient(hits)
+    search = ESearch(client=client)
+    seen = []
+    cursor = None
+    for _ in range(10):
+        results, cursor = search.page("god", cursor, count=3)
+        seen.extend(result["id"] for result in results)
+        if cursor is None:
+            break
+    assert seen == ["x.{}".format(n) for n in range(10)]
+    # Only one point in time is needed, and it is closed at the end
+    assert client.opened == 1
+    assert not client.open
+    # Cursors can only be used for the search they came from
+    _, cursor = search.page("god", count=3)
+    with pytest.raises(InvalidCursor):
+        search.page("goddess", cursor, count=3)
+    with pytest.raises(InvalidCursor):
+        search.page("god", "not a cursor", count=3)
+    # ...and not after their point in time has expired
+    client.open.clear()
+    with pytest.raises(InvalidCursor):
+        search.page("god", cursor, count=3)
+
+
+def test_cursor_endpoint(monkeypatch):
+    """Check that the next cursor is sent in a header."""
+    def fake_page(self, word=None, cursor=None, count=None, **args):
+        if cursor == "bad":
+            raise InvalidCursor("Invalid cursor")
+        if cursor:
+            return [{"gw": "goddess"}], None
+        return [{"gw": "god"}], "next"
+
+    monkeypatch.setattr(ESearch, "page", fake_page)
+    client = app.test_client()
+    response = client.get("/search_all?cursor=")
+    assert response.json == [{"gw": "god"}]
+    assert response.headers["X-Next-Cursor"] == "next"
+    response = client.get("/search/god?cursor=next")
+    assert response.json == [{"gw": "goddess"}]
+    assert "X-Next-Cursor" not in response.headers
+    assert client.get("/search/god?cursor=bad").status_code == 400
+
+
+def test_instances_count(monkeypatch):
+    """Check that only the chunks which can hold the instances requested are fetched."""
+    # The chunks must be read as the ingest writes them
+    assert ESearch.INSTANCES_CHUNK_SIZE == ingest.bulk_upload.INSTANCES_CHUNK_SIZE
+    client = FakeSearchClient({"hits": {"hits": []}})
+    search = ESearch(client=client)
+    search.instances("x.0", after=10, count=2500)
+    assert client.bodies[0]["size"] == 4
+    requested = []
+
+    def fake_instances(self, entry_id, after=0, count=100):
+        requested.append(count)
+        return {"id": entry_id, "total": 0, "instances": [], "next": None}
+
+    # Larger requests are capped
+    monkeypatch.setattr(ESearch, "instances", fake_instances)
+    app.test_client().get("/entry/x.0/instances?count=1000000000")
+    assert requested == [ESearch.MAX_INSTANCES_COUNT]